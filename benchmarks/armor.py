@@ -0,0 +1,115 @@
+# -*- encoding: utf-8 -*-
+# armor.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmark for the ASCII armoring of the vendored pgpy.
+
+For each size, random data generated from a fixed seed is checksummed with
+Armorable.crc24 and with the bit by bit CRC24 of RFC 4880, which pgpy used
+before, to check that they agree and compare their speed. The time to armor
+a literal message holding the data is measured too:
+
+    $ python -m benchmarks.armor --sizes 1024,1048576
+"""
+
+import random
+import sys
+
+from twisted.python import usage
+
+from leap.mx.vendor.pgpy import PGPMessage
+from leap.mx.vendor.pgpy.constants import CompressionAlgorithm
+from leap.mx.vendor.pgpy.types import Armorable
+
+from benchmarks.common import best_time, write_report
+
+
+class Options(usage.Options):
+
+    optParameters = [
+        ["sizes", "s", "1024,65536,1048576",
+         "Comma separated sizes of the data, in bytes."],
+        ["reference-max-size", None, 1048576,
+         "Largest size checksummed with the bit by bit CRC24.", int],
+        ["repeat", "r", 3, "Runs of each measure, the best is kept.", int],
+        ["seed", None, 0, "Seed for the random generator.", int],
+        ["output", "o", None,
+         "File to write the json report to, stdout by default."],
+    ]
+
+    def postOptions(self):
+        try:
+            self["sizes"] = [int(size) for size in self["sizes"].split(",")]
+        except ValueError:
+            raise usage.UsageError("Invalid sizes: %s" % (self["sizes"],))
+
+
+def reference_crc24(data):
+    """
+    The CRC24 of RFC 4880, computed a bit at a time.
+    """
+    crc = 0x0B704CE
+    for b in bytearray(data):
+        crc ^= b << 16
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= 0x1864CFB
+    return crc & 0xFFFFFF
+
+
+def measure(data, options):
+    crc, crc24_time = best_time(lambda: Armorable.crc24(data),
+                                options["repeat"])
+    result = {
+        "crc24_seconds": crc24_time,
+        "crc24_bytes_per_second": len(data) / crc24_time,
+    }
+    if len(data) <= options["reference-max-size"]:
+        reference, reference_time = best_time(
+            lambda: reference_crc24(data), 1)
+        result["reference_crc24_seconds"] = reference_time
+        result["crc24_matches_reference"] = crc == reference
+
+    message = PGPMessage.new(
+        data, compression=CompressionAlgorithm.Uncompressed)
+    armored, armor_time = best_time(lambda: str(message), options["repeat"])
+    result["armor_seconds"] = armor_time
+    result["armored_bytes"] = len(armored)
+    return result
+
+
+def main(argv):
+    options = Options()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError as e:
+        sys.stderr.write("%s\n%s\n" % (options, e))
+        return 1
+    rand = random.Random(options["seed"])
+    results = {}
+    for size in options["sizes"]:
+        data = bytearray(rand.getrandbits(8) for _ in xrange(size))
+        results[str(size)] = measure(bytes(data), options)
+    write_report({"seed": options["seed"], "sizes": results},
+                 options["output"])
+    mismatches = [size for size, result in results.iteritems()
+                  if result.get("crc24_matches_reference") is False]
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,133 @@
+# -*- encoding: utf-8 -*-
+# common.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Helpers shared by the benchmarks.
+"""
+
+import json
+import math
+import os
+import resource
+import sys
+import time
+
+
+def percentile(sorted_values, fraction):
+    """
+    Return the value below which the given fraction of the values fall,
+    using the nearest rank method.
+
+    :param sorted_values: The values, sorted in ascending order.
+    :type sorted_values: list
+    :param fraction: The fraction, between 0 and 1.
+    :type fraction: float
+    """
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(fraction * len(sorted_values))) - 1
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+
+def latency_summary(latencies):
+    """
+    Summarize latencies, in seconds, as a dict of milliseconds.
+
+    :param latencies: The observed latencies in seconds.
+    :type latencies: list of float
+
+    :rtype: dict
+    """
+    values = sorted(latencies)
+    summary = {}
+    for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99),
+                           ("p999", 0.999)):
+        value = percentile(values, fraction)
+        summary[name] = value * 1000 if value is not None else None
+    if values:
+        summary["min"] = values[0] * 1000
+        summary["max"] = values[-1] * 1000
+        summary["mean"] = sum(values) / len(values) * 1000
+    return summary
+
+
+def best_time(f, repeat):
+    """
+    Run f repeat times, and return its result with the shortest time it
+    took, in seconds.
+
+    :param f: The function measured, called without arguments.
+    :type f: callable
+    :param repeat: The number of runs.
+    :type repeat: int
+
+    :rtype: tuple of (object, float)
+    """
+    best = None
+    for _ in xrange(repeat):
+        started = time.time()
+        result = f()
+        elapsed = time.time() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+
+def peak_memory(f):
+    """
+    Run f once in a child process, and return how much the peak RSS of the
+    process grew while it ran, in KB. Forking keeps the peaks reached by
+    what was measured before from hiding this one.
+
+    :param f: The function measured, called without arguments.
+    :type f: callable
+
+    :return: The growth of the peak RSS, or None if f failed.
+    :rtype: int
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        try:
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            f()
+            after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.write(write, str(after - before))
+        finally:
+            os._exit(0)
+    os.close(write)
+    with os.fdopen(read) as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+    return int(data) if data else None
+
+
+def write_report(report, path=None):
+    """
+    Write a benchmark report as json to path, or to stdout.
+
+    :param report: The results.
+    :type report: dict
+    :param path: The file to write to, or None for stdout.
+    :type path: str
+    """
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if path is None:
+        sys.stdout.write(data + "\n")
+    else:
+        with open(path, "w") as f:
+            f.write(data + "\n")
@@ -0,0 +1,170 @@
+# -*- encoding: utf-8 -*-
+# keys.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmark for the parsing of public keys by the vendored pgpy.
+
+Every packet and signature subpacket of a key is dispatched to its class
+by MetaDispatchable, and kept as an object once the key is parsed. Keys
+with the given number of user ids are generated, and the time to parse them
+from their armored and binary forms is measured, along with the memory a
+parsed key takes, as it is kept in the KeyCache:
+
+    $ python -m benchmarks.keys --uids 1,10 --iterations 200
+"""
+
+import gc
+import sys
+import types
+
+from twisted.python import usage
+
+from leap.mx.vendor.pgpy import PGPKey, PGPUID
+from leap.mx.vendor.pgpy.constants import CompressionAlgorithm
+from leap.mx.vendor.pgpy.constants import HashAlgorithm
+from leap.mx.vendor.pgpy.constants import KeyFlags
+from leap.mx.vendor.pgpy.constants import PubKeyAlgorithm
+from leap.mx.vendor.pgpy.constants import SymmetricKeyAlgorithm
+from leap.mx.vendor.pgpy.packet import Packet
+
+from benchmarks.common import best_time, write_report
+
+
+class Options(usage.Options):
+
+    optParameters = [
+        ["uids", "u", "1,10", "Comma separated numbers of user ids."],
+        ["key-size", None, 2048, "Size of the RSA keys, in bits.", int],
+        ["iterations", "i", 200, "Times each key is parsed in a run.", int],
+        ["repeat", "r", 3, "Runs of each measure, the best is kept.", int],
+        ["output", "o", None,
+         "File to write the json report to, stdout by default."],
+    ]
+
+    def postOptions(self):
+        try:
+            self["uids"] = [int(uids) for uids in self["uids"].split(",")]
+        except ValueError:
+            raise usage.UsageError("Invalid uids: %s" % (self["uids"],))
+
+
+def generate_key(size, uids):
+    """
+    Generate a public key with a number of self signed user ids.
+    """
+    key = PGPKey.new(PubKeyAlgorithm.RSAEncryptOrSign, size)
+    for i in xrange(uids):
+        uid = PGPUID.new("Benchmark %d" % (i,),
+                         email="benchmark%d@example.org" % (i,))
+        key.add_uid(uid,
+                    usage=set([KeyFlags.Sign, KeyFlags.EncryptCommunications,
+                               KeyFlags.EncryptStorage]),
+                    hashes=[HashAlgorithm.SHA256, HashAlgorithm.SHA512],
+                    ciphers=[SymmetricKeyAlgorithm.AES256,
+                             SymmetricKeyAlgorithm.AES128],
+                    compression=[CompressionAlgorithm.ZLIB,
+                                 CompressionAlgorithm.ZIP])
+    return key.pubkey
+
+
+def count_packets(binary):
+    """
+    Return the number of packets and signature subpackets in a key.
+    """
+    data = bytearray(binary)
+    packets = subpackets = 0
+    while data:
+        packet = Packet(data)
+        packets += 1
+        signature = getattr(packet, "subpackets", None)
+        if signature is not None:
+            subpackets += (len(signature._hashed_sp) +
+                           len(signature._unhashed_sp))
+    return packets, subpackets
+
+
+def reachable(obj):
+    """
+    Return the objects reachable from obj, by id, without going into classes
+    and modules.
+    """
+    seen = {}
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, (type, types.ModuleType)):
+            continue
+        seen[id(o)] = o
+        stack.extend(gc.get_referents(o))
+    return seen
+
+
+def key_memory(blob):
+    """
+    Return the number of objects a parsed key is made of and their size in
+    bytes. The objects it shares with another parse of the same key, like
+    enum members and interned strings, are left out.
+    """
+    key, _ = PGPKey.from_blob(blob)
+    other, _ = PGPKey.from_blob(blob)
+    shared = reachable(other)
+    objects = [o for i, o in reachable(key).iteritems() if i not in shared]
+    return len(objects), sum(sys.getsizeof(o) for o in objects)
+
+
+def measure(key, options):
+    armored = str(key)
+    binary = bytes(key.__bytes__())
+    packets, subpackets = count_packets(binary)
+    iterations = options["iterations"]
+
+    def parse(blob):
+        for _ in xrange(iterations):
+            PGPKey.from_blob(blob)
+
+    _, armored_time = best_time(lambda: parse(armored), options["repeat"])
+    _, binary_time = best_time(lambda: parse(binary), options["repeat"])
+    objects, size = key_memory(binary)
+    return {
+        "packets": packets,
+        "subpackets": subpackets,
+        "objects_per_key": objects,
+        "bytes_per_key": size,
+        "armored_keys_per_second": iterations / armored_time,
+        "binary_keys_per_second": iterations / binary_time,
+        "dispatches_per_second":
+            iterations * (packets + subpackets) / binary_time,
+    }
+
+
+def main(argv):
+    options = Options()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError as e:
+        sys.stderr.write("%s\n%s\n" % (options, e))
+        return 1
+    results = {}
+    for uids in options["uids"]:
+        key = generate_key(options["key-size"], uids)
+        results[str(uids)] = measure(key, options)
+    write_report({"key_size": options["key-size"], "uids": results},
+                 options["output"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
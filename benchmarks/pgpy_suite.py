@@ -0,0 +1,262 @@
+# -*- encoding: utf-8 -*-
+# pgpy_suite.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmark suite for the operations of the vendored pgpy that leap.mx runs
+on every incoming message.
+
+Keys of each kind are generated with a number of certifications on their
+user id, and parsed with PGPKey.from_blob. Mail like data of each size,
+text followed by a base64 encoded attachment, is made into a PGPMessage
+with each compression algorithm, encrypted to a key, checksummed with
+Armorable.crc24, armored and unarmored. For each operation the shortest
+time of a few runs and the growth of the peak RSS during one run are
+reported.
+
+The data comes from a fixed seed. The key material can't be seeded, but
+the keys have the same structure on every run, which is what the time to
+parse them depends on. A report written before can be given as the
+baseline, the operations that take longer or more memory than in it by
+more than the tolerance are listed as regressions, and make the benchmark
+exit with 1:
+
+    $ python -m benchmarks.pgpy_suite --output baseline.json
+    $ python -m benchmarks.pgpy_suite --baseline baseline.json
+"""
+
+import base64
+import json
+import random
+import sys
+
+from twisted.python import usage
+
+from leap.mx.vendor.pgpy import PGPKey, PGPMessage, PGPUID
+from leap.mx.vendor.pgpy.constants import CompressionAlgorithm
+from leap.mx.vendor.pgpy.constants import EllipticCurveOID
+from leap.mx.vendor.pgpy.constants import HashAlgorithm
+from leap.mx.vendor.pgpy.constants import KeyFlags
+from leap.mx.vendor.pgpy.constants import PubKeyAlgorithm
+from leap.mx.vendor.pgpy.constants import SymmetricKeyAlgorithm
+from leap.mx.vendor.pgpy.types import Armorable
+
+from benchmarks.common import best_time, peak_memory, write_report
+
+
+"""
+Differences under these are noise, and never reported as regressions.
+"""
+MIN_SECONDS = 0.002
+MIN_KB = 1024
+
+KEY_TYPES = ("rsa2048", "rsa4096", "ecc")
+
+WORDS = ("the", "of", "and", "meeting", "attached", "please", "find",
+         "report", "tomorrow", "thanks", "regards", "project", "we", "will",
+         "send", "you", "a", "new", "version", "before", "friday", "list")
+
+
+class Options(usage.Options):
+
+    optFlags = [
+        ["no-memory", None, "Don't measure the peak memory."],
+    ]
+
+    optParameters = [
+        ["sizes", "s", "1024,65536,1048576,10485760,52428800",
+         "Comma separated sizes of the messages, in bytes."],
+        ["key-types", "k", ",".join(KEY_TYPES),
+         "Comma separated kinds of keys, among %s." % (", ".join(KEY_TYPES),)],
+        ["signatures", None, "0,50",
+         "Comma separated numbers of certifications on the keys."],
+        ["repeat", "r", 3, "Runs of each measure, the best is kept.", int],
+        ["seed", None, 0, "Seed for the random generator.", int],
+        ["baseline", "b", None, "Report to compare the results with."],
+        ["tolerance", "t", 0.25,
+         "Fraction by which a measure may exceed the baseline.", float],
+        ["output", "o", None,
+         "File to write the json report to, stdout by default."],
+    ]
+
+    def postOptions(self):
+        for name in ("sizes", "signatures"):
+            try:
+                self[name] = [int(value) for value in self[name].split(",")]
+            except ValueError:
+                raise usage.UsageError("Invalid %s: %s" % (name, self[name]))
+        self["key-types"] = self["key-types"].split(",")
+        for kind in self["key-types"]:
+            if kind not in KEY_TYPES:
+                raise usage.UsageError("Invalid key type: %s" % (kind,))
+
+
+def random_bytes(rand, size):
+    """
+    Return size random bytes from rand.
+    """
+    if size == 0:
+        return ""
+    return ("%0*x" % (2 * size, rand.getrandbits(8 * size))).decode("hex")
+
+
+def mail_data(rand, size):
+    """
+    Return size bytes looking like mail: a quarter of text, and the rest a
+    base64 encoded attachment of random data, like a compressed file.
+    """
+    text = []
+    length = 0
+    while length < size // 4:
+        word = rand.choice(WORDS)
+        text.append(word)
+        length += len(word) + 1
+    attachment = base64.encodestring(random_bytes(rand, size * 3 // 4 + 3))
+    return (" ".join(text) + "\n\n" + attachment)[:size]
+
+
+def generate_key(kind, signatures, signer):
+    """
+    Generate a public key of a kind, with a number of certifications by
+    signer on its user id.
+    """
+    if kind == "ecc":
+        key = PGPKey.new(PubKeyAlgorithm.ECDSA, EllipticCurveOID.NIST_P256)
+        usage = set([KeyFlags.Sign])
+    else:
+        key = PGPKey.new(PubKeyAlgorithm.RSAEncryptOrSign, int(kind[3:]))
+        usage = set([KeyFlags.Sign, KeyFlags.EncryptCommunications,
+                     KeyFlags.EncryptStorage])
+    uid = PGPUID.new("Benchmark", email="benchmark@example.org")
+    key.add_uid(uid, usage=usage,
+                hashes=[HashAlgorithm.SHA256, HashAlgorithm.SHA512],
+                ciphers=[SymmetricKeyAlgorithm.AES256,
+                         SymmetricKeyAlgorithm.AES128],
+                compression=[CompressionAlgorithm.ZLIB,
+                             CompressionAlgorithm.ZIP])
+    if kind == "ecc":
+        subkey = PGPKey.new(PubKeyAlgorithm.ECDH, EllipticCurveOID.NIST_P256)
+        key.add_subkey(subkey, usage=set([KeyFlags.EncryptCommunications,
+                                          KeyFlags.EncryptStorage]))
+    uid = key.userids[0]
+    for i in xrange(signatures):
+        uid |= signer.certify(uid, notation={"n@example.org": str(i)})
+    return key.pubkey
+
+
+def measure(name, f, options, operations):
+    """
+    Measure the time and peak memory of an operation, and add them to
+    operations.
+    """
+    result, seconds = best_time(f, options["repeat"])
+    operations[name] = {
+        "seconds": seconds,
+        "peak_kb": None if options["no-memory"] else peak_memory(f),
+    }
+    return result
+
+
+def run(options):
+    """
+    Measure every operation, and return the results by operation name.
+    """
+    operations = {}
+    signer = PGPKey.new(PubKeyAlgorithm.RSAEncryptOrSign, 1024)
+    signer.add_uid(PGPUID.new("Signer", email="signer@example.org"),
+                   usage=set([KeyFlags.Certify]),
+                   hashes=[HashAlgorithm.SHA256])
+    keys = {}
+    for kind in options["key-types"]:
+        for signatures in options["signatures"]:
+            blob = str(generate_key(kind, signatures, signer))
+            keys[kind] = measure(
+                "from_blob/%s/%d" % (kind, signatures),
+                lambda: PGPKey.from_blob(blob)[0], options, operations)
+    small = PGPMessage.new(mail_data(random.Random(options["seed"]), 1024))
+    for kind, key in sorted(keys.iteritems()):
+        measure("encrypt/%s/1024" % (kind,),
+                lambda: key.encrypt(small).__bytes__(), options, operations)
+
+    # the messages are encrypted to the rsa2048 key, the most common
+    recipient = keys.get("rsa2048") or sorted(keys.items())[0][1]
+    rand = random.Random(options["seed"])
+    for size in options["sizes"]:
+        data = mail_data(rand, size)
+        for alg in CompressionAlgorithm:
+            measure("new/%s/%d" % (alg.name, size),
+                    lambda: PGPMessage.new(data, compression=alg).__bytes__(),
+                    options, operations)
+            measure("encrypt/%s/%d" % (alg.name, size),
+                    lambda: recipient.encrypt(
+                        PGPMessage.new(data, compression=alg)).__bytes__(),
+                    options, operations)
+        message = PGPMessage.new(
+            data, compression=CompressionAlgorithm.Uncompressed)
+        measure("crc24/%d" % (size,), lambda: Armorable.crc24(data),
+                options, operations)
+        armored = measure("armor/%d" % (size,), lambda: str(message),
+                          options, operations)
+        measure("unarmor/%d" % (size,),
+                lambda: Armorable.ascii_unarmor(armored), options, operations)
+    return operations
+
+
+def compare(operations, baseline, tolerance):
+    """
+    Return the measures of the operations that exceed those of the
+    baseline by more than the tolerance.
+    """
+    regressions = []
+    for name, result in sorted(operations.iteritems()):
+        if name not in baseline:
+            continue
+        for measure_name, floor in (("seconds", MIN_SECONDS),
+                                    ("peak_kb", MIN_KB)):
+            value = result[measure_name]
+            base = baseline[name].get(measure_name)
+            if value is None or base is None:
+                continue
+            if value > base * (1 + tolerance) and value - base > floor:
+                regressions.append({
+                    "operation": name,
+                    "measure": measure_name,
+                    "baseline": base,
+                    "value": value,
+                })
+    return regressions
+
+
+def main(argv):
+    options = Options()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError as e:
+        sys.stderr.write("%s\n%s\n" % (options, e))
+        return 1
+    operations = run(options)
+    report = {"seed": options["seed"], "operations": operations}
+    if options["baseline"] is not None:
+        with open(options["baseline"]) as f:
+            baseline = json.load(f)["operations"]
+        report["baseline"] = options["baseline"]
+        report["regressions"] = compare(operations, baseline,
+                                        options["tolerance"])
+    write_report(report, options["output"])
+    return 1 if report.get("regressions") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,404 @@
+# -*- encoding: utf-8 -*-
+# spool.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+End to end throughput benchmark for the MailReceiver.
+
+Generates a Maildir spool of messages with a realistic size distribution,
+some multipart messages with attachments and many recipients, and runs the
+MailReceiver on it with local stand-ins for the identities CouchDB and the
+Soledad incoming API. Two modes are supported:
+
+    inotify: the receiver is started on an empty spool and the messages are
+             written into it at a given rate, as postfix would deliver them.
+    backlog: the messages are written before the receiver is started, and
+             are picked up by the processing of skipped mail.
+
+Throughput, the time spent in each stage, the peak RSS and the latency from
+the creation of a file to its document being stored are written as json:
+
+    $ python -m benchmarks.spool --mode backlog --messages 1000
+"""
+
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from twisted.internet import defer, reactor
+from twisted.python import usage
+from twisted.web import resource as web_resource
+from twisted.web import server
+
+from leap.mx import soledadhelper
+from leap.mx.mail_receiver import MailReceiver
+from leap.mx.metrics import RECEIVER_STAGE_LATENCY
+from leap.mx.vendor.pgpy import PGPKey, PGPUID
+from leap.mx.vendor.pgpy.constants import CompressionAlgorithm
+from leap.mx.vendor.pgpy.constants import HashAlgorithm
+from leap.mx.vendor.pgpy.constants import KeyFlags
+from leap.mx.vendor.pgpy.constants import PubKeyAlgorithm
+from leap.mx.vendor.pgpy.constants import SymmetricKeyAlgorithm
+
+from benchmarks.common import latency_summary, write_report
+
+
+STAGES = ("lookup", "encrypt", "export", "bounce", "total")
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+
+class Options(usage.Options):
+
+    optParameters = [
+        ["mode", "m", "backlog", "Either inotify or backlog."],
+        ["messages", "n", 500, "Number of messages.", int],
+        ["rate", "r", 100.0,
+         "Messages written per second in inotify mode.", float],
+        ["users", "u", 100, "Number of recipients with a key.", int],
+        ["median-size", None, 20000,
+         "Median message size in bytes.", int],
+        ["max-size", None, 5000000, "Maximum message size in bytes.", int],
+        ["multipart-ratio", None, 0.3,
+         "Fraction of multipart messages with an attachment.", float],
+        ["max-recipients", None, 50,
+         "Maximum number of addresses in the To and Cc headers.", int],
+        ["couchdb-latency", None, 0.002,
+         "Latency of the fake CouchDB, in seconds.", float],
+        ["api-latency", None, 0.005,
+         "Latency of the fake incoming API, in seconds.", float],
+        ["key-size", None, 2048, "Size of the recipients' RSA key.", int],
+        ["batch-size", None, 1,
+         "Messages per incoming API request in backlog mode.", int],
+        ["timeout", None, 600.0, "Give up after this many seconds.", float],
+        ["seed", None, 0, "Seed for the random generator.", int],
+        ["output", "o", None,
+         "File to write the json report to, stdout by default."],
+    ]
+
+    def postOptions(self):
+        if self["mode"] not in ("inotify", "backlog"):
+            raise usage.UsageError("Unknown mode: %s" % (self["mode"],))
+
+
+def generate_pubkey(size):
+    """
+    Generate a public key able to encrypt, like the ones users upload.
+    """
+    key = PGPKey.new(PubKeyAlgorithm.RSAEncryptOrSign, size)
+    uid = PGPUID.new("Benchmark", email="benchmark@example.org")
+    key.add_uid(uid,
+                usage=set([KeyFlags.Sign, KeyFlags.EncryptCommunications,
+                           KeyFlags.EncryptStorage]),
+                hashes=[HashAlgorithm.SHA256],
+                ciphers=[SymmetricKeyAlgorithm.AES256],
+                compression=[CompressionAlgorithm.ZLIB])
+    return str(key.pubkey)
+
+
+class MessageGenerator(object):
+    """
+    Generates the raw messages written to the spool.
+    """
+
+    def __init__(self, options, uuids, rand):
+        self._options = options
+        self._uuids = uuids
+        self._rand = rand
+
+    def _size(self):
+        # message sizes are roughly lognormal
+        size = int(self._rand.lognormvariate(0, 1.2) *
+                   self._options["median-size"])
+        return max(500, min(size, self._options["max-size"]))
+
+    def _text(self, size):
+        words = []
+        length = 0
+        while length < size:
+            word = self._rand.choice(WORDS)
+            words.append(word)
+            length += len(word) + 1
+            if len(words) % 12 == 0:
+                words.append("\n")
+        return " ".join(words)
+
+    def _addresses(self, count):
+        return ", ".join("rcpt%d@example.org" % self._rand.randint(0, 10000)
+                         for _ in xrange(count))
+
+    def message(self, number):
+        options = self._options
+        size = self._size()
+        if self._rand.random() < options["multipart-ratio"]:
+            msg = MIMEMultipart()
+            text_size = min(size, 2000)
+            msg.attach(MIMEText(self._text(text_size)))
+            attachment = MIMEApplication(os.urandom(
+                max(0, size - text_size) * 3 // 4))
+            attachment.add_header("Content-Disposition", "attachment",
+                                  filename="attachment%d.bin" % (number,))
+            msg.attach(attachment)
+        else:
+            msg = MIMEText(self._text(size))
+        recipients = self._rand.randint(1, options["max-recipients"])
+        to = self._rand.randint(1, recipients)
+        msg["From"] = "sender%d@example.net" % (number,)
+        msg["To"] = self._addresses(to)
+        if recipients > to:
+            msg["Cc"] = self._addresses(recipients - to)
+        msg["Subject"] = "Benchmark message %d" % (number,)
+        msg["Message-Id"] = "<%d.benchmark@example.net>" % (number,)
+        uuid = self._rand.choice(self._uuids)
+        return ("Delivered-To: %s@deliver.local\n" % (uuid,) +
+                "Return-Path: <sender%d@example.net>\n" % (number,) +
+                msg.as_string())
+
+
+class FakeUsersCouchDB(object):
+    """
+    Stands in for the identities database.
+    """
+
+    def __init__(self, pubkey, latency):
+        self._pubkey = pubkey
+        self._latency = latency
+
+    def getPubkey(self, uuid):
+        d = defer.Deferred()
+        reactor.callLater(self._latency, d.callback, self._pubkey)
+        return d
+
+
+class FakeIncomingAPI(web_resource.Resource):
+    """
+    Stands in for the Soledad incoming API, accepting every PUT and every
+    document in a batch.
+    """
+
+    isLeaf = True
+
+    def __init__(self, latency):
+        web_resource.Resource.__init__(self)
+        self._latency = latency
+        self.stored = 0
+        self.bytes = 0
+
+    def render_PUT(self, request):
+        self.bytes += len(request.content.read())
+
+        def _reply():
+            self.stored += 1
+            request.setResponseCode(200)
+            request.finish()
+
+        reactor.callLater(self._latency, _reply)
+        return server.NOT_DONE_YET
+
+    def render_POST(self, request):
+        body = request.content.read()
+        self.bytes += len(body)
+        docs = json.loads(body)["docs"]
+
+        def _reply():
+            self.stored += len(docs)
+            request.write(json.dumps({"results": [
+                {"doc_id": doc["doc_id"], "status": 200} for doc in docs]}))
+            request.finish()
+
+        reactor.callLater(self._latency, _reply)
+        return server.NOT_DONE_YET
+
+
+class BenchmarkMailReceiver(MailReceiver):
+    """
+    A MailReceiver that reports when a message is done with.
+    """
+
+    def __init__(self, benchmark, *args, **kwargs):
+        MailReceiver.__init__(self, *args, **kwargs)
+        self._benchmark = benchmark
+
+    def _remove(self, filepath):
+        MailReceiver._remove(self, filepath)
+        self._benchmark.done(filepath.path)
+
+
+class Benchmark(object):
+
+    def __init__(self, options):
+        self._options = options
+        self._rand = random.Random(options["seed"])
+        self._uuids = ["%032x" % self._rand.getrandbits(128)
+                       for _ in xrange(options["users"])]
+        self._generator = MessageGenerator(options, self._uuids, self._rand)
+        self._created = {}
+        self._written = 0
+        self.latencies = []
+        self.bytes = 0
+        self.failed = False
+
+    def setup(self):
+        self.root = tempfile.mkdtemp(prefix="leap-mx-spool-")
+        self.new = os.path.join(self.root, "new")
+        self.tmp = os.path.join(self.root, "tmp")
+        for sub in ("new", "cur", "tmp"):
+            os.mkdir(os.path.join(self.root, sub))
+        self._pubkey = generate_pubkey(self._options["key-size"])
+        self._api = FakeIncomingAPI(self._options["api-latency"])
+        self._port = reactor.listenTCP(0, server.Site(self._api),
+                                       interface="127.0.0.1")
+        incoming_api = soledadhelper.SoledadIncomingAPI(
+            "127.0.0.1", self._port.getHost().port, "service:token",
+            batch_size=self._options["batch-size"])
+        self._receiver = BenchmarkMailReceiver(
+            self, FakeUsersCouchDB(self._pubkey,
+                                   self._options["couchdb-latency"]),
+            [[self.root, True]], "MAILER-DAEMON", "Undelivered Mail",
+            incoming_api)
+
+    def cleanup(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _write(self):
+        number = self._written
+        self._written += 1
+        data = self._generator.message(number)
+        name = "%d.benchmark" % (number,)
+        path = os.path.join(self.new, name)
+        tmp_path = os.path.join(self.tmp, name)
+        self._created[path] = time.time()
+        # written in tmp and moved into new once complete, as an MTA
+        # delivering to a Maildir does, so it's never read half written
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+        self.bytes += len(data)
+
+    def _stage_snapshot(self):
+        snapshot = {}
+        for stage in STAGES:
+            child = RECEIVER_STAGE_LATENCY.labels(stage)
+            snapshot[stage] = (sum(child.counts), child.sum)
+        return snapshot
+
+    def start(self):
+        options = self._options
+        self._stages_before = self._stage_snapshot()
+        if options["mode"] == "backlog":
+            for _ in xrange(options["messages"]):
+                self._write()
+            self._started = time.time()
+            self._receiver.startService()
+        else:
+            self._receiver.startService()
+            self._started = time.time()
+            self._write_batch()
+        self._timeout = reactor.callLater(options["timeout"], self._stop,
+                                          True)
+
+    def _write_batch(self):
+        # write the messages due so far, checking a hundred times a second
+        options = self._options
+        due = min(options["messages"],
+                  int((time.time() - self._started) * options["rate"]) + 1)
+        while self._written < due:
+            self._write()
+        if self._written < options["messages"]:
+            reactor.callLater(0.01, self._write_batch)
+
+    def done(self, path):
+        created = self._created.pop(path, None)
+        if created is None:
+            return
+        self.latencies.append(time.time() - created)
+        if len(self.latencies) == self._options["messages"]:
+            self._timeout.cancel()
+            self._stop(False)
+
+    def _stop(self, failed):
+        self.failed = failed
+        self.elapsed = time.time() - self._started
+        self._receiver.stopService()
+        self._port.stopListening()
+        reactor.stop()
+
+    def report(self):
+        options = self._options
+        stages = {}
+        after = self._stage_snapshot()
+        for stage in STAGES:
+            count = after[stage][0] - self._stages_before[stage][0]
+            total = after[stage][1] - self._stages_before[stage][1]
+            stages[stage] = {
+                "count": count,
+                "seconds": total,
+                "mean_ms": total / count * 1000 if count else None,
+            }
+        processed = len(self.latencies)
+        return {
+            "benchmark": "spool",
+            "mode": options["mode"],
+            "messages": options["messages"],
+            "processed": processed,
+            "timed_out": self.failed,
+            "stored": self._api.stored,
+            "users": options["users"],
+            "batch_size": options["batch-size"],
+            "rate": options["rate"] if options["mode"] == "inotify" else None,
+            "couchdb_latency_ms": options["couchdb-latency"] * 1000,
+            "api_latency_ms": options["api-latency"] * 1000,
+            "spool_bytes": self.bytes,
+            "stored_bytes": self._api.bytes,
+            "duration": self.elapsed,
+            "messages_per_second": processed / self.elapsed,
+            "bytes_per_second": self.bytes / self.elapsed,
+            "stages": stages,
+            "peak_rss_kb": resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss,
+            "latency_ms": latency_summary(self.latencies),
+        }
+
+
+def main(argv):
+    options = Options()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError as e:
+        sys.stderr.write("%s\n%s\n" % (options, e))
+        return 1
+    benchmark = Benchmark(options)
+    benchmark.setup()
+    try:
+        reactor.callWhenRunning(benchmark.start)
+        reactor.run()
+    finally:
+        benchmark.cleanup()
+    write_report(benchmark.report(), options["output"])
+    return 0 if not benchmark.failed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
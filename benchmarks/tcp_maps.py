@@ -0,0 +1,279 @@
+# -*- encoding: utf-8 -*-
+# tcp_maps.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Load benchmark for the postfix tcp maps.
+
+Serves one of the map factories on a local port, backed by a fake CouchDB
+with configurable latency, jitter and hit ratio, and drives it with many
+concurrent tcp_table clients. Like postfix's smtpd processes, each client
+keeps its connection open and issues one lookup at a time, and reconnects
+after max-use lookups. The lookup rate and the latency percentiles measured
+by the clients are written as json:
+
+    $ python -m benchmarks.tcp_maps --map alias --clients 100 --duration 10
+"""
+
+import random
+import sys
+import time
+
+from twisted.internet import defer, reactor
+from twisted.internet.protocol import ClientFactory
+from twisted.protocols.basic import LineReceiver
+from twisted.python import usage
+
+from leap.mx.address_filter import AddressFilter
+from leap.mx.alias_resolver import AliasResolverFactory
+from leap.mx.check_recipient_access import CheckRecipientAccessFactory
+from leap.mx.fingerprint_resolver import FingerprintResolverFactory
+
+from benchmarks.common import latency_summary, write_report
+
+
+MAPS = {
+    "alias": AliasResolverFactory,
+    "check_recipient": CheckRecipientAccessFactory,
+    "fingerprint": FingerprintResolverFactory,
+}
+
+UUID = "13d5203bdd09be1e638bdb1d315251cb"
+PUBKEY = "-----BEGIN PGP PUBLIC KEY BLOCK-----"
+EXPIRY = "2099-01-01"
+
+
+class Options(usage.Options):
+
+    optParameters = [
+        ["map", "m", "alias",
+         "Map to benchmark: alias, check_recipient or fingerprint."],
+        ["clients", "c", 50, "Concurrent client connections.", int],
+        ["duration", "d", 10.0, "Seconds to measure for.", float],
+        ["warmup", "w", 1.0, "Seconds to run before measuring.", float],
+        ["latency", "l", 0.002,
+         "Mean latency of the fake CouchDB, in seconds.", float],
+        ["jitter", "j", 0.001,
+         "Maximum deviation from the mean latency, in seconds.", float],
+        ["hit-ratio", None, 0.9,
+         "Fraction of lookups for keys that exist.", float],
+        ["keys", None, 10000, "Number of keys that exist.", int],
+        ["max-use", None, 100,
+         "Lookups before a client reconnects, like postfix's max_use.", int],
+        ["think", None, 0.0,
+         "Seconds a client waits between lookups.", float],
+        ["seed", None, 0, "Seed for the random generator.", int],
+        ["output", "o", None,
+         "File to write the json report to, stdout by default."],
+    ]
+
+    optFlags = [
+        ["address-filter", None,
+         "Put an address filter in front of the alias and check recipient "
+         "maps."],
+    ]
+
+    def postOptions(self):
+        if self["map"] not in MAPS:
+            raise usage.UsageError("Unknown map: %s" % (self["map"],))
+        if not 0 <= self["hit-ratio"] <= 1:
+            raise usage.UsageError("The hit ratio must be between 0 and 1")
+
+
+class FakeCouchDB(object):
+    """
+    Answers the queries of the maps after a random delay.
+    """
+
+    def __init__(self, keys, latency, jitter, rand):
+        self._keys = set(keys)
+        self._latency = latency
+        self._jitter = jitter
+        self._rand = rand
+        self.queries = 0
+
+    def _reply(self, value):
+        self.queries += 1
+        delay = self._latency + self._rand.uniform(-self._jitter,
+                                                   self._jitter)
+        if delay <= 0:
+            return defer.succeed(value)
+        d = defer.Deferred()
+        reactor.callLater(delay, d.callback, value)
+        return d
+
+    def getUuidAndPubkey(self, address):
+        if address in self._keys:
+            return self._reply((UUID, PUBKEY))
+        return self._reply((None, None))
+
+    def getCertExpiry(self, fingerprint):
+        if fingerprint in self._keys:
+            return self._reply(EXPIRY)
+        return self._reply(None)
+
+    def getAllAddresses(self):
+        return defer.succeed((0, list(self._keys)))
+
+
+class TCPTableClient(LineReceiver):
+    """
+    A postfix tcp_table client doing one lookup at a time.
+    """
+
+    delimiter = "\n"
+
+    def connectionMade(self):
+        self.uses = 0
+        self.factory.benchmark.next_lookup(self)
+
+    def connectionLost(self, reason):
+        self.factory.benchmark.client_lost(self)
+
+    def lookup(self, key):
+        self.uses += 1
+        self._sent = time.time()
+        self.sendLine("get " + key)
+
+    def lineReceived(self, line):
+        self.factory.benchmark.reply(self, line, time.time() - self._sent)
+
+
+class Benchmark(object):
+    """
+    Drives a map with concurrent clients and collects the results.
+    """
+
+    def __init__(self, options):
+        self._options = options
+        self._rand = random.Random(options["seed"])
+        self._hits = ["user%d@example.org" % i
+                      for i in xrange(options["keys"])]
+        self._cdb = FakeCouchDB(self._hits, options["latency"],
+                                options["jitter"], self._rand)
+        self._running = False
+        self._measuring = False
+        self._port = None
+        self.latencies = []
+        self.codes = {}
+        self.connections = 0
+
+    def _key(self):
+        if self._rand.random() < self._options["hit-ratio"]:
+            return self._rand.choice(self._hits)
+        return "nobody%d@example.org" % (self._rand.randint(0, 1 << 30),)
+
+    @defer.inlineCallbacks
+    def start(self):
+        options = self._options
+        kwargs = {}
+        if options["address-filter"] and options["map"] != "fingerprint":
+            address_filter = AddressFilter(self._cdb)
+            yield address_filter.rebuild()
+            kwargs["address_filter"] = address_filter
+        server_factory = MAPS[options["map"]](self._cdb, **kwargs)
+        self._port = reactor.listenTCP(0, server_factory,
+                                       interface="127.0.0.1")
+        self._client_factory = ClientFactory()
+        self._client_factory.protocol = TCPTableClient
+        self._client_factory.benchmark = self
+
+        self._running = True
+        for _ in xrange(options["clients"]):
+            self._connect()
+        reactor.callLater(options["warmup"], self._start_measuring)
+
+    def _connect(self):
+        self.connections += 1
+        reactor.connectTCP("127.0.0.1", self._port.getHost().port,
+                           self._client_factory)
+
+    def _start_measuring(self):
+        self._measuring = True
+        self._started = time.time()
+        self._queries_before = self._cdb.queries
+        reactor.callLater(self._options["duration"], self._stop)
+
+    def _stop(self):
+        self._measuring = False
+        self._running = False
+        self.elapsed = time.time() - self._started
+        self.couchdb_queries = self._cdb.queries - self._queries_before
+        self._port.stopListening()
+        reactor.stop()
+
+    def next_lookup(self, client):
+        if not self._running:
+            client.transport.loseConnection()
+        elif client.uses >= self._options["max-use"]:
+            client.transport.loseConnection()
+        elif self._options["think"] > 0:
+            reactor.callLater(self._options["think"], self._lookup, client)
+        else:
+            self._lookup(client)
+
+    def _lookup(self, client):
+        if self._running:
+            client.lookup(self._key())
+
+    def reply(self, client, line, latency):
+        if self._measuring:
+            self.latencies.append(latency)
+            code = line[:3]
+            self.codes[code] = self.codes.get(code, 0) + 1
+        self.next_lookup(client)
+
+    def client_lost(self, client):
+        if self._running:
+            self._connect()
+
+    def report(self):
+        options = self._options
+        return {
+            "benchmark": "tcp_maps",
+            "map": options["map"],
+            "clients": options["clients"],
+            "address_filter": bool(options["address-filter"]),
+            "couchdb_latency_ms": options["latency"] * 1000,
+            "couchdb_jitter_ms": options["jitter"] * 1000,
+            "hit_ratio": options["hit-ratio"],
+            "max_use": options["max-use"],
+            "think_ms": options["think"] * 1000,
+            "duration": self.elapsed,
+            "lookups": len(self.latencies),
+            "qps": len(self.latencies) / self.elapsed,
+            "couchdb_queries": self.couchdb_queries,
+            "connections": self.connections,
+            "codes": self.codes,
+            "latency_ms": latency_summary(self.latencies),
+        }
+
+
+def main(argv):
+    options = Options()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError as e:
+        sys.stderr.write("%s\n%s\n" % (options, e))
+        return 1
+    benchmark = Benchmark(options)
+    reactor.callWhenRunning(benchmark.start)
+    reactor.run()
+    write_report(benchmark.report(), options["output"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# address_filter.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-memory filter of the valid recipient addresses.
+
+Dictionary attacks and backscatter spam produce lots of alias and recipient
+access queries for addresses that don't exist, and each one of them would
+otherwise become a CouchDB view query. The AddressFilter service keeps a Bloom
+filter with every address in the by_address view, so the tcp maps can answer
+a definite miss right away and only go to CouchDB on a possible hit.
+
+The filter is loaded on service start, retried with backoff until it loads,
+kept current by polling the CouchDB changes feed and rebuilt from scratch
+every once in a while, so addresses that were removed stop producing false
+positives. Bloom filters have no false
+negatives, so while the filter is loading or if it couldn't be synced for a
+while every address is reported as possibly valid and lookups fall back to
+CouchDB.
+"""
+
+import hashlib
+import math
+import struct
+import time
+
+from twisted.application.service import Service
+from twisted.internet import defer, reactor, task
+from twisted.python import log
+
+from leap.mx.retry import Backoff
+
+
+class BloomFilter(object):
+    """
+    A fixed size Bloom filter for strings.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        Initialize the filter.
+
+        :param capacity: The number of elements the filter is sized for.
+        :type capacity: int
+        :param error_rate: The desired false positive rate when the filter
+                           holds capacity elements.
+        :type error_rate: float
+        """
+        if capacity <= 0:
+            raise ValueError("Capacity must be positive")
+        if not 0 < error_rate < 1:
+            raise ValueError("Error rate must be between 0 and 1")
+        self.capacity = capacity
+        self.error_rate = error_rate
+        nbits = int(math.ceil(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self._nbits = max(nbits, 8)
+        self._nhashes = max(
+            1, int(round(float(self._nbits) / capacity * math.log(2))))
+        self._bits = bytearray((self._nbits + 7) // 8)
+        self._count = 0
+
+    def _indexes(self, key):
+        """
+        Return the bit indexes for key, using double hashing over a single
+        digest.
+
+        :param key: The element.
+        :type key: str or unicode
+        """
+        if isinstance(key, unicode):
+            key = key.encode("utf8")
+        h1, h2 = struct.unpack(">QQ", hashlib.md5(key).digest())
+        nbits = self._nbits
+        return [(h1 + i * h2) % nbits for i in xrange(self._nhashes)]
+
+    def add(self, key):
+        """
+        Add key to the filter.
+
+        :param key: The element to add.
+        :type key: str or unicode
+        """
+        bits = self._bits
+        for i in self._indexes(key):
+            bits[i >> 3] |= 1 << (i & 7)
+        self._count += 1
+
+    def __contains__(self, key):
+        bits = self._bits
+        for i in self._indexes(key):
+            if not bits[i >> 3] & (1 << (i & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        """
+        Return the number of elements added to the filter.
+        """
+        return self._count
+
+
+class AddressFilter(Service):
+    """
+    Service that keeps a Bloom filter of the valid addresses up to date.
+    """
+
+    """
+    Seconds between polls of the CouchDB changes feed.
+    """
+    POLL_INTERVAL = 10
+
+    """
+    Seconds between full rebuilds of the filter, which drop deleted addresses
+    and resize the filter to the current number of addresses.
+    """
+    REBUILD_INTERVAL = 60 * 60 * 6  # 6 hours
+
+    """
+    If the filter couldn't be synced for this long it is not trusted anymore
+    and every lookup goes to CouchDB.
+    """
+    MAX_STALENESS = 60 * 5  # 5 minutes
+
+    """
+    Delays between attempts to load the filter until it loads for the first
+    time, the last one is kept for the attempts after them.
+    """
+    LOAD_BACKOFF = Backoff(retries=5, initial=POLL_INTERVAL, maximum=60 * 5)
+
+    def __init__(self, couchdb, capacity=100000, error_rate=0.001,
+                 clock=reactor):
+        """
+        Initialize the service.
+
+        :param couchdb: A CouchDB client.
+        :type couchdb: leap.mx.couchdbhelper.ConnectedCouchDB
+        :param capacity: Minimum number of addresses the filter is sized for.
+        :type capacity: int
+        :param error_rate: Desired false positive rate.
+        :type error_rate: float
+        :param clock: Provider of the current time.
+        :type clock: twisted.internet.interfaces.IReactorTime
+        """
+        self._cdb = couchdb
+        self._capacity = capacity
+        self._error_rate = error_rate
+        self._filter = None
+        self._update_seq = None
+        self._last_sync = None
+        self._rebuilding = False
+        self._polling = False
+        self._clock = clock
+        self._load_failures = 0
+        self._load_call = None
+        self.hits = 0
+        self.misses = 0
+
+    def startService(self):
+        """
+        Load the filter and start following the changes feed.
+        """
+        Service.startService(self)
+        self._rebuild_call = task.LoopingCall(self.rebuild)
+        self._rebuild_call.clock = self._clock
+        self._rebuild_call.start(self.REBUILD_INTERVAL, now=True)
+        self._poll_call = task.LoopingCall(self.poll_changes)
+        self._poll_call.clock = self._clock
+        self._poll_call.start(self.POLL_INTERVAL, now=False)
+
+    def stopService(self):
+        """
+        Stop syncing the filter.
+        """
+        Service.stopService(self)
+        self._poll_call.stop()
+        self._rebuild_call.stop()
+        if self._load_call is not None and self._load_call.active():
+            self._load_call.cancel()
+
+    @property
+    def ready(self):
+        """
+        Whether the filter is loaded and was synced recently enough to be
+        trusted.
+
+        :rtype: bool
+        """
+        if self._filter is None or self._last_sync is None:
+            return False
+        return time.time() - self._last_sync < self.MAX_STALENESS
+
+    def might_contain(self, address):
+        """
+        Return whether address may be a valid address.
+
+        A False return value means the address is definitely not in the
+        database.
+
+        :param address: The address being looked up.
+        :type address: str
+
+        :rtype: bool
+        """
+        if not self.ready:
+            return True
+        if address in self._filter:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    @defer.inlineCallbacks
+    def rebuild(self):
+        """
+        Build a new filter from the whole by_address view and swap it in.
+        """
+        if self._rebuilding:
+            defer.returnValue(None)
+        self._rebuilding = True
+        try:
+            update_seq, addresses = yield self._cdb.getAllAddresses()
+            capacity = max(self._capacity, 2 * len(addresses))
+            new_filter = BloomFilter(capacity, self._error_rate)
+            for address in addresses:
+                new_filter.add(address)
+            self._filter = new_filter
+            self._update_seq = update_seq
+            self._last_sync = time.time()
+            log.msg("Address filter loaded with %d addresses"
+                    % (len(addresses),))
+        except Exception as e:
+            log.msg("Failed loading the address filter: %r" % (e,))
+            if self._filter is None:
+                self._retry_load()
+        finally:
+            self._rebuilding = False
+
+    def _retry_load(self):
+        """
+        Try to load the filter again soon, instead of waiting for the next
+        rebuild, as it can't be used at all until it loads once.
+        """
+        if not self.running:
+            return
+        delays = self.LOAD_BACKOFF.delays()
+        delay = delays[min(self._load_failures, len(delays) - 1)]
+        self._load_failures += 1
+        log.msg("Loading the address filter again in %.1fs" % (delay,))
+        self._load_call = self._clock.callLater(delay, self.rebuild)
+
+    @defer.inlineCallbacks
+    def poll_changes(self):
+        """
+        Add the addresses of documents changed since the last sync.
+        """
+        if self._polling or self._rebuilding or self._filter is None:
+            defer.returnValue(None)
+        self._polling = True
+        try:
+            since = self._update_seq
+            last_seq, docs = yield self._cdb.getChanges(since)
+            # a rebuild may have swapped the filter in the meantime, the
+            # changes are added to whatever filter is current
+            for doc in docs:
+                address = doc.get("address")
+                if address:
+                    self._filter.add(address)
+            if self._update_seq == since:
+                self._update_seq = last_seq
+                self._last_sync = time.time()
+        except Exception as e:
+            log.msg("Failed polling changes for the address filter: %r"
+                    % (e,))
+        finally:
+            self._polling = False
@@ -28,20 +28,19 @@ address early and the mail server will delivery the message to
 Test this with postmap -v -q "foo" tcp:localhost:4242
 
 TODO:
-    o Look into using twisted.protocols.postfix.policies classes for
-      controlling concurrent connections and throttling resource consumption.
     o We should probably use twisted.mail.alias somehow.
 """
 
 
 from twisted.protocols import postfix
 
+from leap.mx.tcp_map import LEAPPostfixTCPMapServer
 from leap.mx.tcp_map import LEAPPostfixTCPMapServerFactory
 from leap.mx.tcp_map import TCP_MAP_CODE_SUCCESS
 from leap.mx.tcp_map import TCP_MAP_CODE_PERMANENT_FAILURE
 
 
-class LEAPPostfixTCPMapAliasServer(postfix.PostfixTCPMapServer):
+class LEAPPostfixTCPMapAliasServer(LEAPPostfixTCPMapServer):
     """
     A postfix tcp map alias resolver server.
     """
@@ -79,3 +78,7 @@ class AliasResolverFactory(LEAPPostfixTCPMapServerFactory):
     @property
     def _query_message(self):
         return "virtual alias map"
+
+    @property
+    def _map_name(self):
+        return "alias"
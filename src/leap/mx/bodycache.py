@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# bodycache.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Cache of the bodies of messages delivered to several recipients.
+
+A message sent to several users is dropped in the spool once for each of
+them, by copies that only differ in the headers added on delivery, like
+Delivered-To and X-Original-To. Each copy is still encrypted on its own:
+OpenPGP encrypts the whole plaintext in a single chain, so two plaintexts
+that differ anywhere share no ciphertext. What the copies share is the
+work on their body, which is most of the message. The BodyCache keeps the
+JSON encoded bodies of recent messages as SharedChunks, which pgpy deflates
+once for all the messages they are part of.
+"""
+
+import hashlib
+import json
+
+from collections import OrderedDict
+
+from twisted.internet import reactor
+
+from leap.mx.metrics import BODY_CACHE_BYTES
+from leap.mx.metrics import BODY_CACHE_LOOKUPS
+from leap.mx.vendor.pgpy import PGPMessage
+from leap.mx.vendor.pgpy.types import SharedChunk
+
+
+"""
+The JSON document of an incoming message is the content of the message,
+between these.
+"""
+DOCUMENT_START = '{"content": '
+DOCUMENT_END = ', "incoming": true}'
+
+
+class BodyCache(object):
+    """
+    A bounded LRU cache of the JSON encoded bodies of recent messages, whose
+    entries expire after a while.
+    """
+
+    def __init__(self, min_size=16384, max_bytes=32 * 1024 * 1024, ttl=300,
+                 clock=reactor):
+        """
+        :param min_size: Size in bytes of the smallest bodies cached.
+        :type min_size: int
+        :param max_bytes: Maximum size in bytes of the bodies kept, the
+                          least recently used are evicted first. 0
+                          disables the cache.
+        :type max_bytes: int
+        :param ttl: Seconds a body is kept since it was last used.
+        :type ttl: float
+        :param clock: Provider of the current time.
+        :type clock: twisted.internet.interfaces.IReactorTime
+        """
+        self._min_size = min_size
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._clock = clock
+        self._bodies = OrderedDict()
+        self._size = 0
+        self._lookups = dict(
+            (result, BODY_CACHE_LOOKUPS.labels(result))
+            for result in ("hit", "miss"))
+        BODY_CACHE_BYTES.set_function(lambda: self._size)
+
+    def __len__(self):
+        return len(self._bodies)
+
+    def document(self, message):
+        """
+        Return the JSON document of an incoming message in chunks, with its
+        body shared with the other messages with the same body.
+
+        :param message: The incoming message.
+        :type message: str
+
+        :return: The chunks of the document and its literal data format,
+                 or None if the message is too small to be shared.
+        :rtype: tuple of (list, str) or None
+        """
+        if self._max_bytes == 0 or not isinstance(message, str):
+            return None
+        headers, separator, body = message.partition("\n\n")
+        if not separator or len(body) < self._min_size:
+            return None
+
+        start = DOCUMENT_START + json.dumps(headers + separator,
+                                            ensure_ascii=False)[:-1]
+        shared, ascii = self._body(body)
+        # only strings without unicode can be concatenated as they are
+        if shared is None or not isinstance(start, str):
+            return None
+        # the same format PGPMessage.new gives the whole document
+        text = ascii and PGPMessage.is_ascii(start)
+        return [start, shared], "t" if text else "b"
+
+    def _body(self, body):
+        """
+        Return the shared chunk ending the document of a message with this
+        body, and whether it's ascii text, or None if the body isn't encoded
+        to a str.
+        """
+        digest = hashlib.sha256(body).digest()
+        now = self._clock.seconds()
+        entry = self._bodies.pop(digest, None)
+        if entry is not None and now - entry[2] < self._ttl:
+            self._lookups["hit"].inc()
+            # move it to the end, as the most recently used
+            self._bodies[digest] = (entry[0], entry[1], now)
+            return entry[0], entry[1]
+        if entry is not None:
+            self._size -= len(entry[0])
+
+        self._lookups["miss"].inc()
+        encoded = json.dumps(body, ensure_ascii=False)[1:]
+        if not isinstance(encoded, str):
+            return None, False
+        shared = SharedChunk(encoded + DOCUMENT_END)
+        ascii = PGPMessage.is_ascii(shared)
+        self._bodies[digest] = (shared, ascii, now)
+        self._size += len(shared)
+        while self._size > self._max_bytes:
+            _, (evicted, _, _) = self._bodies.popitem(last=False)
+            self._size -= len(evicted)
+        return shared, ascii
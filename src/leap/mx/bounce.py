@@ -31,15 +31,27 @@ This is built from the following RFCs:
 
   * An Extensible Message Format for Delivery Status Notifications
     https://tools.ietf.org/html/rfc3464
+
+Bounces can go through a BounceQueue, which coalesces the failures of
+messages from the same sender for the same reason into one report and rate
+limits the reports sent to each sender and overall. It can also keep the
+bounces on disk, so that sending them is decoupled from the delivery of
+mail.
 """
 
 
+import json
+import os
+import random
 import re
 import socket
+import sys
+import uuid
 
 from StringIO import StringIO
 from textwrap import wrap
 
+from email import message_from_string
 from email.errors import MessageError
 from email.message import Message
 from email.utils import formatdate
@@ -50,16 +62,28 @@ from email.mime.text import MIMEText
 from email.generator import Generator
 from email.generator import NL
 
+from twisted.application.service import Service
 from twisted.internet import defer
 from twisted.internet import protocol
 from twisted.internet import reactor
+from twisted.internet import threads
 from twisted.internet.error import ProcessDone
 from twisted.python import log
 
+from leap.mx.metrics import BOUNCE_QUEUE_MESSAGES
+from leap.mx.metrics import BOUNCE_TRANSPORT_MESSAGES
+from leap.mx.retry import Backoff, retry
+from leap.mx.throttle import TokenBucket
+
 
 EMAIL_ADDRESS_REGEXP = re.compile("[^@]+@[^@]+\.[^@]+")
 HOSTNAME = socket.gethostbyaddr(socket.gethostname())[0]
 
+"""
+How a BounceQueue retries a report before queueing it again.
+"""
+BOUNCE_BACKOFF = Backoff(retries=3, initial=10, maximum=60)
+
 
 def _valid_address(address):
     """
@@ -74,7 +98,8 @@ def _valid_address(address):
     return bool(EMAIL_ADDRESS_REGEXP.match(address))
 
 
-def bounce_message(bounce_from, bounce_subject, orig_msg, reason):
+def bounce_message(bounce_from, bounce_subject, orig_msg, reason,
+                   transport=None, headers_only=False):
     """
     Bounce a message.
 
@@ -86,10 +111,17 @@ def bounce_message(bounce_from, bounce_subject, orig_msg, reason):
     :type orig_msg: email.message.Message
     :param reason: The reason for bouncing the message.
     :type reason: str
-
-    :return: A deferred that will fire with the output of the sendmail process
-             if it was successful or with a failure containing the reason for
-             the end of the process if it failed.
+    :param transport: How to hand the bounce to the MTA, sendmail by
+                      default.
+    :type transport: SendmailTransport or
+                     leap.mx.bounce_transport.SMTPBounceTransport
+    :param headers_only: Whether to return only the headers of the original
+                         message, which is all that orig_msg needs to hold
+                         then.
+    :type headers_only: bool
+
+    :return: A deferred that will fire when the transport accepted the bounce
+             or with a failure containing the reason it didn't.
     :rtype: Deferred
     """
     orig_rpath = orig_msg.get("Return-Path")
@@ -102,9 +134,11 @@ def bounce_message(bounce_from, bounce_subject, orig_msg, reason):
             % orig_rpath)
         return
 
-    msg = _build_bounce_message(
-        bounce_from, bounce_subject, orig_msg, reason)
-    return _async_check_output(["/usr/sbin/sendmail", "-t"], msg.as_string())
+    data = bounce_template(bounce_from, bounce_subject, reason).render(
+        orig_msg, headers_only)
+    if transport is None:
+        transport = SENDMAIL
+    return transport.send(addr, data)
 
 
 def _check_valid_return_path(return_path):
@@ -148,64 +182,101 @@ class DeliveryStatusNotificationMessage(MIMEBase):
     A delivery status message, as per RFC 3464.
     """
 
-    def __init__(self, orig_msg):
+    def __init__(self, orig_msg, more_msgs=()):
         """
         Initialize the DSN.
         """
         MIMEBase.__init__(self, "message", "delivery-status")
         self.__delitem__("MIME-Version")
-        self._build_dsn(orig_msg)
+        self._build_dsn(orig_msg, more_msgs)
 
-    def _build_dsn(self, orig_msg):
+    def _build_dsn(self, orig_msg, more_msgs=()):
         """
         Build an RFC 3464 compliant delivery status message.
 
         :param orig_msg: The original bouncing message.
         :type orig_msg: email.message.Message
+        :param more_msgs: Other bouncing messages reported together with
+                          orig_msg.
+        :type more_msgs: list of email.message.Message
         """
-        content = []
+        # return a "message/delivery-status" message
+        msg = Message()
+        msg.set_payload(_delivery_status(orig_msg, more_msgs))
+        self.attach(msg)
+
+
+def _delivery_status(orig_msg, more_msgs=()):
+    """
+    Return the fields of an RFC 3464 delivery status notification.
+
+    :param orig_msg: The original bouncing message.
+    :type orig_msg: email.message.Message
+    :param more_msgs: Other bouncing messages reported together with
+                      orig_msg, each distinct recipient gets its own
+                      per-recipient fields.
+    :type more_msgs: list of email.message.Message
+
+    :return: The per-message fields and the blocks of per-recipient fields.
+    :rtype: str
+    """
+    content = []
 
-        # Per-Message DSN fields
-        # ======================
+    # Per-Message DSN fields
+    # ======================
 
-        # Original-Envelope-Id (optional)
-        envelope_id = orig_msg.get("Envelope-Id")
-        if envelope_id:
-            content.append("Original-Envelope-Id: %s" % envelope_id)
+    # Original-Envelope-Id (optional)
+    envelope_id = orig_msg.get("Envelope-Id")
+    if envelope_id:
+        content.append("Original-Envelope-Id: %s" % envelope_id)
 
-        # Reporting-MTA (required)
-        content.append("Reporting-MTA: dns; %s" % HOSTNAME)
+    # Reporting-MTA (required)
+    content.append("Reporting-MTA: dns; %s" % HOSTNAME)
 
-        # XXX add Arrival-Date DSN field? (optional).
+    # XXX add Arrival-Date DSN field? (optional).
 
+    seen = set()
+    for msg in [orig_msg] + list(more_msgs):
+        recipient = (msg.get("X-Original-To"), msg.get("Delivered-To"))
+        if recipient in seen:
+            continue
+        seen.add(recipient)
         content.append("")
+        _add_recipient_fields(content, msg)
 
-        # Per-Recipient DSN fields
-        # ========================
+    return "\n".join(content)
 
-        # Original-Recipient (optional)
-        orig_to = orig_msg.get("X-Original-To")  # added by postfix
-        _, orig_addr = parseaddr(orig_to)
-        if orig_addr:
-            content.append("Original-Recipient: rfc822; %s" % orig_addr)
 
-        # Final-Recipient (required)
-        delivered_to = orig_msg.get("Delivered-To")
-        content.append("Final-Recipient: rfc822; %s" % delivered_to)
+def _add_recipient_fields(content, orig_msg):
+    """
+    Add the per-recipient fields for the recipient of a message.
 
-        # Action (required)
-        content.append("Action: failed")
+    :param content: The lines of the DSN.
+    :type content: list of str
+    :param orig_msg: The original bouncing message.
+    :type orig_msg: email.message.Message
+    """
+    # Per-Recipient DSN fields
+    # ========================
 
-        # Status (required)
-        content.append("Status: 5.0.0")  # permanent failure
+    # Original-Recipient (optional)
+    orig_to = orig_msg.get("X-Original-To")  # added by postfix
+    _, orig_addr = parseaddr(orig_to)
+    if orig_addr:
+        content.append("Original-Recipient: rfc822; %s" % orig_addr)
 
-        # XXX add other optional fields? (Remote-MTA, Diagnostic-Code,
-        #     Last-Attempt-Date, Final-Log-ID, Will-Retry-Until)
+    # Final-Recipient (required)
+    delivered_to = orig_msg.get("Delivered-To")
+    content.append("Final-Recipient: rfc822; %s" % delivered_to)
 
-        # return a "message/delivery-status" message
-        msg = Message()
-        msg.set_payload("\n".join(content))
-        self.attach(msg)
+    # Action (required)
+    content.append("Action: failed")
+
+    # Status (required)
+    content.append("Status: 5.0.0")  # permanent failure
+
+    # XXX add other optional fields? (Remote-MTA, Diagnostic-Code,
+    #     Last-Attempt-Date, Final-Log-ID, Will-Retry-Until)
 
 
 class RFC822Headers(MIMEText):
@@ -244,13 +315,38 @@ delete your own text from the attached returned message.
 """.strip()
 
 
+AGGREGATE_BOUNCE_TEMPLATE = """
+This is the mail system at {0}.
+
+I'm sorry to have to inform you that {1} of your messages could not
+be delivered to one or more recipients. The headers of the first of
+them are attached below.
+
+For further assistance, please send mail to postmaster.
+
+If you do so, please include this problem report.
+
+                   The mail system
+
+{2}
+""".strip()
+
+
+def _headers(orig_msg):
+    """
+    Return the headers of a message, as they are returned in bounces.
+    """
+    return "".join("%s: %s\n" % item for item in orig_msg.items())
+
+
 class InvalidReturnPathError(MessageError):
     """
     Exception raised when the return path is invalid.
     """
 
 
-def _build_bounce_message(bounce_from, bounce_subject, orig_msg, reason):
+def _build_bounce_message(bounce_from, bounce_subject, orig_msg, reason,
+                          headers_only=False):
     """
     Build a bounce message.
 
@@ -262,6 +358,9 @@ def _build_bounce_message(bounce_from, bounce_subject, orig_msg, reason):
     :type orig_msg: email.message.Message
     :param reason: The reason for the bounce.
     :type reason: str
+    :param headers_only: Whether to return only the headers of the original
+                         message.
+    :type headers_only: bool
 
     :return: The bounce message.
     :rtype: MIMEMultipartReport
@@ -284,10 +383,7 @@ def _build_bounce_message(bounce_from, bounce_subject, orig_msg, reason):
 
     # create and attach first required part
     orig_to = orig_msg.get("X-Original-To")  # added by postfix
-    wrapped_reason = wrap(("<%s>: " % orig_to) + reason, 74)
-    for i in xrange(1, len(wrapped_reason)):
-        wrapped_reason[i] = "    " + wrapped_reason[i]
-    wrapped_reason = "\n".join(wrapped_reason)
+    wrapped_reason = _wrap_reason(orig_to, reason)
     text = BOUNCE_TEMPLATE.format(HOSTNAME, wrapped_reason)
     msg.attach(MIMEText(text))
 
@@ -315,11 +411,675 @@ def _build_bounce_message(bounce_from, bounce_subject, orig_msg, reason):
 #        for k in orig_msg.keys():
 #            headers.append("%s: %s" % (k, orig_msg[k]))
 #        orig_msg = RFC822Headers("\n".join(headers))
-    msg.attach(orig_msg)
+    if headers_only:
+        msg.attach(RFC822Headers(_headers(orig_msg)))
+    else:
+        msg.attach(orig_msg)
 
     return msg
 
 
+def _wrap_reason(orig_to, reason):
+    """
+    Format the reason a recipient failed for the human readable part of a
+    bounce.
+    """
+    wrapped_reason = wrap(("<%s>: " % orig_to) + reason, 74)
+    for i in xrange(1, len(wrapped_reason)):
+        wrapped_reason[i] = "    " + wrapped_reason[i]
+    return "\n".join(wrapped_reason)
+
+
+def _unique(values):
+    """
+    Return the distinct values, in the order they first appear.
+    """
+    seen = set()
+    unique = []
+    for value in values:
+        if value not in seen:
+            seen.add(value)
+            unique.append(value)
+    return unique
+
+
+def _build_aggregate_bounce_message(bounce_from, bounce_subject, orig_msgs,
+                                    reason, count=None, headers_only=False):
+    """
+    Build a single bounce message for several messages from the same sender
+    that failed for the same reason.
+
+    The report has per-recipient fields for each distinct recipient, and
+    only the headers of the first message are returned.
+
+    :param bounce_from: The sender address of the bounce message.
+    :type bounce_from: str
+    :param bounce_subject: The subject of the bounce message.
+    :type bounce_subject: str
+    :param orig_msgs: The original bouncing messages.
+    :type orig_msgs: list of email.message.Message
+    :param reason: The reason for the bounce.
+    :type reason: str
+    :param count: How many messages bounced, if more than orig_msgs.
+    :type count: int
+    :param headers_only: Whether to return only the headers of the original
+                         message when there is a single one.
+    :type headers_only: bool
+
+    :return: The bounce message.
+    :rtype: MIMEMultipartReport
+
+    :raise InvalidReturnPathError: Raised when the "Return-Path" header of the
+                                   original messages is invalid for creating a
+                                   bounce message.
+    """
+    count = max(count or 0, len(orig_msgs))
+    orig_msg = orig_msgs[0]
+    if count == 1:
+        return _build_bounce_message(
+            bounce_from, bounce_subject, orig_msg, reason, headers_only)
+
+    # abort creation if "Return-Path" header is invalid
+    orig_rpath = orig_msg.get("Return-Path")
+    if not _check_valid_return_path(orig_rpath):
+        raise InvalidReturnPathError
+
+    msg = MIMEMultipartReport()
+    msg['From'] = bounce_from
+    msg['To'] = orig_rpath
+    msg['Date'] = formatdate(localtime=True)
+    msg['Subject'] = bounce_subject
+    msg['Return-Path'] = "<>"  # prevent bounce message loop, see RFC 3834
+
+    # a line for each recipient in the human readable part
+    reasons = [_wrap_reason(orig_to, reason) for orig_to in
+               _unique(m.get("X-Original-To") for m in orig_msgs)]
+    text = AGGREGATE_BOUNCE_TEMPLATE.format(
+        HOSTNAME, count, "\n".join(reasons))
+    msg.attach(MIMEText(text))
+
+    msg.attach(DeliveryStatusNotificationMessage(orig_msg, orig_msgs[1:]))
+
+    # return only the headers of the first message
+    msg.attach(RFC822Headers(_headers(orig_msg)))
+
+    return msg
+
+
+def _make_boundary(text):
+    """
+    Return a MIME boundary that doesn't appear in text, like the ones the
+    email generator makes.
+    """
+    while True:
+        boundary = "=" * 15 + "%d==" % random.randrange(sys.maxint)
+        if "--" + boundary not in text:
+            return boundary
+
+
+def _flatten(msg):
+    """
+    Serialize a message the way it's serialized as part of a bounce.
+    """
+    fp = StringIO()
+    DSNGenerator(fp).flatten(msg, unixfrom=False)
+    return fp.getvalue()
+
+
+class BounceTemplate(object):
+    """
+    A bounce message for one reason, rendered once with placeholders for the
+    fields that change with every bounced message.
+
+    The result is the same as serializing the message built by
+    _build_bounce_message(), but bouncing a message only takes filling in
+    its addresses, the date, its delivery status fields and the returned
+    message, instead of building and serializing a tree of MIME objects.
+    """
+
+    """
+    Maximum number of wrapped reasons kept, one for each original recipient.
+    """
+    MAX_WRAPPED_REASONS = 1024
+
+    def __init__(self, bounce_from, bounce_subject, reason):
+        """
+        :param bounce_from: The sender address of the bounce messages.
+        :type bounce_from: str
+        :param bounce_subject: The subject of the bounce messages.
+        :type bounce_subject: str
+        :param reason: The reason for the bounces.
+        :type reason: str
+        """
+        self._reason = reason
+        self._wrapped_reasons = {}
+
+        # let the MIME classes render the fixed parts, with markers where
+        # the per-message fields go
+        markers = dict((name, "@@%s@@" % name.upper())
+                       for name in ("boundary", "to", "date", "reason",
+                                    "dsn"))
+        msg = MIMEMultipartReport(boundary=markers["boundary"])
+        msg['From'] = bounce_from
+        msg['To'] = markers["to"]
+        msg['Date'] = markers["date"]
+        msg['Subject'] = bounce_subject
+        msg['Return-Path'] = "<>"  # prevent bounce message loop
+        msg.attach(MIMEText(
+            BOUNCE_TEMPLATE.format(HOSTNAME, markers["reason"])))
+        dsn = MIMEBase("message", "delivery-status")
+        del dsn["MIME-Version"]
+        status = Message()
+        status.set_payload(markers["dsn"])
+        dsn.attach(status)
+        msg.attach(dsn)
+        text = msg.as_string().replace("%", "%%")
+        for name, marker in markers.iteritems():
+            text = text.replace(marker, "%%(%s)s" % name)
+
+        # the returned message is the last part
+        self._prefix = text[:text.rindex("\n--%(boundary)s--")]
+        self._headers_part = _flatten(RFC822Headers(""))
+
+    def _wrap_reason(self, orig_to):
+        wrapped = self._wrapped_reasons.get(orig_to)
+        if wrapped is None:
+            if len(self._wrapped_reasons) >= self.MAX_WRAPPED_REASONS:
+                self._wrapped_reasons.clear()
+            wrapped = _wrap_reason(orig_to, self._reason)
+            self._wrapped_reasons[orig_to] = wrapped
+        return wrapped
+
+    def render(self, orig_msg, headers_only=False):
+        """
+        Render the bounce of a message.
+
+        :param orig_msg: The original bouncing message.
+        :type orig_msg: email.message.Message
+        :param headers_only: Whether to return only the headers of the
+                             original message.
+        :type headers_only: bool
+
+        :return: The bounce message.
+        :rtype: str
+
+        :raise InvalidReturnPathError: Raised when the "Return-Path" header of
+                                       the original message is invalid for
+                                       creating a bounce message.
+        """
+        orig_rpath = orig_msg.get("Return-Path")
+        if not _check_valid_return_path(orig_rpath):
+            raise InvalidReturnPathError
+
+        if headers_only:
+            returned = self._headers_part + _headers(orig_msg)
+        else:
+            returned = _flatten(orig_msg)
+        boundary = _make_boundary(returned)
+        prefix = self._prefix % {
+            "boundary": boundary,
+            "to": orig_rpath,
+            "date": formatdate(localtime=True),
+            "reason": self._wrap_reason(orig_msg.get("X-Original-To")),
+            "dsn": _delivery_status(orig_msg),
+        }
+        return "%s\n--%s\n%s\n--%s--\n" % (
+            prefix, boundary, returned, boundary)
+
+
+_TEMPLATES = {}
+
+
+def bounce_template(bounce_from, bounce_subject, reason):
+    """
+    Return the template of the bounces for a reason, rendering it the first
+    time.
+
+    :param bounce_from: The sender address of the bounce messages.
+    :type bounce_from: str
+    :param bounce_subject: The subject of the bounce messages.
+    :type bounce_subject: str
+    :param reason: The reason for the bounces.
+    :type reason: str
+
+    :rtype: BounceTemplate
+    """
+    key = (bounce_from, bounce_subject, reason)
+    template = _TEMPLATES.get(key)
+    if template is None:
+        template = _TEMPLATES[key] = BounceTemplate(
+            bounce_from, bounce_subject, reason)
+    return template
+
+
+class _BounceGroup(object):
+    """
+    The bounces to one sender for one reason waiting to be reported.
+    """
+
+    def __init__(self, created):
+        self.created = created
+        self.msgs = []
+        self.records = []
+        self.count = 0
+        self.headers_only = False
+        self.call = None
+
+    def add(self, orig_msg, max_messages, record=None, headers_only=False):
+        self.count += 1
+        self.headers_only = self.headers_only or headers_only
+        if len(self.msgs) < max_messages:
+            self.msgs.append(orig_msg)
+        if record is not None:
+            self.records.append(record)
+
+    def merge(self, other, max_messages):
+        self.created = min(self.created, other.created)
+        self.count += other.count
+        self.headers_only = self.headers_only or other.headers_only
+        self.msgs.extend(other.msgs[:max_messages - len(self.msgs)])
+        self.records.extend(other.records)
+
+
+class BounceQueue(Service):
+    """
+    Coalesces, rate limits and sends bounces.
+
+    The first bounce to a return path for a given reason opens a group, and
+    bounces to the same return path for the same reason that arrive within
+    window seconds join it. When the window ends the group is sent as a
+    single report, if the rate limits allow it. Otherwise the group is
+    delayed for another window, while it keeps gathering bounces, and it's
+    dropped once it has waited for more than max_delay seconds.
+
+    Reports are handed to the transport by at most concurrency senders, and
+    retried following backoff. A report that still fails joins the queue
+    again, to be retried after another window.
+
+    If a directory is given, every bounce is first written to it as a
+    record holding the headers of the original message and the reason, so
+    the original can be removed from the spool right away. Records are
+    removed once their report is sent or dropped, and the ones left by a
+    previous run are queued again when the service starts. Bounces sent
+    from records only return the headers of the original message. Records
+    are written and synced in a thread, so a burst of bounces doesn't block
+    the reactor.
+    """
+
+    """
+    Suffix of the bounce records in the queue directory.
+    """
+    RECORD_SUFFIX = ".bounce"
+
+    def __init__(self, bounce_from, bounce_subject, transport=None,
+                 window=60, max_messages=100, max_delay=3600,
+                 sender_rate=None, sender_burst=None, rate=None, burst=None,
+                 directory=None, concurrency=2, backoff=BOUNCE_BACKOFF,
+                 clock=reactor):
+        """
+        :param bounce_from: The sender of the bounce messages.
+        :type bounce_from: str
+        :param bounce_subject: The subject of the bounce messages.
+        :type bounce_subject: str
+        :param transport: How to hand the bounces to the MTA, sendmail by
+                          default.
+        :type transport: SendmailTransport or
+                         leap.mx.bounce_transport.SMTPBounceTransport
+        :param window: Seconds a group gathers bounces before it's sent.
+        :type window: float
+        :param max_messages: Maximum number of messages described in a
+                             report, the rest are only counted.
+        :type max_messages: int
+        :param max_delay: Seconds after which a group that the rate limits
+                          kept from being sent is dropped.
+        :type max_delay: float
+        :param sender_rate: Reports per second allowed to a single return
+                            path, or None for no limit.
+        :type sender_rate: float
+        :param sender_burst: Reports allowed in a burst to a single return
+                             path. Defaults to sender_rate, and at least
+                             one.
+        :type sender_burst: float
+        :param rate: Reports per second allowed overall, or None for no
+                     limit.
+        :type rate: float
+        :param burst: Reports allowed in a burst overall. Defaults to rate,
+                      and at least one.
+        :type burst: float
+        :param directory: Where to keep the bounce records, or None to keep
+                          the queue in memory only.
+        :type directory: str
+        :param concurrency: Maximum number of reports being sent at once.
+        :type concurrency: int
+        :param backoff: How to retry a report the transport failed to send.
+        :type backoff: leap.mx.retry.Backoff
+        :param clock: The reactor used to schedule the reports.
+        :type clock: twisted.internet.interfaces.IReactorTime
+        """
+        self._bounce_from = bounce_from
+        self._bounce_subject = bounce_subject
+        self._transport = transport or SENDMAIL
+        self._window = window
+        self._max_messages = max_messages
+        self._max_delay = max_delay
+        self._sender_rate = sender_rate
+        self._sender_burst = sender_burst or max(sender_rate, 1)
+        self._directory = directory
+        self._semaphore = defer.DeferredSemaphore(concurrency)
+        self._backoff = backoff
+        self._clock = clock
+        self._bucket = None
+        if rate:
+            self._bucket = TokenBucket(rate, burst or max(rate, 1), clock)
+        self._senders = {}
+        self._groups = {}
+        self._sending = set()
+        self._events = dict(
+            (event, BOUNCE_QUEUE_MESSAGES.labels(event))
+            for event in ("queued", "coalesced", "sent", "delayed",
+                          "dropped", "failed"))
+
+    def startService(self):
+        """
+        Queue the bounces recorded by a previous run.
+        """
+        Service.startService(self)
+        if self._directory is not None:
+            if not os.path.isdir(self._directory):
+                os.makedirs(self._directory)
+            self.load()
+
+    def stopService(self):
+        """
+        Send the pending reports if they are only kept in memory.
+
+        :return: A deferred which fires when the reports being sent are
+                 done.
+        :rtype: Deferred
+        """
+        Service.stopService(self)
+        if self._directory is None:
+            self.flush()
+        else:
+            # the records will be queued again on the next start
+            for group in self._groups.itervalues():
+                group.call.cancel()
+            self._groups = {}
+        return defer.DeferredList(list(self._sending))
+
+    @property
+    def pending(self):
+        """
+        The number of bounced messages waiting to be reported.
+        """
+        return sum(group.count for group in self._groups.itervalues())
+
+    def bounce(self, orig_msg, reason, headers_only=False):
+        """
+        Queue the bounce of a message.
+
+        :param orig_msg: The original message that will be bounced.
+        :type orig_msg: email.message.Message
+        :param reason: The reason for bouncing the message.
+        :type reason: str
+        :param headers_only: Whether to return only the headers of the
+                             original message.
+        :type headers_only: bool
+
+        :return: A deferred which fires once the bounce is queued, and
+                 durably recorded if the queue has a directory.
+        :rtype: Deferred
+
+        :raise InvalidReturnPathError: Raised when the "Return-Path" header
+                                       of the message is invalid for creating
+                                       a bounce message.
+        """
+        orig_rpath = orig_msg.get("Return-Path")
+
+        # do not bounce if sender address is invalid
+        _, addr = parseaddr(orig_rpath)
+        if not _valid_address(addr):
+            log.msg(
+                "Will not send a bounce message to an invalid address: %s"
+                % orig_rpath)
+            return defer.succeed(None)
+        if not _check_valid_return_path(orig_rpath):
+            raise InvalidReturnPathError
+
+        now = self._clock.seconds()
+        if self._directory is not None or headers_only:
+            # don't keep the body around if it won't be returned
+            headers = _headers(orig_msg)
+            orig_msg = message_from_string(headers)
+            headers_only = True
+        if self._directory is None:
+            self._add(addr, reason, orig_msg, None, now, headers_only)
+            return defer.succeed(None)
+
+        def recorded(record):
+            # a record written while stopping is queued on the next start
+            if self.running:
+                self._add(addr, reason, orig_msg, record, now, True)
+
+        d = threads.deferToThread(self._write_record, headers, reason, now)
+        d.addCallback(recorded)
+        # stopping waits for the records being written too
+        self._sending.add(d)
+        d.addBoth(self._done_sending, d)
+        return d
+
+    def _add(self, addr, reason, orig_msg, record, created,
+             headers_only=False):
+        key = (addr.lower(), reason)
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = _BounceGroup(created)
+            self._schedule(key, group)
+        else:
+            self._events["coalesced"].inc()
+        group.add(orig_msg, self._max_messages, record, headers_only)
+        self._events["queued"].inc()
+
+    def _schedule(self, key, group):
+        group.call = self._clock.callLater(
+            self._window, self._flush_group, key)
+
+    def _write_record(self, headers, reason, queued_at):
+        """
+        Durably write a bounce record, called in a thread.
+
+        :return: The path of the record.
+        :rtype: str
+        """
+        name = "%d-%s" % (queued_at, uuid.uuid4().hex)
+        path = os.path.join(self._directory, name + self.RECORD_SUFFIX)
+        tmp_path = os.path.join(self._directory, "." + name)
+        try:
+            with open(tmp_path, "w") as f:
+                # headers may have any 8 bit bytes, latin-1 keeps them all
+                json.dump({"headers": headers.decode("latin-1"),
+                           "reason": reason, "queued_at": queued_at}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        # the rename is only durable once the directory is synced
+        fd = os.open(self._directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return path
+
+    def load(self):
+        """
+        Queue the bounces recorded in the directory that aren't queued yet.
+        """
+        queued = set()
+        for group in self._groups.itervalues():
+            queued.update(group.records)
+        loaded = 0
+        for name in sorted(os.listdir(self._directory)):
+            path = os.path.join(self._directory, name)
+            if name.startswith("."):
+                # left by a run that stopped while writing a record
+                self._remove_records([path])
+                continue
+            if not name.endswith(self.RECORD_SUFFIX) or path in queued:
+                continue
+            try:
+                with open(path) as f:
+                    record = json.load(f)
+                orig_msg = message_from_string(
+                    record["headers"].encode("latin-1"))
+                _, addr = parseaddr(orig_msg.get("Return-Path"))
+                self._add(addr, record["reason"], orig_msg, path,
+                          record["queued_at"], True)
+                loaded += 1
+            except Exception:
+                log.msg("Removing unreadable bounce record %s" % (path,))
+                log.err()
+                self._remove_records([path])
+        if loaded:
+            log.msg("Queued %d recorded bounces" % (loaded,))
+
+    def _remove_records(self, records):
+        for path in records:
+            try:
+                os.remove(path)
+            except OSError:
+                log.err()
+
+    def flush(self):
+        """
+        Send every group right away, regardless of the rate limits.
+        """
+        for key, group in self._groups.items():
+            group.call.cancel()
+            del self._groups[key]
+            self._send(key, group)
+
+    def _allowed(self, addr):
+        """
+        Take a token from the limits for a report to addr, if there are
+        enough of them.
+        """
+        sender = None
+        if self._sender_rate:
+            now = self._clock.seconds()
+            self._expire_senders(now)
+            state = self._senders.get(addr)
+            if state is None:
+                state = self._senders[addr] = [TokenBucket(
+                    self._sender_rate, self._sender_burst, self._clock), now]
+            state[1] = now
+            sender = state[0]
+            if not sender.consume():
+                return False
+        if self._bucket is not None and not self._bucket.consume():
+            # the report isn't sent, the sender keeps its token
+            if sender is not None:
+                sender.refund()
+            return False
+        return True
+
+    def _expire_senders(self, now):
+        """
+        Forget the limits of senders whose buckets are full again.
+        """
+        idle = self._sender_burst / self._sender_rate
+        for addr, (_, last) in self._senders.items():
+            if now - last > idle:
+                del self._senders[addr]
+
+    def _expired(self, group):
+        waited = self._clock.seconds() - group.created
+        return waited + self._window > self._max_delay
+
+    def _drop(self, key, group):
+        self._events["dropped"].inc(group.count)
+        log.msg("Dropping %d bounces to %s" % (group.count, key[0]))
+        self._remove_records(group.records)
+
+    def _flush_group(self, key):
+        """
+        Send the group for key at the end of its window, or delay it if the
+        rate limits don't allow it.
+        """
+        group = self._groups.pop(key)
+        if not self._allowed(key[0]):
+            if self._expired(group):
+                self._drop(key, group)
+            else:
+                self._events["delayed"].inc(group.count)
+                self._requeue(key, group)
+            return
+        self._send(key, group)
+
+    def _requeue(self, key, group):
+        """
+        Put a group back in the queue, merging it with the group that took
+        its place in the meantime.
+        """
+        current = self._groups.get(key)
+        if current is None:
+            self._groups[key] = group
+            self._schedule(key, group)
+        else:
+            current.merge(group, self._max_messages)
+
+    def _send(self, key, group):
+        addr, reason = key
+        try:
+            if group.count == 1:
+                data = bounce_template(
+                    self._bounce_from, self._bounce_subject, reason).render(
+                        group.msgs[0], group.headers_only)
+            else:
+                data = _build_aggregate_bounce_message(
+                    self._bounce_from, self._bounce_subject, group.msgs,
+                    reason, group.count).as_string()
+        except Exception:
+            log.err()
+            self._remove_records(group.records)
+            return
+        d = self._semaphore.run(
+            retry, lambda: self._transport.send(addr, data),
+            _transient_bounce_error, self._backoff, clock=self._clock)
+        d.addCallbacks(self._sent, self._send_failed,
+                       callbackArgs=(group,), errbackArgs=(key, group))
+        self._sending.add(d)
+        d.addBoth(self._done_sending, d)
+
+    def _sent(self, _, group):
+        self._events["sent"].inc(group.count)
+        self._remove_records(group.records)
+
+    def _send_failed(self, failure, key, group):
+        log.msg("Failed to send %d bounces to %s: %s"
+                % (group.count, key[0], failure.getErrorMessage()))
+        if not _transient_bounce_error(failure.value) or \
+                self._expired(group):
+            self._drop(key, group)
+        elif self.running or self._directory is None:
+            self._events["failed"].inc(group.count)
+            self._requeue(key, group)
+
+    def _done_sending(self, result, d):
+        self._sending.discard(d)
+        return result
+
+
+def _transient_bounce_error(error):
+    """
+    Whether sending a bounce that failed with error may succeed later.
+    """
+    return not getattr(error, "permanent", False)
+
+
 class BouncerSubprocessProtocol(protocol.ProcessProtocol):
     """
     Bouncer subprocess protocol that will feed the msg contents to be
@@ -378,6 +1138,40 @@ def _async_check_output(args, msg):
     return pprotocol.deferred
 
 
+class SendmailTransport(object):
+    """
+    Hands bounces to the MTA by running sendmail, once per message.
+    """
+
+    def __init__(self, path="/usr/sbin/sendmail"):
+        """
+        :param path: The path of the sendmail binary.
+        :type path: str
+        """
+        self._path = path
+
+    def send(self, recipient, data):
+        """
+        Send a message to the recipients in its headers.
+
+        :param recipient: The envelope recipient, sendmail takes it from the
+                          headers of the message.
+        :type recipient: str
+        :param data: The message.
+        :type data: str
+
+        :return: A deferred that will fire with the output of the sendmail
+                 process if it was successful or with a failure containing
+                 the reason for the end of the process if it failed.
+        :rtype: Deferred
+        """
+        BOUNCE_TRANSPORT_MESSAGES.labels("sendmail").inc()
+        return _async_check_output([self._path, "-t"], data)
+
+
+SENDMAIL = SendmailTransport()
+
+
 class DSNGenerator(Generator):
     """
     A slightly modified generator to correctly parse delivery status
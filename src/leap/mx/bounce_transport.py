@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# bounce_transport.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Sends bounces to the local MTA over persistent SMTP connections.
+
+Running sendmail forks a process per bounce, which then goes through
+postfix's pickup daemon. The SMTPBounceTransport keeps a few connections to
+the MTA open instead, and sends every bounce as a new transaction on one of
+them, pipelining the envelope commands when the server supports it
+(RFC 2920). Bounces are sent with a null reverse-path, as RFC 3464 requires
+for delivery status notifications.
+
+If the MTA can't be reached, or it fails a transaction with a temporary
+error, the bounce is handed to the fallback transport, usually sendmail.
+"""
+
+from collections import deque
+
+from twisted.internet import defer, reactor
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet.error import ConnectionLost
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineReceiver
+from twisted.python import log
+
+from leap.mx.bounce import HOSTNAME
+from leap.mx.metrics import BOUNCE_SMTP_CONNECTIONS
+from leap.mx.metrics import BOUNCE_TRANSPORT_MESSAGES
+
+
+class SMTPBounceError(Exception):
+    """
+    Raised when the MTA refuses a bounce.
+    """
+
+    def __init__(self, code, text):
+        Exception.__init__(self, "%d %s" % (code, text))
+        self.code = code
+        self.text = text
+
+    @property
+    def permanent(self):
+        return self.code >= 500
+
+
+def _smtp_data(data):
+    """
+    Convert a message to the DATA format: CRLF line endings, leading dots
+    doubled and the final dot line.
+    """
+    lines = data.replace("\r\n", "\n").split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    for i, line in enumerate(lines):
+        if line.startswith("."):
+            lines[i] = "." + line
+    lines.append(".")
+    return "\r\n".join(lines) + "\r\n"
+
+
+class BounceSMTPClient(LineReceiver):
+    """
+    A minimal ESMTP client that sends several messages over one connection.
+    """
+
+    delimiter = "\r\n"
+    MAX_LENGTH = 65536
+
+    def __init__(self):
+        self.ready = defer.Deferred()
+        self.closed = defer.Deferred()
+        self.established = False
+        self.pipelining = False
+        self._replies = deque()
+        self._lines = []
+
+    def connectionMade(self):
+        # the greeting is the reply to connecting
+        d = self._reply()
+        d.addCallback(self._greeted)
+        d.addErrback(self._failed)
+
+    def _failed(self, failure):
+        if not self.ready.called:
+            self.ready.errback(failure)
+        self.transport.loseConnection()
+
+    @defer.inlineCallbacks
+    def _greeted(self, reply):
+        self._expect(reply, 220)
+        reply = yield self._command("EHLO %s" % (HOSTNAME,))
+        code, lines = reply
+        if code != 250:
+            reply = yield self._command("HELO %s" % (HOSTNAME,))
+            self._expect(reply, 250)
+        else:
+            extensions = [line.split(" ", 1)[0].upper()
+                          for line in lines[1:]]
+            self.pipelining = "PIPELINING" in extensions
+        self.established = True
+        self.ready.callback(self)
+
+    def _expect(self, reply, code):
+        if reply[0] // 100 != code // 100 or \
+                (code == 354 and reply[0] != 354):
+            raise SMTPBounceError(reply[0], " ".join(reply[1]))
+
+    def _reply(self):
+        d = defer.Deferred()
+        self._replies.append(d)
+        return d
+
+    def _command(self, line):
+        self.sendLine(line)
+        return self._reply()
+
+    def lineReceived(self, line):
+        code, continued, text = line[:3], line[3:4], line[4:]
+        self._lines.append(text)
+        if continued == "-":
+            return
+        lines, self._lines = self._lines, []
+        try:
+            code = int(code)
+        except ValueError:
+            code = 0
+        if self._replies:
+            self._replies.popleft().callback((code, lines))
+
+    def connectionLost(self, reason):
+        replies, self._replies = self._replies, deque()
+        for d in replies:
+            d.errback(ConnectionLost(reason.getErrorMessage()))
+        if not self.ready.called:
+            self.ready.errback(reason)
+        if self.established:
+            self.factory.pool.lost(self)
+        self.closed.callback(None)
+
+    @defer.inlineCallbacks
+    def sendmail(self, recipient, data):
+        """
+        Send a message with a null reverse-path.
+
+        :param recipient: The envelope recipient.
+        :type recipient: str
+        :param data: The message.
+        :type data: str
+
+        :return: A deferred which fires when the server accepted the message
+                 or fails with SMTPBounceError if it refused it.
+        :rtype: Deferred
+        """
+        commands = ["MAIL FROM:<>", "RCPT TO:<%s>" % (recipient,), "DATA"]
+        if self.pipelining:
+            replies = yield defer.gatherResults(
+                [self._command(command) for command in commands],
+                consumeErrors=True)
+        else:
+            replies = []
+            for command in commands:
+                reply = yield self._command(command)
+                replies.append(reply)
+                if reply[0] // 100 != 2:
+                    break
+        try:
+            for reply, code in zip(replies, (250, 250, 354)):
+                self._expect(reply, code)
+        except SMTPBounceError:
+            # get the connection ready for the next transaction
+            if len(replies) == 3 and replies[2][0] == 354:
+                self.transport.write(".\r\n")
+                self._reply().addErrback(lambda _: None)
+            self._command("RSET").addErrback(lambda _: None)
+            raise
+        reply = yield self._send_data(data)
+        self._expect(reply, 250)
+
+    def _send_data(self, data):
+        self.transport.write(_smtp_data(data))
+        return self._reply()
+
+    def quit(self):
+        """
+        End the session.
+        """
+        self.sendLine("QUIT")
+        self._reply().addBoth(lambda _: self.transport.loseConnection())
+
+
+class _BounceSMTPClientFactory(Factory):
+
+    protocol = BounceSMTPClient
+
+    def __init__(self, pool):
+        self.pool = pool
+
+
+class SMTPBounceTransport(object):
+    """
+    Hands bounces to the MTA over a pool of persistent SMTP connections.
+    """
+
+    def __init__(self, host="localhost", port=25, concurrency=2,
+                 idle_timeout=60, connect_timeout=30, fallback=None,
+                 reactor=reactor):
+        """
+        :param host: The host of the MTA.
+        :type host: str
+        :param port: The SMTP port of the MTA.
+        :type port: int
+        :param concurrency: Maximum number of connections to the MTA, and so
+                            of bounces being sent at the same time.
+        :type concurrency: int
+        :param idle_timeout: Seconds an idle connection is kept open.
+        :type idle_timeout: float
+        :param connect_timeout: Seconds to wait for a new connection to be
+                                established.
+        :type connect_timeout: float
+        :param fallback: The transport used when the MTA can't be reached
+                         over SMTP, or None to fail the bounce instead.
+        :type fallback: leap.mx.bounce.SendmailTransport
+        """
+        self._endpoint = TCP4ClientEndpoint(
+            reactor, host, port, timeout=connect_timeout)
+        self._factory = _BounceSMTPClientFactory(self)
+        self._concurrency = concurrency
+        self._idle_timeout = idle_timeout
+        self._fallback = fallback
+        self._reactor = reactor
+        self._queue = deque()
+        self._idle = []
+        self._idle_calls = {}
+        self._connections = 0
+        self._connecting = 0
+        self._sent = BOUNCE_TRANSPORT_MESSAGES.labels("smtp")
+
+    def send(self, recipient, data):
+        """
+        Send a message.
+
+        :param recipient: The envelope recipient.
+        :type recipient: str
+        :param data: The message.
+        :type data: str
+
+        :return: A deferred which fires when the MTA accepted the message,
+                 or fails if neither the MTA nor the fallback did.
+        :rtype: Deferred
+        """
+        d = defer.Deferred()
+        self._queue.append((recipient, data, d))
+        self._dispatch()
+        return d
+
+    def _dispatch(self):
+        while self._queue and self._idle:
+            client = self._idle.pop()
+            self._idle_calls.pop(client).cancel()
+            self._send(client, *self._queue.popleft())
+        while len(self._queue) > self._connecting and \
+                self._connections < self._concurrency:
+            self._connect()
+
+    def _connect(self):
+        self._connections += 1
+        self._connecting += 1
+        BOUNCE_SMTP_CONNECTIONS.inc()
+        d = self._endpoint.connect(self._factory)
+        d.addCallback(lambda client: client.ready)
+        d.addCallbacks(self._connected, self._connect_failed)
+
+    def _connected(self, client):
+        self._connecting -= 1
+        self._release(client)
+
+    def _connect_failed(self, failure):
+        self._connections -= 1
+        self._connecting -= 1
+        log.msg("Could not connect to the MTA to send bounces: %s"
+                % (failure.getErrorMessage(),))
+        if not self._connections:
+            # nothing else will pick the queue up
+            queue, self._queue = self._queue, deque()
+            for recipient, data, d in queue:
+                self._fall_back(recipient, data, d, failure)
+
+    def _release(self, client):
+        if self._queue:
+            self._send(client, *self._queue.popleft())
+            return
+        self._idle.append(client)
+        self._idle_calls[client] = self._reactor.callLater(
+            self._idle_timeout, self._expire, client)
+
+    def _expire(self, client):
+        del self._idle_calls[client]
+        self._idle.remove(client)
+        client.quit()
+
+    def lost(self, client):
+        """
+        Forget about a connection that was closed.
+
+        :param client: The protocol of the connection.
+        :type client: BounceSMTPClient
+        """
+        self._connections -= 1
+        if client in self._idle:
+            self._idle.remove(client)
+            self._idle_calls.pop(client).cancel()
+        if self._queue:
+            self._dispatch()
+
+    @defer.inlineCallbacks
+    def _send(self, client, recipient, data, d):
+        try:
+            yield client.sendmail(recipient, data)
+        except SMTPBounceError as e:
+            self._release(client)
+            if e.permanent:
+                d.errback(e)
+            else:
+                self._fall_back(recipient, data, d, e)
+            return
+        except Exception as e:
+            # lost connections are accounted by lost()
+            client.transport.abortConnection()
+            self._fall_back(recipient, data, d, e)
+            return
+        self._sent.inc()
+        self._release(client)
+        d.callback(None)
+
+    def _fall_back(self, recipient, data, d, error):
+        if self._fallback is None:
+            d.errback(error)
+            return
+        log.msg("Sending bounce with the fallback transport: %s" % (error,))
+        self._fallback.send(recipient, data).chainDeferred(d)
+
+    def close(self):
+        """
+        Close the idle connections.
+
+        :return: A deferred which fires when the connections are closed.
+        :rtype: Deferred
+        """
+        idle, self._idle = self._idle, []
+        for client in idle:
+            self._idle_calls.pop(client).cancel()
+            client.quit()
+        return defer.DeferredList([client.closed for client in idle])
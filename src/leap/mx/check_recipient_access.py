@@ -29,13 +29,14 @@ Test this with postmap -v -q "foo" tcp:localhost:2244
 
 from twisted.protocols import postfix
 
+from leap.mx.tcp_map import LEAPPostfixTCPMapServer
 from leap.mx.tcp_map import LEAPPostfixTCPMapServerFactory
 from leap.mx.tcp_map import TCP_MAP_CODE_SUCCESS
 from leap.mx.tcp_map import TCP_MAP_CODE_TEMPORARY_FAILURE
 from leap.mx.tcp_map import TCP_MAP_CODE_PERMANENT_FAILURE
 
 
-class LEAPPostFixTCPMapAccessServer(postfix.PostfixTCPMapServer):
+class LEAPPostFixTCPMapAccessServer(LEAPPostfixTCPMapServer):
     """
     A postfix tcp map recipient access checker server.
 
@@ -84,3 +85,7 @@ class CheckRecipientAccessFactory(LEAPPostfixTCPMapServerFactory):
     @property
     def _query_message(self):
         return "check recipient access"
+
+    @property
+    def _map_name(self):
+        return "check_recipient"
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# compression.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Choice of the compression of incoming messages before they are encrypted.
+
+Large mail is mostly attachments that are already compressed, like images,
+pdfs or archives, and that only lose the redundancy of their base64 encoding
+when deflated, at a high cost in CPU. Small messages gain few bytes. The
+CompressionPolicy compresses a few samples spread over a message at the
+fastest level, and only compresses the message when they shrink enough,
+with a lower level the larger the message is. The size and time of the
+compression of each message at the level it was given are recorded once
+it's encrypted.
+"""
+
+import time
+import zlib
+
+from leap.mx.metrics import COMPRESSION_BYTES
+from leap.mx.metrics import COMPRESSION_MESSAGES
+from leap.mx.metrics import COMPRESSION_RATIO
+from leap.mx.metrics import COMPRESSION_SAMPLE_RATIO
+from leap.mx.metrics import COMPRESSION_SAMPLE_SECONDS
+from leap.mx.metrics import COMPRESSION_SECONDS
+from leap.mx.vendor.pgpy.constants import CompressionAlgorithm
+
+
+class CompressionPolicy(object):
+    """
+    Decide whether and how hard to compress each message.
+    """
+
+    """
+    Compression level by message size, the first whose size limit is above
+    the size of the message is used.
+    """
+    LEVELS = ((64 * 1024, 6), (1024 * 1024, 3), (None, 1))
+
+    """
+    Number of samples taken from messages larger than sample_size.
+    """
+    SAMPLES = 4
+
+    def __init__(self, min_size=1024, max_ratio=0.7, sample_size=16384):
+        """
+        :param min_size: Size in bytes under which messages are not
+                         compressed.
+        :type min_size: int
+        :param max_ratio: Compressed to original size ratio of the samples
+                          above which a message is not compressed.
+        :type max_ratio: float
+        :param sample_size: Bytes of a message compressed to estimate its
+                            ratio, messages up to this size are compressed
+                            whole.
+        :type sample_size: int
+        """
+        self._min_size = min_size
+        self._max_ratio = max_ratio
+        self._sample_size = sample_size
+        self._messages = dict(
+            (decision, COMPRESSION_MESSAGES.labels(decision))
+            for decision in ("compressed", "small", "incompressible"))
+        self._levels = {}
+
+    def choose(self, data):
+        """
+        Choose the compression of a message.
+
+        :param data: The message to be encrypted.
+        :type data: str or unicode
+
+        :return: The compression algorithm and level to encrypt it with.
+        :rtype: tuple of (CompressionAlgorithm, int)
+        """
+        if len(data) < self._min_size:
+            self._messages["small"].inc()
+            return CompressionAlgorithm.Uncompressed, None
+
+        started = time.time()
+        sample = self._sample(data)
+        if isinstance(sample, unicode):
+            sample = sample.encode("utf-8")
+        ratio = len(zlib.compress(sample, 1)) / float(len(sample))
+        COMPRESSION_SAMPLE_SECONDS.observe(time.time() - started)
+        COMPRESSION_SAMPLE_RATIO.observe(ratio)
+        if ratio > self._max_ratio:
+            self._messages["incompressible"].inc()
+            return CompressionAlgorithm.Uncompressed, None
+
+        self._messages["compressed"].inc()
+        for max_size, level in self.LEVELS:
+            if max_size is None or len(data) <= max_size:
+                return CompressionAlgorithm.ZIP, level
+
+    def observe(self, message):
+        """
+        Record the size and time of the compression of a message, once it
+        has been encrypted.
+
+        :param message: A message compressed as chosen by this policy.
+        :type message: leap.mx.vendor.pgpy.PGPMessage
+        """
+        stats = message.compression_stats
+        if stats is None:
+            return
+        level, size, compressed_size, seconds = stats
+        children = self._levels.get(level)
+        if children is None:
+            label = str(level)
+            children = self._levels[level] = (
+                COMPRESSION_RATIO.labels(label),
+                COMPRESSION_SECONDS.labels(label),
+                COMPRESSION_BYTES.labels(label, "original"),
+                COMPRESSION_BYTES.labels(label, "compressed"))
+        ratio, latency, original_bytes, compressed_bytes = children
+        if size:
+            ratio.observe(compressed_size / float(size))
+        latency.observe(seconds)
+        original_bytes.inc(size)
+        compressed_bytes.inc(compressed_size)
+
+    def _sample(self, data):
+        """
+        Take evenly spaced chunks of data, so that the headers and text at
+        the start of a message don't hide attachments further on.
+        """
+        if len(data) <= self._sample_size:
+            return data
+        chunk = self._sample_size // self.SAMPLES
+        step = (len(data) - chunk) // (self.SAMPLES - 1)
+        return "".join(data[i * step:i * step + chunk]
+                       for i in xrange(self.SAMPLES))
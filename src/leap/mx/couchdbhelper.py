@@ -22,11 +22,35 @@ maps, user UUIDs, and GPG keyIDs.
 """
 
 
+import socket
+import time
+
+from httplib import HTTPException
+from urllib import urlencode
+
+from couchdb.http import ServerError
 from paisley import client
 from twisted.internet import defer
 from twisted.python import log
+from u1db.errors import RevisionConflict
 from leap.soledad.common.couch import CouchDatabase
 
+from leap.mx.metrics import COUCHDB_ERRORS
+from leap.mx.metrics import COUCHDB_LATENCY
+from leap.mx.metrics import EXPORT_RETRIES
+from leap.mx.retry import DEFAULT_BACKOFF, retry
+
+
+def _is_transient(error):
+    """
+    Whether writing a document that failed with error may succeed if tried
+    again.
+    """
+    if isinstance(error, ServerError):
+        status = error.args[0][0] if error.args else None
+        return status is None or status >= 500
+    return isinstance(error, (socket.error, HTTPException))
+
 
 class ConnectedCouchDB(client.CouchDB):
     """
@@ -37,7 +61,7 @@ class ConnectedCouchDB(client.CouchDB):
     """
 
     def __init__(self, host, port=5984, dbName=None, username=None,
-                 password=None, *args, **kwargs):
+                 password=None, backoff=DEFAULT_BACKOFF, *args, **kwargs):
         """
         Connect to a CouchDB instance.
 
@@ -51,6 +75,9 @@ class ConnectedCouchDB(client.CouchDB):
         :type username: str
         :param str password: (optional) The password for authorization.
         :type password: str
+        :param backoff: (optional) How to retry writing a document that
+                        failed with a transient error.
+        :type backoff: leap.mx.retry.Backoff
         """
         self._mail_couch_url = "http://%s:%s@%s:%s" % (username,
                                                        password,
@@ -63,7 +90,46 @@ class ConnectedCouchDB(client.CouchDB):
                                 username=username,
                                 password=password,
                                 *args, **kwargs)
+        self._dbName = dbName
         self._cache = {}
+        self._backoff = backoff
+        self._export_retries = EXPORT_RETRIES.labels("couchdb")
+
+    def _measure(self, d, view):
+        """
+        Record the latency and the failure, if any, of the request whose
+        result d will fire with.
+
+        :param d: The deferred for the request.
+        :type d: Deferred
+        :param view: The name of the view or endpoint queried.
+        :type view: str
+
+        :return: d
+        :rtype: Deferred
+        """
+        started = time.time()
+        latency = COUCHDB_LATENCY.labels(view)
+
+        def _measure_cbk(result):
+            latency.observe(time.time() - started)
+            return result
+
+        def _measure_ebk(failure):
+            latency.observe(time.time() - started)
+            COUCHDB_ERRORS.labels(view).inc()
+            return failure
+
+        d.addCallbacks(_measure_cbk, _measure_ebk)
+        return d
+
+    def openView(self, dbName, docId, viewId, **kwargs):
+        """
+        Overrides ``paisley.client.CouchDB.openView`` to measure the
+        request.
+        """
+        d = client.CouchDB.openView(self, dbName, docId, viewId, **kwargs)
+        return self._measure(d, viewId.rstrip("/"))
 
     def createDB(self, dbName):
         """
@@ -111,6 +177,61 @@ class ConnectedCouchDB(client.CouchDB):
         d.addErrback(lambda _: (None, None))
         return d
 
+    def getAllAddresses(self):
+        """
+        Query couch and return a deferred that will fire with every address
+        known to the by_address view, together with the database update
+        sequence the listing is consistent with.
+
+        The update sequence is read before the view, so any change that
+        races with the listing will also be returned by a later call to
+        getChanges(since=update_seq).
+
+        :return: A deferred that will fire with a tuple (update_seq,
+                 addresses).
+        :rtype: Deferred
+        """
+        d = self.infoDB()
+
+        def _get_addresses(info):
+            update_seq = info["update_seq"]
+            d = self.openView(docId="Identity",
+                              viewId="by_address/",
+                              reduce=False)
+            d.addCallback(
+                lambda result: (update_seq,
+                                [row["key"] for row in result["rows"]]))
+            return d
+
+        d.addCallback(_get_addresses)
+        return d
+
+    def getChanges(self, since):
+        """
+        Query couch's changes feed and return a deferred that will fire with
+        the documents changed after the given update sequence.
+
+        :param since: The update sequence to start from.
+        :type since: int or str
+
+        :return: A deferred that will fire with a tuple (last_seq, docs),
+                 where docs is a list of the changed documents that were not
+                 deleted.
+        :rtype: Deferred
+        """
+        uri = "/%s/_changes?%s" % (
+            self._dbName, urlencode({"since": since, "include_docs": "true"}))
+        d = self._measure(self.get(uri), "_changes")
+        d.addCallback(self.parseResult)
+
+        def _get_changes_cbk(result):
+            docs = [change["doc"] for change in result["results"]
+                    if not change.get("deleted") and "doc" in change]
+            return result["last_seq"], docs
+
+        d.addCallback(_get_changes_cbk)
+        return d
+
     def getPubkey(self, uuid):
         """
         Query couch and return a deferred that will fire with the pgp public
@@ -177,6 +298,11 @@ class ConnectedCouchDB(client.CouchDB):
         If the database specifies a maximum document size and the document
         exceeds it, put will fail and raise a DocumentTooBig exception.
 
+        Transient failures, like a refused connection or a 5xx response, are
+        retried with the same doc_id. A new document whose doc_id is already
+        taken is assumed to have been stored by an earlier attempt whose
+        response was lost, as incoming messages get a fresh uuid4 doc_id.
+
         :param uuid: The uuid of a user
         :type uuid: str
         :param doc: A Document with new content.
@@ -189,8 +315,19 @@ class ConnectedCouchDB(client.CouchDB):
         """
         # TODO: that should be implemented with paisley
         url = self._mail_couch_url + "/user-%s" % (uuid,)
-        try:
+        rev = doc.rev
+
+        def _put_doc():
+            # a failed attempt may have bumped the revision already
+            doc.rev = rev
             db = CouchDatabase.open_database(url, create=False)
-            return defer.succeed(db.put_doc(doc))
-        except Exception as e:
-            return defer.fail(e)
+            try:
+                return db.put_doc(doc)
+            except RevisionConflict:
+                if rev is not None:
+                    raise
+                log.msg("Document %s was already stored" % (doc.doc_id,))
+                return None
+
+        return retry(_put_doc, _is_transient, self._backoff,
+                     self._export_retries)
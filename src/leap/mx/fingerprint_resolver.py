@@ -28,11 +28,13 @@ from twisted.internet.protocol import ServerFactory
 from twisted.protocols import postfix
 from twisted.python import log
 
+from leap.mx.tcp_map import LEAPPostfixTCPMapServer
+from leap.mx.tcp_map import MapMetrics
 from leap.mx.tcp_map import TCP_MAP_CODE_SUCCESS
 from leap.mx.tcp_map import TCP_MAP_CODE_PERMANENT_FAILURE
 
 
-class LEAPPostfixTCPMapFingerprintServer(postfix.PostfixTCPMapServer):
+class LEAPPostfixTCPMapFingerprintServer(LEAPPostfixTCPMapServer):
     """
     A postfix tcp map fingerprint resolver server.
     """
@@ -72,14 +74,18 @@ class FingerprintResolverFactory(ServerFactory, object):
 
     protocol = LEAPPostfixTCPMapFingerprintServer
 
-    def __init__(self, couchdb):
+    def __init__(self, couchdb, throttle=None):
         """
         Initialize the factory.
 
         :param couchdb: A CouchDB client.
         :type couchdb: leap.mx.couchdbhelper.ConnectedCouchDB
+        :param throttle: Optional limits on connections and lookups.
+        :type throttle: leap.mx.throttle.QueryThrottle
         """
         self._cdb = couchdb
+        self.throttle = throttle
+        self.metrics = MapMetrics("fingerprint")
 
     def get(self, fingerprint):
         """
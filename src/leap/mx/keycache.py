@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# keycache.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Cache of parsed OpenPGP public keys.
+
+Parsing an armored key means unarmoring it, checking its CRC24 and building
+every packet, user id and signature in it, which costs more than encrypting
+a small message to it. Users keep receiving mail, so the MailReceiver keeps
+the keys it parsed in a KeyCache, keyed by a hash of the armored blob as it
+comes from CouchDB. A key that changes in the database has a different
+blob, and so is parsed again, while the old one ages out of the cache.
+"""
+
+import hashlib
+
+from collections import OrderedDict
+
+from twisted.internet import reactor
+
+from leap.mx.metrics import KEY_CACHE_EVICTIONS
+from leap.mx.metrics import KEY_CACHE_KEYS
+from leap.mx.metrics import KEY_CACHE_LOOKUPS
+from leap.mx.vendor.pgpy import PGPKey
+
+
+class KeyCache(object):
+    """
+    A bounded LRU cache of parsed public keys, whose entries also expire
+    after a while.
+    """
+
+    def __init__(self, max_size=1024, ttl=3600, clock=reactor):
+        """
+        :param max_size: Maximum number of keys kept, the least recently
+                         used are evicted first.
+        :type max_size: int
+        :param ttl: Seconds a key is kept since it was parsed.
+        :type ttl: float
+        :param clock: Provider of the current time.
+        :type clock: twisted.internet.interfaces.IReactorTime
+        """
+        self._max_size = max_size
+        self._ttl = ttl
+        self._clock = clock
+        self._keys = OrderedDict()
+        self._lookups = dict(
+            (result, KEY_CACHE_LOOKUPS.labels(result))
+            for result in ("hit", "miss"))
+        KEY_CACHE_KEYS.set_function(lambda: len(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get_key(self, blob):
+        """
+        Return the parsed key for an armored public key, parsing it if it
+        isn't cached.
+
+        :param blob: The armored public key.
+        :type blob: str
+
+        :return: The parsed key.
+        :rtype: leap.mx.vendor.pgpy.PGPKey
+
+        :raise ValueError: Raised when the key can't be parsed.
+        """
+        digest = hashlib.sha256(blob).digest()
+        now = self._clock.seconds()
+        entry = self._keys.pop(digest, None)
+        if entry is not None and now - entry[1] < self._ttl:
+            self._lookups["hit"].inc()
+            # move it to the end, as the most recently used
+            self._keys[digest] = entry
+            return entry[0]
+
+        self._lookups["miss"].inc()
+        key, _ = PGPKey.from_blob(blob)
+        self._keys[digest] = (key, now)
+        while len(self._keys) > self._max_size:
+            self._keys.popitem(last=False)
+            KEY_CACHE_EVICTIONS.inc()
+        return key
@@ -32,19 +32,27 @@ User facing problems could be:
 
 Any other problem is a bug, which will be logged. Until the bug is
 fixed, the email will stay in there waiting.
+
+Transient failures to deliver are retried in place by the exporters. The
+encrypted document of a message that still couldn't be delivered is kept
+for a while, so the next attempt delivers the same doc_id without
+encrypting the message again.
 """
 import os
 import uuid as pyuuid
 import signal
+import time
 
 import json
 import email.utils
 
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from email import message_from_string
+from email.parser import HeaderParser
 
 from twisted.application.service import Service, IService
-from twisted.internet import inotify, defer, task, reactor
+from twisted.internet import inotify, defer, task, threads, reactor
 from twisted.python import filepath, log
 
 from zope.interface import implements
@@ -54,13 +62,50 @@ from leap.soledad.common.crypto import ENC_JSON_KEY
 from leap.soledad.common.crypto import ENC_SCHEME_KEY
 from leap.soledad.common.document import ServerDocument
 
+from leap.mx.bodycache import BodyCache
 from leap.mx.bounce import bounce_message
+from leap.mx.bounce import bounce_template
 from leap.mx.bounce import InvalidReturnPathError
-
-from leap.mx.vendor.pgpy import PGPKey, PGPMessage
+from leap.mx.compression import CompressionPolicy
+from leap.mx.keycache import KeyCache
+from leap.mx.metrics import RECEIVER_BOUNCES
+from leap.mx.metrics import RECEIVER_BYTES
+from leap.mx.metrics import RECEIVER_MESSAGES
+from leap.mx.metrics import RECEIVER_STAGE_LATENCY
+from leap.mx.metrics import RECEIVER_STALLED
+from leap.mx.metrics import SPOOL_AGE
+from leap.mx.metrics import SPOOL_DEPTH
+
+from leap.mx.vendor.pgpy import PGPMessage
 from leap.mx.vendor.pgpy.errors import PGPEncryptionError
 
 
+"""
+Encryption scheme of documents whose content is the raw OpenPGP packets of
+the encrypted message instead of its ASCII armor.
+"""
+ENC_SCHEME_PUBKEY_BINARY = "pubkey-binary"
+
+"""
+Content type of binary OpenPGP messages sent to the incoming API.
+"""
+BINARY_CONTENT_TYPE = "application/pgp-encrypted"
+
+
+class BinaryCiphertextDocument(ServerDocument):
+    """
+    A document for an incoming message encrypted to binary OpenPGP packets.
+
+    The packets can't be part of the JSON content of a document, so they
+    are kept in the ciphertext attribute and delivered as they are as the
+    body of the incoming API request.
+    """
+
+    def __init__(self, doc_id, ciphertext):
+        ServerDocument.__init__(self, doc_id=doc_id)
+        self.ciphertext = ciphertext
+
+
 class MailReceiver(Service):
     """
     Service that monitors incoming email and processes it.
@@ -77,13 +122,45 @@ class MailReceiver(Service):
     """
     RETRY_DIR_WATCH_DELAY = 60 * 5  # 5 minutes
 
+    """
+    Seconds between walks of the mail directories to count the messages
+    waiting in them.
+    """
+    SPOOL_STATS_INTERVAL = 15
+
     """
     Time delta to keep stalled emails
     """
     MAX_BOUNCE_DELTA = timedelta(days=5)
 
+    """
+    Seconds the encrypted document of a message that couldn't be delivered
+    is reused by other attempts, counted from its encryption. Later attempts
+    look the key up and encrypt the message again.
+    """
+    ENCRYPTED_CACHE_TTL = 2 * PROCESS_SKIPPED_INTERVAL
+
+    """
+    Bytes of encrypted documents kept, the least recently used are
+    forgotten first.
+    """
+    ENCRYPTED_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+    """
+    Reasons for bouncing a message, their bounces are rendered ahead.
+    """
+    MISSING_UUID_REASON = "Missing UUID: There was a problem locating the " \
+                          "user in our database."
+    MISSING_PUBKEY_REASON = "Missing PGP public key: There was a problem " \
+                            "locating the user's public key in our database."
+    SERVER_ERROR_REASON = "There was a problem in the server and the email " \
+                          "could not be delivered."
+
     def __init__(self, users_cdb, directories, bounce_from,
-                 bounce_subject, incoming_api_helper=False):
+                 bounce_subject, incoming_api_helper=False,
+                 binary_ciphertext=False, bounce_transport=None,
+                 bounce_queue=None, max_returned_size=None, key_cache=None,
+                 compression_policy=None, body_cache=None):
         """
         Constructor
 
@@ -99,15 +176,80 @@ class MailReceiver(Service):
 
         :param bounce_subject: Subject line used in the bounced mail
         :type bounce_subject: str
+
+        :param incoming_api_helper: helper to deliver over the Soledad
+                                    incoming API instead of writing to
+                                    CouchDB directly
+        :type incoming_api_helper: SoledadIncomingAPI
+
+        :param binary_ciphertext: deliver raw OpenPGP packets instead of
+                                  ASCII armor, only supported over the
+                                  incoming API
+        :type binary_ciphertext: bool
+
+        :param bounce_transport: how to hand bounces to the MTA, sendmail
+                                 by default
+        :type bounce_transport: leap.mx.bounce_transport.SMTPBounceTransport
+
+        :param bounce_queue: queue coalescing, rate limiting and persisting
+                             bounces, if given bounce_transport is not used
+        :type bounce_queue: leap.mx.bounce.BounceQueue
+
+        :param max_returned_size: size in bytes above which only the
+                                  headers of a message are parsed, and
+                                  returned if it bounces, or None to always
+                                  return the whole message
+        :type max_returned_size: int
+
+        :param key_cache: cache of the parsed public keys, one with the
+                          default limits by default
+        :type key_cache: leap.mx.keycache.KeyCache
+
+        :param compression_policy: decides how messages are compressed
+                                   before being encrypted, one with the
+                                   default limits by default
+        :type compression_policy: leap.mx.compression.CompressionPolicy
+
+        :param body_cache: cache of the bodies of recent messages, shared
+                           by the copies of a message to several
+                           recipients, one with the default limits by
+                           default
+        :type body_cache: leap.mx.bodycache.BodyCache
         """
+        if binary_ciphertext and not incoming_api_helper:
+            raise ValueError(
+                "Binary ciphertext can only be delivered over the incoming "
+                "API")
         # IService doesn't define an __init__
         self._users_cdb = users_cdb
         self._directories = directories
         self._bounce_from = bounce_from
         self._bounce_subject = bounce_subject
+        self._bounce_transport = bounce_transport
+        self._bounce_queue = bounce_queue
+        self._max_returned_size = max_returned_size
+        self._key_cache = key_cache if key_cache is not None else KeyCache()
+        self._compression_policy = compression_policy \
+            if compression_policy is not None else CompressionPolicy()
+        self._body_cache = body_cache if body_cache is not None \
+            else BodyCache()
+        for reason in (self.MISSING_UUID_REASON, self.MISSING_PUBKEY_REASON,
+                       self.SERVER_ERROR_REASON):
+            bounce_template(bounce_from, bounce_subject, reason)
         self._bounce_timestamp = {}
+        self._encrypted = OrderedDict()
+        self._encrypted_bytes = 0
         self._processing_skipped = False
+        self._spool_oldest = {}
+        self._spool_walk = None
         self._incoming_api = incoming_api_helper
+        self._binary_ciphertext = binary_ciphertext
+        self._stage_latency = dict(
+            (stage, RECEIVER_STAGE_LATENCY.labels(stage))
+            for stage in ("lookup", "encrypt", "export", "bounce", "total"))
+        self._outcomes = dict(
+            (outcome, RECEIVER_MESSAGES.labels(outcome))
+            for outcome in ("delivered", "bounced", "stalled"))
 
     def startService(self):
         """
@@ -132,17 +274,109 @@ class MailReceiver(Service):
             signal.SIGUSR1,
             lambda *_: self._process_skipped())
 
+        # walking the spool is too slow to do on every scrape, the age of
+        # the oldest message is computed from the last walk
+        RECEIVER_STALLED.set_function(lambda: len(self._bounce_timestamp))
+        for directory, _ in self._directories:
+            SPOOL_AGE.labels(directory).set_function(
+                lambda d=directory: self._spool_age(d))
+        self._spool_lcall = task.LoopingCall(self._update_spool_stats)
+        self._spool_lcall.start(interval=self.SPOOL_STATS_INTERVAL, now=True)
+
     def stopService(self):
         """
         Stop the MailReceiver service
         """
         self.wm.stopReading()
         self._lcall.stop()
+        self._spool_lcall.stop()
+
+    def _observe(self, stage, started):
+        """
+        Record the time spent in a processing stage.
+
+        :param stage: The name of the stage.
+        :type stage: str
+        :param started: The time the stage started at.
+        :type started: float
+        """
+        self._stage_latency[stage].observe(time.time() - started)
+
+    def _update_spool_stats(self):
+        """
+        Walk the mail directories in a thread, so the reactor isn't blocked
+        when they are full, and update the spool gauges with the result.
+
+        :return: A deferred which fires when the gauges are updated.
+        :rtype: Deferred
+        """
+        if self._spool_walk is not None:
+            # the previous walk is still running
+            return self._spool_walk
+
+        def walk():
+            return [(directory, self._spool_stats(directory, recursive))
+                    for directory, recursive in self._directories]
+
+        def update(stats):
+            for directory, (count, oldest) in stats:
+                SPOOL_DEPTH.labels(directory).set(count)
+                self._spool_oldest[directory] = oldest
+
+        def done(result):
+            self._spool_walk = None
+            return result
+
+        self._spool_walk = threads.deferToThread(walk)
+        self._spool_walk.addCallback(update)
+        self._spool_walk.addErrback(log.err)
+        self._spool_walk.addBoth(done)
+        return self._spool_walk
+
+    def _spool_age(self, directory):
+        """
+        Return the age in seconds of the oldest message found in a directory
+        by the last walk, or 0 if there was none.
+        """
+        oldest = self._spool_oldest.get(directory)
+        if oldest is None:
+            return 0
+        return max(0, time.time() - oldest)
+
+    def _spool_stats(self, directory, recursive):
+        """
+        Count the messages waiting in a directory and find out the
+        modification time of the oldest one.
+
+        :param directory: The directory to inspect.
+        :type directory: str
+        :param recursive: Whether to look into subdirectories.
+        :type recursive: bool
+
+        :return: The number of messages and the modification time of the
+                 oldest one, or None if there are none.
+        :rtype: tuple
+        """
+        count = 0
+        oldest = None
+        for root, dirs, files in os.walk(directory):
+            for fname in files:
+                try:
+                    mtime = os.stat(os.path.join(root, fname)).st_mtime
+                except OSError:
+                    continue  # processed while we were walking
+                count += 1
+                if oldest is None or mtime < oldest:
+                    oldest = mtime
+            if not recursive:
+                break
+        return count, oldest
 
     def _start_watching_dir(self, dirname, recursive):
         """
         Start watching a directory to trigger processing of newly created
-        files.
+        files, either written in place or moved into it once complete, as
+        MTAs delivering to a Maildir do.
 
         Will also add a delayed call to retry when failed for some reason.
         """
@@ -152,7 +386,7 @@ class MailReceiver(Service):
                 raise OSError("Not a directory: '%s'" % directory.path)
             self.wm.watch(
                 directory,
-                inotify.IN_CREATE,
+                inotify.IN_CREATE | inotify.IN_MOVED_TO,
                 callbacks=[self._process_incoming_email],
                 recursive=recursive)
             log.msg("Watching %r --- Recursive: %r" % (directory, recursive))
@@ -185,27 +419,38 @@ class MailReceiver(Service):
                     "I know: %r" % (pubkey,))
             raise Exception('Not valid key')
 
-        doc = ServerDocument(doc_id=str(pyuuid.uuid4()))
+        doc_id = str(pyuuid.uuid4())
+        doc = ServerDocument(doc_id=doc_id)
 
-        # store plain text if pubkey is not available
-        data = {'incoming': True, 'content': message}
-        json_dump = json.dumps(data, ensure_ascii=False)
         try:
-            key, _ = PGPKey.from_blob(pubkey)
+            key = self._key_cache.get_key(pubkey)
             if key.expires_at and key.expires_at < datetime.now():
                 log.msg("_encrypt_message: the key is expired (%s)"
                         % str(key.expires_at))
 
-            message = PGPMessage.new(json_dump)
-            encryption_result = key.encrypt(message)
+            pgp_message = self._new_message(message)
+            encryption_result = key.encrypt(pgp_message)
+            self._compression_policy.observe(pgp_message)
         except (ValueError, PGPEncryptionError) as e:
             log.msg("_encrypt_message: Encryption failed with status: %s"
                     % (e,))
+            # store plain text if pubkey is not available
+            data = {'incoming': True, 'content': message}
             doc.content = {
                 self.INCOMING_KEY: True,
                 self.ERROR_DECRYPTING_KEY: False,
                 ENC_SCHEME_KEY: EncryptionSchemes.NONE,
-                ENC_JSON_KEY: json_dump
+                ENC_JSON_KEY: json.dumps(data, ensure_ascii=False)
+            }
+            return doc
+
+        if self._binary_ciphertext:
+            doc = BinaryCiphertextDocument(
+                doc_id, encryption_result.__bytes__())
+            doc.content = {
+                self.INCOMING_KEY: True,
+                self.ERROR_DECRYPTING_KEY: False,
+                ENC_SCHEME_KEY: ENC_SCHEME_PUBKEY_BINARY,
             }
             return doc
 
@@ -217,6 +462,31 @@ class MailReceiver(Service):
         }
         return doc
 
+    def _new_message(self, message):
+        """
+        Build the OpenPGP message holding the JSON document of an incoming
+        message, whose body is shared with the copies of the message to
+        other recipients, if it's in the body cache.
+
+        :param message: message contents
+        :type message: str
+
+        :rtype: leap.mx.vendor.pgpy.PGPMessage
+        """
+        document = self._body_cache.document(message)
+        if document is not None:
+            chunks, literal_format = document
+            compression, level = self._compression_policy.choose(chunks[-1])
+            return PGPMessage.new(chunks, format=literal_format,
+                                  compression=compression,
+                                  compression_level=level)
+
+        data = {'incoming': True, 'content': message}
+        json_dump = json.dumps(data, ensure_ascii=False)
+        compression, level = self._compression_policy.choose(json_dump)
+        return PGPMessage.new(json_dump, compression=compression,
+                              compression_level=level)
+
     @defer.inlineCallbacks
     def _export_message(self, uuid, doc):
         """
@@ -240,14 +510,140 @@ class MailReceiver(Service):
 
         if self._incoming_api:
             log.msg("Exporting message for %s over Incoming API" % (uuid,))
-            # TODO: Stop using ServerDocument when old code gets deprecated
-            content = doc.content[ENC_JSON_KEY]
-            yield self._incoming_api.put_doc(uuid, doc.doc_id, content)
+            content, content_type, enc_scheme = self._incoming_content(doc)
+            yield self._incoming_api.put_doc(
+                uuid, doc.doc_id, content, content_type=content_type,
+                enc_scheme=enc_scheme)
         else:
             log.msg("Exporting message for %s directly into CouchDB" % (uuid,))
             yield self._users_cdb.put_doc(uuid, doc)
         log.msg("Done exporting")
 
+    def _incoming_content(self, doc):
+        """
+        Return the body, content type and encryption scheme to deliver doc
+        over the incoming API.
+
+        :param doc: ServerDocument that represents the email
+        :type doc: ServerDocument
+
+        :return: The content, its content type and its encryption scheme,
+                 the last two None for armored messages.
+        :rtype: tuple
+        """
+        # TODO: Stop using ServerDocument when old code gets deprecated
+        if isinstance(doc, BinaryCiphertextDocument):
+            return (doc.ciphertext, BINARY_CONTENT_TYPE,
+                    doc.content[ENC_SCHEME_KEY])
+        return doc.content[ENC_JSON_KEY], None, None
+
+    @defer.inlineCallbacks
+    def _export_batch(self, batch):
+        """
+        Deliver the messages prepared while processing skipped mail with as
+        few incoming API requests as possible, and finish processing each
+        of them.
+
+        :param batch: The prepared messages, as (filepath, msg, uuid, doc,
+                      size, started) tuples.
+        :type batch: list of tuple
+        """
+        log.msg("Exporting %d messages over Incoming API" % (len(batch),))
+        docs = []
+        for _, _, uuid, doc, _, _ in batch:
+            content, content_type, enc_scheme = self._incoming_content(doc)
+            docs.append((uuid, doc.doc_id, content, content_type, enc_scheme))
+        stage_started = time.time()
+        errors = yield self._incoming_api.put_docs(docs)
+        # the export stage is accounted per message
+        elapsed = (time.time() - stage_started) / len(batch)
+        for item, error in zip(batch, errors):
+            filepath, msg, _, _, size, started = item
+            self._stage_latency["export"].observe(elapsed)
+            if error is None:
+                yield self._delivered(filepath, size, started)
+            else:
+                yield self._bounce_with_timeout(filepath, msg, error)
+
+    @defer.inlineCallbacks
+    def _delivered(self, filepath, size, started):
+        """
+        Finish processing a delivered message.
+
+        :param filepath: Path for the message
+        :type filepath: twisted.python.filepath.FilePath
+        :param size: Size of the message
+        :type size: int
+        :param started: The time its processing started at
+        :type started: float
+        """
+        yield self._remove(filepath)
+        self._bounce_timestamp.pop(filepath, None)
+        self._forget_doc(filepath)
+        self._outcomes["delivered"].inc()
+        RECEIVER_BYTES.inc(size)
+        self._observe("total", started)
+
+    def _cached_doc(self, filepath):
+        """
+        Return the document a previous attempt encrypted the message at
+        filepath to, unless it was encrypted too long ago.
+
+        :param filepath: Path for the message
+        :type filepath: twisted.python.filepath.FilePath
+
+        :rtype: ServerDocument or None
+        """
+        entry = self._encrypted.pop(filepath, None)
+        if entry is None:
+            return None
+        doc, encrypted_at, size = entry
+        if time.time() - encrypted_at > self.ENCRYPTED_CACHE_TTL:
+            self._encrypted_bytes -= size
+            return None
+        # move it to the end, as the most recently used
+        self._encrypted[filepath] = entry
+        return doc
+
+    def _cache_doc(self, filepath, doc):
+        """
+        Keep the document the message at filepath was encrypted to, for the
+        next attempts to deliver it.
+
+        :param filepath: Path for the message
+        :type filepath: twisted.python.filepath.FilePath
+        :param doc: The encrypted document.
+        :type doc: ServerDocument
+        """
+        self._forget_doc(filepath)
+        if isinstance(doc, BinaryCiphertextDocument):
+            size = len(doc.ciphertext)
+        else:
+            size = len(doc.content.get(ENC_JSON_KEY, ""))
+        self._encrypted[filepath] = (doc, time.time(), size)
+        self._encrypted_bytes += size
+        while self._encrypted_bytes > self.ENCRYPTED_CACHE_MAX_BYTES:
+            _, (_, _, evicted) = self._encrypted.popitem(last=False)
+            self._encrypted_bytes -= evicted
+
+    def _forget_doc(self, filepath):
+        """
+        Forget the encrypted document of the message at filepath, if any.
+        """
+        entry = self._encrypted.pop(filepath, None)
+        if entry is not None:
+            self._encrypted_bytes -= entry[2]
+
+    def _expire_encrypted(self):
+        """
+        Forget the encrypted documents that were encrypted too long ago, like
+        the ones of messages removed from the spool by someone else.
+        """
+        now = time.time()
+        for filepath, (_, encrypted_at, _) in self._encrypted.items():
+            if now - encrypted_at > self.ENCRYPTED_CACHE_TTL:
+                self._forget_doc(filepath)
+
     def _remove(self, filepath):
         """
         Removes the message.
@@ -298,14 +694,45 @@ class MailReceiver(Service):
         :param reason: Brief explanation about why it's being bounced
         :type reason: str
         """
+        started = time.time()
+        headers_only = self._headers_only(filepath.getsize())
         try:
-            yield bounce_message(
-                self._bounce_from, self._bounce_subject, orig_msg, reason)
+            if self._bounce_queue is not None:
+                yield self._bounce_queue.bounce(
+                    orig_msg, reason, headers_only)
+            else:
+                yield bounce_message(
+                    self._bounce_from, self._bounce_subject, orig_msg,
+                    reason, transport=self._bounce_transport,
+                    headers_only=headers_only)
+            RECEIVER_BOUNCES.inc()
         except InvalidReturnPathError:
             # give up bouncing this message!
             log.msg("Will not bounce message because of invalid return path.")
+        self._observe("bounce", started)
+        self._outcomes["bounced"].inc()
+        self._forget_doc(filepath)
         yield self._remove(filepath)
 
+    def _headers_only(self, size):
+        """
+        Whether only the headers of a message of size bytes are parsed and
+        returned in bounces.
+        """
+        return self._max_returned_size is not None and \
+            size > self._max_returned_size
+
+    def _parse(self, mail_data):
+        """
+        Parse a message, only its headers if it's too large to be returned
+        whole in a bounce, as they are all that's needed otherwise.
+
+        :rtype: email.message.Message
+        """
+        if self._headers_only(len(mail_data)):
+            return HeaderParser().parsestr(mail_data)
+        return message_from_string(mail_data)
+
     def sleep(self, secs):
         """
         Async sleep for a defer. Use this when you want to wait for
@@ -335,6 +762,12 @@ class MailReceiver(Service):
         try:
             log.msg("Starting processing skipped mail...")
             log.msg("-" * 50)
+            self._expire_encrypted()
+
+            # deliver the backlog in batches if the incoming api can
+            batch = None
+            if self._incoming_api and self._incoming_api.batching:
+                batch = []
 
             for directory, recursive in self._directories:
                 for root, dirs, files in os.walk(directory):
@@ -342,13 +775,20 @@ class MailReceiver(Service):
                         try:
                             fullpath = os.path.join(root, fname)
                             fpath = filepath.FilePath(fullpath)
-                            yield self._step_process_mail_backend(fpath)
+                            yield self._step_process_mail_backend(
+                                fpath, batch)
                         except Exception:
                             log.msg("Error processing skipped mail: %r" %
                                     (fullpath,))
                             log.err()
+                        if batch and \
+                                len(batch) >= self._incoming_api.batch_size:
+                            pending, batch = batch, []
+                            yield self._export_batch(pending)
                     if not recursive:
                         break
+            if batch:
+                yield self._export_batch(batch)
         except Exception:
             log.msg("Error processing skipped mail")
             log.err()
@@ -359,7 +799,7 @@ class MailReceiver(Service):
         log.msg("Done processing skipped mail")
 
     @defer.inlineCallbacks
-    def _step_process_mail_backend(self, filepath):
+    def _step_process_mail_backend(self, filepath, batch=None):
         """
         Processes the email pointed by filepath in an async
         fashion. yield this method in another inlineCallbacks method
@@ -367,45 +807,78 @@ class MailReceiver(Service):
 
         :param filepath: Path of the file that changed
         :type filepath: twisted.python.filepath.FilePath
+        :param batch: If given, the encrypted message is added to it to be
+                      exported later with _export_batch() instead of being
+                      exported right away.
+        :type batch: list
         """
         log.msg("Processing new mail at %r" % (filepath.path,))
+        started = time.time()
         with filepath.open("r") as f:
             mail_data = f.read()
-            msg = message_from_string(mail_data)
+            msg = self._parse(mail_data)
             uuid = self._get_owner(msg)
             if uuid is None:
                 log.msg("Don't know how to deliver mail %r, skipping..." %
                         (filepath.path,))
-                bounce_reason = "Missing UUID: There was a problem " \
-                                "locating the user in our database."
-                yield self._bounce_message(msg, filepath, bounce_reason)
+                yield self._bounce_message(
+                    msg, filepath, self.MISSING_UUID_REASON)
                 defer.returnValue(None)
             log.msg("Mail owner: %s" % (uuid,))
 
+            doc = self._cached_doc(filepath)
+            if doc is not None:
+                log.msg("Reusing the encrypted document %s" % (doc.doc_id,))
+                yield self._export_encrypted(
+                    filepath, msg, uuid, doc, len(mail_data), started, batch)
+                defer.returnValue(None)
+
+            stage_started = time.time()
             pubkey = yield self._users_cdb.getPubkey(uuid)
+            self._observe("lookup", stage_started)
             if pubkey is None or len(pubkey) == 0:
                 log.msg(
                     "No public key for %s, stopping the processing chain."
                     % uuid)
-                bounce_reason = "Missing PGP public key: There was a " \
-                                "problem locating the user's public key in " \
-                                "our database."
-                yield self._bounce_message(msg, filepath, bounce_reason)
+                yield self._bounce_message(
+                    msg, filepath, self.MISSING_PUBKEY_REASON)
                 defer.returnValue(None)
 
             log.msg("Encrypting message to %s's pubkey" % (uuid,))
             try:
+                stage_started = time.time()
                 doc = yield self._encrypt_message(pubkey, mail_data)
-
-                yield self._export_message(uuid, doc)
-                yield self._remove(filepath)
+                self._observe("encrypt", stage_started)
             except Exception as e:
                 yield self._bounce_with_timeout(filepath, msg, e)
+                defer.returnValue(None)
+            self._cache_doc(filepath, doc)
+            yield self._export_encrypted(
+                filepath, msg, uuid, doc, len(mail_data), started, batch)
+
+    @defer.inlineCallbacks
+    def _export_encrypted(self, filepath, msg, uuid, doc, size, started,
+                          batch=None):
+        """
+        Export an encrypted message, or add it to batch to be exported
+        later.
+        """
+        if batch is not None:
+            batch.append((filepath, msg, uuid, doc, size, started))
+            defer.returnValue(None)
+        try:
+            stage_started = time.time()
+            yield self._export_message(uuid, doc)
+            self._observe("export", stage_started)
+            yield self._delivered(filepath, size, started)
+        except Exception as e:
+            yield self._bounce_with_timeout(filepath, msg, e)
 
     @defer.inlineCallbacks
     def _bounce_with_timeout(self, filepath, msg, error):
         if filepath not in self._bounce_timestamp:
             self._bounce_timestamp[filepath] = datetime.now()
+            self._outcomes["stalled"].inc()
             log.msg("New stalled email {0!r}: {1!r}".format(filepath, error))
             defer.returnValue(None)
 
@@ -413,9 +886,9 @@ class MailReceiver(Service):
         if current_delta > self.MAX_BOUNCE_DELTA:
             log.msg("Bouncing stalled email {0!r}: {1!r}"
                     .format(filepath, error))
-            bounce_reason = "There was a problem in the server and the " \
-                            "email could not be delivered."
-            yield self._bounce_message(msg, filepath, bounce_reason)
+            yield self._bounce_message(
+                msg, filepath, self.SERVER_ERROR_REASON)
+            del self._bounce_timestamp[filepath]
         else:
             log.msg("Still stalled email {0!r} for the last {1}: {2!r}"
                     .format(filepath, str(current_delta), error))
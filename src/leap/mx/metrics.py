@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# metrics.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Metrics for leap.mx in the Prometheus text exposition format.
+
+Metrics are module level objects that hold one child per combination of
+label values. Code that updates a metric on a hot path should fetch its
+child once with labels() and keep it, so updating the metric is just an
+increment of a preallocated value. Gauges that describe state, like the
+number of stalled messages, are computed by a function when the metrics
+are scraped. The spool depth is too slow to compute on every scrape, and
+is updated periodically instead.
+
+The MetricsResource renders the registry and can be served with
+twisted.web, see pkg/mx.tac.
+"""
+
+from bisect import bisect_left
+
+from twisted.web import resource
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+"""
+Default latency buckets, in seconds.
+"""
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+"""
+Buckets for the ratio of compressed to original sizes.
+"""
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace(
+        "\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (name, _escape(value))
+             for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append('%s="%s"' % extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(pairs)
+
+
+class Registry(object):
+    """
+    A collection of metrics rendered together.
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        """
+        Add a metric to the registry.
+
+        :param metric: The metric.
+        :type metric: Metric
+
+        :return: The metric.
+        :rtype: Metric
+        """
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Render every registered metric.
+
+        :return: The metrics in the text exposition format.
+        :rtype: str
+        """
+        lines = []
+        for metric in self._metrics:
+            metric.render(lines)
+        lines.append("")
+        return "\n".join(lines)
+
+
+REGISTRY = Registry()
+
+
+class Metric(object):
+    """
+    Base class for metrics with optional labels.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(),
+                 registry=REGISTRY):
+        """
+        Initialize the metric and add it to registry.
+
+        :param name: The metric name.
+        :type name: str
+        :param documentation: A one line description of the metric.
+        :type documentation: str
+        :param labelnames: The names of the labels of the metric.
+        :type labelnames: tuple of str
+        :param registry: The registry to add the metric to, or None.
+        :type registry: Registry
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+        if registry is not None:
+            registry.register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """
+        Return the child for the given label values, creating it the first
+        time it's asked for.
+
+        :return: The child holding the values for these labels.
+        """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError("Expected label values for %r"
+                                 % (self.labelnames,))
+            child = self._children[values] = self._new_child()
+        return child
+
+    def render(self, lines):
+        """
+        Append the lines for this metric to lines.
+
+        :param lines: The lines rendered so far.
+        :type lines: list of str
+        """
+        lines.append("# HELP %s %s" % (self.name, self.documentation))
+        lines.append("# TYPE %s %s" % (self.name, self.kind))
+        for values in sorted(self._children):
+            self._render_child(
+                lines, values, self._children[values])
+
+    def _render_child(self, lines, values, child):
+        lines.append("%s%s %s" % (
+            self.name, _format_labels(self.labelnames, values),
+            _format_value(child.get())))
+
+
+class _Value(object):
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def get(self):
+        return self.value
+
+
+class Counter(Metric):
+    """
+    A monotonically increasing count.
+    """
+
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        """
+        Increment the counter of a metric without labels.
+        """
+        self._children[()].inc(amount)
+
+
+class _GaugeValue(_Value):
+
+    __slots__ = ("function",)
+
+    def __init__(self):
+        _Value.__init__(self)
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, function):
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class Gauge(Metric):
+    """
+    A value that can go up and down, or that is computed by a function
+    every time the metrics are rendered.
+    """
+
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeValue()
+
+    def set(self, value):
+        """
+        Set the value of a gauge without labels.
+        """
+        self._children[()].set(value)
+
+    def set_function(self, function):
+        """
+        Compute the value of a gauge without labels with function.
+        """
+        self._children[()].set_function(function)
+
+
+class _HistogramValue(object):
+
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(Metric):
+    """
+    Counts of observations in cumulative buckets, plus their sum.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        """
+        Initialize the histogram.
+
+        :param buckets: The upper bounds of the buckets, the +Inf bucket is
+                        implicit.
+        :type buckets: tuple of float
+        """
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        Metric.__init__(self, name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        """
+        Observe a value in a histogram without labels.
+        """
+        self._children[()].observe(value)
+
+    def _render_child(self, lines, values, child):
+        labels = self.labelnames
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),),
+                                child.counts):
+            cumulative += count
+            lines.append("%s_bucket%s %d" % (
+                self.name,
+                _format_labels(labels, values,
+                               ("le", _format_value(bound))),
+                cumulative))
+        lines.append("%s_sum%s %s" % (
+            self.name, _format_labels(labels, values),
+            _format_value(child.sum)))
+        lines.append("%s_count%s %d" % (
+            self.name, _format_labels(labels, values), cumulative))
+
+
+class MetricsResource(resource.Resource):
+    """
+    A twisted.web resource that renders a registry.
+    """
+
+    isLeaf = True
+
+    def __init__(self, registry=REGISTRY):
+        resource.Resource.__init__(self)
+        self._registry = registry
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", CONTENT_TYPE)
+        return self._registry.render()
+
+
+# tcp maps
+
+MAP_QUERIES = Counter(
+    "leap_mx_map_queries_total",
+    "Lookups received by the tcp maps.",
+    ("map",))
+
+MAP_RESULTS = Counter(
+    "leap_mx_map_results_total",
+    "Replies sent by the tcp maps, by tcp_table code.",
+    ("map", "code"))
+
+MAP_LATENCY = Histogram(
+    "leap_mx_map_query_seconds",
+    "Time taken to answer tcp map lookups.",
+    ("map",))
+
+# couchdb
+
+COUCHDB_LATENCY = Histogram(
+    "leap_mx_couchdb_request_seconds",
+    "Latency of CouchDB requests, by view.",
+    ("view",))
+
+COUCHDB_ERRORS = Counter(
+    "leap_mx_couchdb_errors_total",
+    "CouchDB requests that failed, by view.",
+    ("view",))
+
+# mail receiver
+
+RECEIVER_STAGE_LATENCY = Histogram(
+    "leap_mx_receiver_stage_seconds",
+    "Time spent in each stage of processing an incoming message.",
+    ("stage",))
+
+RECEIVER_MESSAGES = Counter(
+    "leap_mx_receiver_messages_total",
+    "Incoming messages processed, by outcome.",
+    ("outcome",))
+
+RECEIVER_BYTES = Counter(
+    "leap_mx_receiver_bytes_total",
+    "Bytes of incoming messages delivered.")
+
+RECEIVER_BOUNCES = Counter(
+    "leap_mx_receiver_bounces_total",
+    "Messages bounced back to their senders.")
+
+RECEIVER_STALLED = Gauge(
+    "leap_mx_receiver_stalled_messages",
+    "Messages that failed to be delivered and are waiting to be retried.")
+
+KEY_CACHE_LOOKUPS = Counter(
+    "leap_mx_key_cache_lookups_total",
+    "Public keys looked up in the parsed key cache, by result: hit or "
+    "miss.",
+    ("result",))
+
+KEY_CACHE_EVICTIONS = Counter(
+    "leap_mx_key_cache_evictions_total",
+    "Parsed public keys evicted from the cache to make room for others.")
+
+KEY_CACHE_KEYS = Gauge(
+    "leap_mx_key_cache_keys",
+    "Parsed public keys held in the cache.")
+
+BODY_CACHE_LOOKUPS = Counter(
+    "leap_mx_body_cache_lookups_total",
+    "Bodies of messages looked up in the cache of bodies shared by several "
+    "recipients, by result: hit or miss.",
+    ("result",))
+
+BODY_CACHE_BYTES = Gauge(
+    "leap_mx_body_cache_bytes",
+    "Size of the message bodies held in the cache.")
+
+COMPRESSION_MESSAGES = Counter(
+    "leap_mx_compression_messages_total",
+    "Messages encrypted, by compression decision: compressed, or not "
+    "because they are small or their samples are incompressible.",
+    ("decision",))
+
+COMPRESSION_SAMPLE_RATIO = Histogram(
+    "leap_mx_compression_sample_ratio",
+    "Compressed to original size ratio of the samples of the messages "
+    "large enough to be compressed.",
+    buckets=RATIO_BUCKETS)
+
+COMPRESSION_SAMPLE_SECONDS = Histogram(
+    "leap_mx_compression_sample_seconds",
+    "Time taken to compress the samples of a message.")
+
+COMPRESSION_RATIO = Histogram(
+    "leap_mx_compression_ratio",
+    "Compressed to original size ratio of the messages compressed, by "
+    "level.",
+    ("level",),
+    buckets=RATIO_BUCKETS)
+
+COMPRESSION_SECONDS = Histogram(
+    "leap_mx_compression_seconds",
+    "Time taken to compress messages, by level.",
+    ("level",))
+
+COMPRESSION_BYTES = Counter(
+    "leap_mx_compression_bytes_total",
+    "Size of the messages compressed, by level and stage: original or "
+    "compressed.",
+    ("level", "stage"))
+
+BOUNCE_QUEUE_MESSAGES = Counter(
+    "leap_mx_bounce_queue_messages_total",
+    "Bounced messages going through the bounce queue, by event: queued, "
+    "coalesced into a pending report, sent, delayed by the rate limits, "
+    "failed to be sent and queued again, or dropped.",
+    ("event",))
+
+BOUNCE_TRANSPORT_MESSAGES = Counter(
+    "leap_mx_bounce_transport_messages_total",
+    "Bounces handed to the MTA, by transport.",
+    ("transport",))
+
+BOUNCE_SMTP_CONNECTIONS = Counter(
+    "leap_mx_bounce_smtp_connections_total",
+    "Connections opened to the MTA to send bounces.")
+
+SPOOL_DEPTH = Gauge(
+    "leap_mx_spool_messages",
+    "Messages waiting in a watched mail directory.",
+    ("directory",))
+
+SPOOL_AGE = Gauge(
+    "leap_mx_spool_oldest_message_seconds",
+    "Age of the oldest message waiting in a watched mail directory.",
+    ("directory",))
+
+# soledad incoming api
+
+INCOMING_API_REQUESTS = Counter(
+    "leap_mx_incoming_api_requests_total",
+    "Requests made to the Soledad incoming API.")
+
+INCOMING_API_CONNECTIONS = Counter(
+    "leap_mx_incoming_api_connections_total",
+    "Connections opened to the Soledad incoming API.")
+
+INCOMING_API_RETRIES = Counter(
+    "leap_mx_incoming_api_retries_total",
+    "Requests retried after the connection to the incoming API was lost.")
+
+INCOMING_API_IDLE_CONNECTIONS = Gauge(
+    "leap_mx_incoming_api_idle_connections",
+    "Idle connections to the Soledad incoming API kept in the pool.")
+
+# exporters
+
+EXPORT_RETRIES = Counter(
+    "leap_mx_export_retries_total",
+    "Deliveries retried after a transient failure, by exporter.",
+    ("exporter",))
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# retry.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Retries with bounded exponential backoff.
+
+The exporters use it to ride out short outages of the incoming API or of
+CouchDB without giving up on a message, which would leave it stalled until
+the next processing of skipped mail. Only failures the exporter considers
+transient are retried, and the caller is expected to make the operation
+idempotent, by delivering the same doc_id every time.
+"""
+
+from twisted.internet import defer, reactor, task
+from twisted.python import log
+
+
+class Backoff(object):
+    """
+    A bounded exponential backoff policy.
+    """
+
+    def __init__(self, retries=3, initial=0.5, maximum=10.0, factor=2.0):
+        """
+        :param retries: How many times to retry after the first attempt, 0
+                        disables retries.
+        :type retries: int
+        :param initial: Seconds to wait before the first retry.
+        :type initial: float
+        :param maximum: Maximum number of seconds to wait between attempts.
+        :type maximum: float
+        :param factor: How much the delay grows after each retry.
+        :type factor: float
+        """
+        self.retries = retries
+        self.initial = float(initial)
+        self.maximum = float(maximum)
+        self.factor = float(factor)
+
+    def delays(self):
+        """
+        Return the seconds to wait before each retry.
+
+        :rtype: list of float
+        """
+        delays = []
+        delay = self.initial
+        for _ in xrange(self.retries):
+            delays.append(min(delay, self.maximum))
+            delay *= self.factor
+        return delays
+
+
+"""
+The policy used when an exporter isn't given one.
+"""
+DEFAULT_BACKOFF = Backoff()
+
+
+@defer.inlineCallbacks
+def retry(f, transient, backoff=DEFAULT_BACKOFF, counter=None,
+          clock=reactor):
+    """
+    Call f until it succeeds, it fails with an error that isn't transient or
+    the retries of backoff are exhausted.
+
+    :param f: A callable returning a deferred or a value.
+    :type f: callable
+    :param transient: Tells whether an exception is worth retrying.
+    :type transient: callable
+    :param backoff: The delays between attempts.
+    :type backoff: Backoff
+    :param counter: A metric incremented on every retry.
+    :type counter: leap.mx.metrics.Counter
+    :param clock: The reactor used to wait between attempts.
+    :type clock: twisted.internet.interfaces.IReactorTime
+
+    :return: A deferred which fires with the result of the last attempt, or
+             fails with its error.
+    :rtype: Deferred
+    """
+    delays = backoff.delays()
+    attempt = 0
+    while True:
+        try:
+            result = yield defer.maybeDeferred(f)
+            defer.returnValue(result)
+        except Exception as e:
+            if attempt >= len(delays) or not transient(e):
+                raise
+            delay = delays[attempt]
+            attempt += 1
+            log.msg("Transient failure, retry %d of %d in %.1fs: %r"
+                    % (attempt, len(delays), delay, e))
+            if counter is not None:
+                counter.inc()
+            yield task.deferLater(clock, delay, lambda: None)
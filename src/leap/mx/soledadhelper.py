@@ -23,9 +23,27 @@ See: http://soledad.readthedocs.io/en/latest/incoming_box.html
 
 
 import base64
-import treq
-from io import BytesIO
-from twisted.internet import defer
+import json
+
+from treq.client import HTTPClient
+from twisted.internet import defer, reactor
+from twisted.internet.error import ConnectError, TimeoutError
+from twisted.python import log
+from twisted.web.client import Agent
+from twisted.web.client import FileBodyProducer
+from twisted.web.client import HTTPConnectionPool
+from twisted.web.client import RequestNotSent
+from twisted.web.client import RequestTransmissionFailed
+from twisted.web.client import ResponseNeverReceived
+from twisted.web.iweb import IBodyProducer
+from zope.interface import implements
+
+from leap.mx.metrics import EXPORT_RETRIES
+from leap.mx.metrics import INCOMING_API_CONNECTIONS
+from leap.mx.metrics import INCOMING_API_IDLE_CONNECTIONS
+from leap.mx.metrics import INCOMING_API_REQUESTS
+from leap.mx.metrics import INCOMING_API_RETRIES
+from leap.mx.retry import Backoff, DEFAULT_BACKOFF, retry
 
 try:
     from six import raise_from
@@ -35,15 +53,154 @@ except ImportError:
 
 
 class UnavailableIncomingAPIException(Exception):
+
+    def __init__(self, message, transient=True):
+        """
+        :param message: What went wrong.
+        :type message: str
+        :param transient: Whether trying again later may succeed.
+        :type transient: bool
+        """
+        Exception.__init__(self, message)
+        self.transient = transient
+
+
+def _is_transient(error):
+    return getattr(error, "transient", False)
+
+
+def _transient_status(code):
+    """
+    Whether a response with this status may succeed if tried again.
+    """
+    return code >= 500 or code in (408, 429)
+
+
+class _BatchNotSupported(Exception):
     pass
 
 
+"""
+Header of single requests naming the encryption scheme of the content, for
+content that isn't an armored message.
+"""
+ENC_SCHEME_HEADER = "X-Enc-Scheme"
+
+
+class StringBodyProducer(object):
+    """
+    A body producer that writes a string as it is, without copying it into
+    a buffer first.
+    """
+    implements(IBodyProducer)
+
+    def __init__(self, data):
+        """
+        :param data: The request body.
+        :type data: str
+        """
+        self._data = data
+        self.length = len(data)
+
+    def startProducing(self, consumer):
+        consumer.write(self._data)
+        return defer.succeed(None)
+
+    def pauseProducing(self):
+        pass
+
+    def resumeProducing(self):
+        pass
+
+    def stopProducing(self):
+        pass
+
+
+class _KeepOpen(object):
+    """
+    A file wrapper that ignores close(), so FileBodyProducer doesn't close
+    files that belong to the caller and may be sent again.
+    """
+
+    def __init__(self, f):
+        self._f = f
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+    def close(self):
+        pass
+
+
+class _CountingConnectionPool(HTTPConnectionPool):
+    """
+    An HTTPConnectionPool that keeps statistics about its connections.
+    """
+
+    def __init__(self, reactor, persistent=True):
+        HTTPConnectionPool.__init__(self, reactor, persistent)
+        self.requests = 0
+        self.new_connections = 0
+
+    def getConnection(self, key, endpoint):
+        self.requests += 1
+        INCOMING_API_REQUESTS.inc()
+        return HTTPConnectionPool.getConnection(self, key, endpoint)
+
+    def _newConnection(self, key, endpoint):
+        self.new_connections += 1
+        INCOMING_API_CONNECTIONS.inc()
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+    @property
+    def idle_connections(self):
+        return sum(len(c) for c in self._connections.values())
+
+
 class SoledadIncomingAPI:
     """
     Delivers messages using Soledad Incoming API.
+
+    Requests are made over persistent connections kept in a pool owned by
+    the helper, so delivering a message doesn't need a new TCP connection
+    (and a new TLS handshake when stunnel is in between). A PUT that fails
+    because the server closed a cached connection is retried on a fresh
+    one, as delivering the same doc_id twice is harmless. Other transient
+    failures, like a refused connection, a timeout or a 5xx response, are
+    retried in place following the backoff policy.
+
+    When batch_size is bigger than one, put_docs() delivers several messages
+    in a single POST to the _batch endpoint::
+
+        {"docs": [{"user": <uuid>, "doc_id": <doc_id>, "content": <str>,
+                   "content_type": <str>, "enc_scheme": <str>,
+                   "encoding": "base64"}, ...]}
+
+    content_type and enc_scheme are only there for content that isn't an
+    armored message, and such content is base64 encoded. Single requests
+    send them as the Content-Type and X-Enc-Scheme headers. The response
+    has the status of each document, in the same order::
+
+        {"results": [{"doc_id": <doc_id>, "status": 200}, ...]}
+
+    If the server doesn't know about the endpoint the helper falls back to
+    single PUTs for good.
     """
 
-    def __init__(self, host, port, token):
+    """
+    Times a PUT is retried when the connection is lost before a response
+    arrives.
+    """
+    CONNECTION_RETRIES = 1
+
+    """
+    HTTP status codes meaning the server has no batch endpoint.
+    """
+    BATCH_NOT_SUPPORTED_CODES = (404, 405, 501)
+
+    def __init__(self, host, port, token, max_persistent=2,
+                 idle_timeout=240, connect_timeout=30, batch_size=1,
+                 backoff=DEFAULT_BACKOFF, reactor=reactor):
         """
         Creates a SoledadIncomingAPI helper to deliver messages into user's
         database.
@@ -56,39 +213,273 @@ class SoledadIncomingAPI:
         :param token: Incoming service authentication token as configured in
             Soledad.
         :type token: str
+        :param max_persistent: Maximum number of idle connections kept open
+            to the incoming service.
+        :type max_persistent: int
+        :param idle_timeout: Seconds an idle connection is kept open.
+        :type idle_timeout: float
+        :param connect_timeout: Seconds to wait for a new connection to be
+            established.
+        :type connect_timeout: float
+        :param batch_size: Maximum number of messages to deliver in a single
+            request, 1 disables batches.
+        :type batch_size: int
+        :param backoff: How to retry requests that failed with a transient
+            error.
+        :type backoff: leap.mx.retry.Backoff
         """
         self._incoming_url = "http://%s:%s/incoming/" % (host, port)
         b64_token = base64.b64encode(token)
         self._auth_header = {'Authorization': ['Token %s' % b64_token]}
+        self._pool = _CountingConnectionPool(reactor, persistent=True)
+        self._pool.maxPersistentPerHost = max_persistent
+        self._pool.cachedConnectionTimeout = idle_timeout
+        self._client = HTTPClient(
+            Agent(reactor, connectTimeout=connect_timeout, pool=self._pool))
+        self._retries = 0
+        self._backoff = backoff
+        self._reactor = reactor
+        self._export_retries = EXPORT_RETRIES.labels("incoming_api")
+        self.batch_size = batch_size
+        self._batch_supported = batch_size > 1
+        INCOMING_API_IDLE_CONNECTIONS.set_function(
+            lambda: self._pool.idle_connections)
 
-    @defer.inlineCallbacks
-    def put_doc(self, uuid, doc_id, content):
+    def stats(self):
+        """
+        Return statistics about the connections to the incoming service.
+
+        :return: The number of requests made, connections opened, requests
+                 retried after losing their connection and connections
+                 currently idle in the pool.
+        :rtype: dict
+        """
+        return {
+            "requests": self._pool.requests,
+            "new_connections": self._pool.new_connections,
+            "reused_connections":
+                self._pool.requests - self._pool.new_connections,
+            "retries": self._retries,
+            "idle_connections": self._pool.idle_connections,
+        }
+
+    def close(self):
+        """
+        Close the idle connections in the pool.
+
+        :return: A deferred which fires when the connections are closed.
+        :rtype: Deferred
+        """
+        return self._pool.closeCachedConnections()
+
+    def _body(self, content, start):
+        """
+        Return a body producer for content, rewinding files to start so the
+        body can be sent again.
+        """
+        if IBodyProducer.providedBy(content):
+            return content
+        if hasattr(content, "read"):
+            content.seek(start)
+            return FileBodyProducer(_KeepOpen(content))
+        return StringBodyProducer(str(content))
+
+    def put_doc(self, uuid, doc_id, content, content_type=None,
+                enc_scheme=None):
         """
         Make a PUT request to Soledad's incoming API, delivering a message into
         user's database.
 
+        The content is streamed to the connection with its length known in
+        advance, so it is not copied into another buffer. A file is sent from
+        its current position to its end and is not closed. A body producer
+        is sent as it is, but can't be retried if the connection is lost.
+        Transient failures are retried with the same doc_id, so the message
+        is never delivered twice.
+
         :param uuid: The uuid of a user
         :type uuid: str
         :param content: Message content.
-        :type content: str
+        :type content: str, file or twisted.web.iweb.IBodyProducer
+        :param content_type: The Content-Type of the content, if it's not the
+            armored message.
+        :type content_type: str
+        :param enc_scheme: The encryption scheme the server stores for the
+            document, if the content is not the armored message.
+        :type enc_scheme: str
 
         :return: A deferred which fires after the HTTP request is complete, or
                  which fails with the correspondent exception if there was any
                  error.
         """
         url = self._incoming_url + "%s/%s" % (uuid, doc_id)
+        headers = self._auth_header
+        if content_type is not None:
+            headers = dict(headers, **{'Content-Type': [content_type]})
+        if enc_scheme is not None:
+            headers = dict(headers, **{ENC_SCHEME_HEADER: [enc_scheme]})
+        retries = self.CONNECTION_RETRIES
+        backoff = self._backoff
+        start = None
+        if IBodyProducer.providedBy(content):
+            retries = 0
+            backoff = Backoff(retries=0)
+        elif hasattr(content, "read"):
+            start = content.tell()
+        return retry(
+            lambda: self._put_doc(url, headers, content, start, retries),
+            _is_transient, backoff, self._export_retries, self._reactor)
+
+    @defer.inlineCallbacks
+    def _put_doc(self, url, headers, content, start, retries):
+        """
+        Make a single attempt at the PUT request of put_doc(), retrying
+        right away only if a pooled connection turns out to be closed.
+        """
+        attempt = 0
+        try:
+            while True:
+                try:
+                    response = yield self._client.put(
+                        url,
+                        self._body(content, start),
+                        headers=headers)
+                    break
+                except (ResponseNeverReceived, RequestNotSent,
+                        RequestTransmissionFailed):
+                    # the server closed the connection we picked from the
+                    # pool, the PUT is idempotent so try a fresh one
+                    if attempt >= retries:
+                        raise
+                    attempt += 1
+                    self._retries += 1
+                    INCOMING_API_RETRIES.inc()
+            # the body must be read for the connection to go back to the pool
+            yield response.content()
+        except Exception as original_exception:
+            raise_from(self._unavailable(original_exception),
+                       original_exception)
+        if not response.code == 200:
+            error_message = '%s returned status %s instead of 200'
+            error_message %= (url, response.code)
+            raise UnavailableIncomingAPIException(
+                error_message, transient=_transient_status(response.code))
+
+    def _unavailable(self, original_exception):
+        """
+        Wrap an error raised while making a request.
+        """
+        error_message = "Server unreacheable or unknown error: %s"
+        error_message %= (original_exception.message)
+        transient = isinstance(original_exception, (
+            ConnectError, TimeoutError, defer.CancelledError,
+            ResponseNeverReceived, RequestNotSent, RequestTransmissionFailed))
+        return UnavailableIncomingAPIException(
+            error_message, transient=transient)
+
+    @property
+    def batching(self):
+        """
+        Whether put_docs() will deliver in batches.
+
+        :rtype: bool
+        """
+        return self._batch_supported
+
+    @defer.inlineCallbacks
+    def put_docs(self, docs):
+        """
+        Deliver several messages, in a single request if the server supports
+        it or with one PUT each, one after another, otherwise.
+
+        :param docs: The messages, as (uuid, doc_id, content, content_type,
+            enc_scheme) tuples, where content is a str and content_type and
+            enc_scheme are None for armored messages.
+        :type docs: list of tuple
+
+        :return: A deferred which fires with a list that has, for each
+            message, None if it was delivered or the exception that
+            prevented it.
+        :rtype: Deferred
+        """
+        if self._batch_supported and len(docs) > 1:
+            try:
+                results = yield retry(
+                    lambda: self._put_batch(docs), _is_transient,
+                    self._backoff, self._export_retries, self._reactor)
+                defer.returnValue(results)
+            except _BatchNotSupported:
+                log.msg("The incoming API has no batch endpoint, falling "
+                        "back to single requests")
+                self._batch_supported = False
+            except Exception as e:
+                defer.returnValue([e] * len(docs))
+
+        # one at a time, a server without batches gets no more load than
+        # when batches are disabled
+        results = []
+        for uuid, doc_id, content, content_type, enc_scheme in docs:
+            try:
+                yield self.put_doc(uuid, doc_id, content,
+                                   content_type=content_type,
+                                   enc_scheme=enc_scheme)
+                results.append(None)
+            except Exception as e:
+                results.append(e)
+        defer.returnValue(results)
+
+    @defer.inlineCallbacks
+    def _put_batch(self, docs):
+        """
+        Deliver several messages in a single request to the batch endpoint.
+        """
+        items = []
+        for uuid, doc_id, content, content_type, enc_scheme in docs:
+            item = {"user": uuid, "doc_id": doc_id}
+            if content_type is None:
+                item["content"] = content
+            else:
+                item["content"] = base64.b64encode(content)
+                item["content_type"] = content_type
+                item["encoding"] = "base64"
+            if enc_scheme is not None:
+                item["enc_scheme"] = enc_scheme
+            items.append(item)
+        url = self._incoming_url + "_batch"
+        headers = dict(self._auth_header,
+                       **{'Content-Type': ['application/json']})
         try:
-            response = yield treq.put(
+            response = yield self._client.post(
                 url,
-                BytesIO(str(content)),
-                headers=self._auth_header,
-                persistent=False)
+                StringBodyProducer(json.dumps({"docs": items})),
+                headers=headers)
+            body = yield response.content()
         except Exception as original_exception:
-            error_message = "Server unreacheable or unknown error: %s"
-            error_message %= (original_exception.message)
-            our_exception = UnavailableIncomingAPIException(error_message)
-            raise_from(our_exception, original_exception)
+            raise_from(self._unavailable(original_exception),
+                       original_exception)
+        if response.code in self.BATCH_NOT_SUPPORTED_CODES:
+            raise _BatchNotSupported()
         if not response.code == 200:
             error_message = '%s returned status %s instead of 200'
             error_message %= (url, response.code)
-            raise UnavailableIncomingAPIException(error_message)
+            raise UnavailableIncomingAPIException(
+                error_message, transient=_transient_status(response.code))
+
+        statuses = {}
+        try:
+            for result in json.loads(body)["results"]:
+                statuses[result["doc_id"]] = result["status"]
+        except (ValueError, KeyError, TypeError):
+            raise UnavailableIncomingAPIException(
+                "%s returned an invalid response" % (url,))
+        results = []
+        for uuid, doc_id, _, _, _ in docs:
+            status = statuses.get(doc_id)
+            if status == 200:
+                results.append(None)
+            else:
+                results.append(UnavailableIncomingAPIException(
+                    "%s returned status %s for %s/%s"
+                    % (url, status, uuid, doc_id),
+                    transient=status is None or _transient_status(status)))
+        defer.returnValue(results)
@@ -17,12 +17,20 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import time
+
 from abc import ABCMeta
 from abc import abstractproperty
 
+from twisted.internet import defer
 from twisted.internet.protocol import ServerFactory
+from twisted.protocols import postfix
 from twisted.python import log
 
+from leap.mx.metrics import MAP_LATENCY
+from leap.mx.metrics import MAP_QUERIES
+from leap.mx.metrics import MAP_RESULTS
+
 
 # For info on codes, see: http://www.postfix.org/tcp_table.5.html
 TCP_MAP_CODE_SUCCESS = 200
@@ -30,6 +38,100 @@ TCP_MAP_CODE_TEMPORARY_FAILURE = 400
 TCP_MAP_CODE_PERMANENT_FAILURE = 500
 
 
+class MapMetrics(object):
+    """
+    The preallocated metrics of a tcp map.
+    """
+
+    def __init__(self, name):
+        """
+        Initialize the metrics.
+
+        :param name: The name of the map, used as the map label.
+        :type name: str
+        """
+        self.queries = MAP_QUERIES.labels(name)
+        self.latency = MAP_LATENCY.labels(name)
+        self._name = name
+        self._results = {}
+        for code in (TCP_MAP_CODE_SUCCESS,
+                     TCP_MAP_CODE_TEMPORARY_FAILURE,
+                     TCP_MAP_CODE_PERMANENT_FAILURE):
+            self._results[code] = MAP_RESULTS.labels(name, str(code))
+
+    def result(self, code):
+        """
+        Return the counter of replies with the given code.
+
+        :param code: The tcp_table reply code.
+        :type code: int
+        """
+        counter = self._results.get(code)
+        if counter is None:
+            counter = self._results[code] = MAP_RESULTS.labels(
+                self._name, str(code))
+        return counter
+
+
+class LEAPPostfixTCPMapServer(postfix.PostfixTCPMapServer):
+    """
+    A postfix tcp map server that honours its factory's throttle and updates
+    its factory's metrics.
+
+    Connections over the throttle's limit are dropped, which postfix treats
+    as a temporary lookup failure, and lookups over the limits are answered
+    with a temporary failure without reaching the factory.
+    """
+
+    def connectionMade(self):
+        postfix.PostfixTCPMapServer.connectionMade(self)
+        self._metrics = getattr(self.factory, "metrics", None)
+        throttle = getattr(self.factory, "throttle", None)
+        if throttle is not None and not throttle.connection_made(self):
+            log.msg("Too many connections, dropping new connection.")
+            self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        postfix.PostfixTCPMapServer.connectionLost(self, reason)
+        throttle = getattr(self.factory, "throttle", None)
+        if throttle is not None:
+            throttle.connection_lost(self)
+
+    def sendCode(self, code, message=""):
+        if self._metrics is not None:
+            self._metrics.result(code).inc()
+        postfix.PostfixTCPMapServer.sendCode(self, code, message)
+
+    def do_get(self, key):
+        if key is None:
+            return postfix.PostfixTCPMapServer.do_get(self, key)
+
+        if self._metrics is not None:
+            self._metrics.queries.inc()
+
+        throttle = getattr(self.factory, "throttle", None)
+        if throttle is not None and not throttle.acquire(self):
+            self.sendCode(
+                TCP_MAP_CODE_TEMPORARY_FAILURE,
+                postfix.quote("TRY AGAIN LATER"))
+            return
+
+        d = defer.maybeDeferred(self.factory.get, key)
+        d.addBoth(self._done, throttle, time.time())
+        d.addCallbacks(self._cbGot, self._cbNot)
+        d.addErrback(log.err)
+
+    def _done(self, result, throttle, started):
+        """
+        Release the throttle and record the latency of a finished lookup.
+        """
+        if throttle is not None:
+            throttle.release(self)
+        if self._metrics is not None:
+            self._metrics.latency.observe(time.time() - started)
+        return result
+
+
 # we have to also extend from object here to make the class a new-style class.
 # If we don't, we get a TypeError because "new-style classes can't have only
 # classic bases". This has to do with the way abc.ABCMeta works and the old
@@ -41,19 +143,32 @@ class LEAPPostfixTCPMapServerFactory(ServerFactory, object):
 
     __metaclass__ = ABCMeta
 
-    def __init__(self, couchdb):
+    def __init__(self, couchdb, address_filter=None, throttle=None):
         """
         Initialize the factory.
 
         :param couchdb: A CouchDB client.
         :type couchdb: leap.mx.couchdbhelper.ConnectedCouchDB
+        :param address_filter: An optional filter of the valid addresses,
+                               used to answer definite misses without
+                               querying CouchDB.
+        :type address_filter: leap.mx.address_filter.AddressFilter
+        :param throttle: Optional limits on connections and lookups.
+        :type throttle: leap.mx.throttle.QueryThrottle
         """
         self._cdb = couchdb
+        self._address_filter = address_filter
+        self.throttle = throttle
+        self.metrics = MapMetrics(self._map_name)
 
     @abstractproperty
     def _query_message(self):
         pass
 
+    @abstractproperty
+    def _map_name(self):
+        pass
+
     def get(self, lookup_key):
         """
         Look up user based on lookup_key.
@@ -65,6 +180,11 @@ class LEAPPostfixTCPMapServerFactory(ServerFactory, object):
                  and pgp key.
         :rtype: Deferred
         """
+        if self._address_filter is not None \
+                and not self._address_filter.might_contain(lookup_key):
+            log.msg("%s: %s (not in address filter)"
+                    % (self._query_message, lookup_key,))
+            return defer.succeed((None, None))
         log.msg("%s: %s" % (self._query_message, lookup_key,))
         d = self._cdb.getUuidAndPubkey(lookup_key)
         d.addErrback(log.err)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# test_address_filter.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+AddressFilter tests
+"""
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from leap.mx.address_filter import AddressFilter, BloomFilter
+from leap.mx.check_recipient_access import CheckRecipientAccessFactory
+
+
+ADDRESSES = ["user%d@leap.se" % i for i in xrange(1000)]
+UUID = "13d5203bdd09be1e638bdb1d315251cb"
+
+
+class FakeCouchDB(object):
+
+    def __init__(self):
+        self.addresses = list(ADDRESSES)
+        self.changes = []
+        self.lookups = []
+        self.failures = 0
+
+    def getAllAddresses(self):
+        if self.failures:
+            self.failures -= 1
+            return defer.fail(Exception("CouchDB is down"))
+        return defer.succeed((1, list(self.addresses)))
+
+    def getChanges(self, since):
+        docs, self.changes = self.changes, []
+        return defer.succeed((since + 1, docs))
+
+    def getUuidAndPubkey(self, address):
+        self.lookups.append(address)
+        if address in self.addresses:
+            return defer.succeed((UUID, "pubkey"))
+        return defer.succeed((None, None))
+
+
+class BloomFilterTestCase(unittest.TestCase):
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(len(ADDRESSES))
+        for address in ADDRESSES:
+            bloom.add(address)
+        for address in ADDRESSES:
+            self.assertIn(address, bloom)
+        self.assertEqual(len(ADDRESSES), len(bloom))
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(len(ADDRESSES), error_rate=0.01)
+        for address in ADDRESSES:
+            bloom.add(address)
+        false_positives = sum(1 for i in xrange(10000)
+                              if "other%d@leap.se" % i in bloom)
+        self.assertTrue(false_positives < 300)
+
+    def test_unicode(self):
+        bloom = BloomFilter(10)
+        bloom.add(u"ñandú@leap.se")
+        self.assertIn(u"ñandú@leap.se".encode("utf8"), bloom)
+
+
+class AddressFilterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cdb = FakeCouchDB()
+        self.address_filter = AddressFilter(self.cdb, capacity=10)
+
+    def test_not_ready_might_contain_everything(self):
+        self.assertTrue(self.address_filter.might_contain("unknown@leap.se"))
+
+    @defer.inlineCallbacks
+    def test_rebuild(self):
+        yield self.address_filter.rebuild()
+        self.assertTrue(self.address_filter.ready)
+        self.assertTrue(self.address_filter.might_contain(ADDRESSES[0]))
+        self.assertFalse(self.address_filter.might_contain("unknown@leap.se"))
+
+    @defer.inlineCallbacks
+    def test_poll_changes(self):
+        yield self.address_filter.rebuild()
+        self.cdb.changes = [{"address": "new@leap.se"}, {"foo": "bar"}]
+        yield self.address_filter.poll_changes()
+        self.assertTrue(self.address_filter.might_contain("new@leap.se"))
+
+    @defer.inlineCallbacks
+    def test_stale_filter_is_not_trusted(self):
+        yield self.address_filter.rebuild()
+        self.address_filter._last_sync -= AddressFilter.MAX_STALENESS
+        self.assertTrue(self.address_filter.might_contain("unknown@leap.se"))
+
+    @defer.inlineCallbacks
+    def test_factory_skips_couchdb_on_miss(self):
+        yield self.address_filter.rebuild()
+        factory = CheckRecipientAccessFactory(
+            self.cdb, address_filter=self.address_filter)
+        result = yield factory.get("unknown@leap.se")
+        self.assertEqual((None, None), result)
+        self.assertEqual([], self.cdb.lookups)
+        result = yield factory.get(ADDRESSES[0])
+        self.assertEqual((UUID, "pubkey"), result)
+        self.assertEqual([ADDRESSES[0]], self.cdb.lookups)
+
+    def test_failed_load_is_retried(self):
+        clock = task.Clock()
+        self.cdb.failures = 2
+        address_filter = AddressFilter(self.cdb, capacity=10, clock=clock)
+        address_filter.startService()
+        self.addCleanup(address_filter.stopService)
+        self.assertFalse(address_filter.ready)
+        delays = AddressFilter.LOAD_BACKOFF.delays()
+        clock.advance(delays[0])
+        self.assertFalse(address_filter.ready)
+        clock.advance(delays[1])
+        self.assertTrue(address_filter.ready)
+        self.assertFalse(address_filter.might_contain("unknown@leap.se"))
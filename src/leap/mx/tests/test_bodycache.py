@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# test_bodycache.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Shared message body cache tests
+"""
+
+import json
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from leap.mx.bodycache import BodyCache
+from leap.mx.tests.test_mail_receiver import PRIVATE_KEY, PUBLIC_KEY
+from leap.mx.vendor.pgpy import PGPKey, PGPMessage
+from leap.mx.vendor.pgpy.constants import CompressionAlgorithm
+
+
+BODY = "The quick brown fox jumps over the \"lazy\" dog.\n" * 1000
+
+
+def message(to, body=BODY):
+    return "Delivered-To: %s\nSubject: hello\n\n%s" % (to, body)
+
+
+class BodyCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def test_document(self):
+        cache = BodyCache(clock=self.clock)
+        for body, expected in ((BODY, "t"), (BODY + "\xc3\xa9", "b")):
+            msg = message("foo@example.org", body)
+            chunks, literal_format = cache.document(msg)
+            self.assertEqual(expected, literal_format)
+            self.assertEqual(
+                {'incoming': True, 'content': msg.decode("utf-8")},
+                json.loads("".join(chunks)))
+            lit = PGPMessage.new(
+                json.dumps({'incoming': True, 'content': msg},
+                           ensure_ascii=False))
+            self.assertEqual(literal_format, lit._message.format)
+
+    def test_hit(self):
+        cache = BodyCache(clock=self.clock)
+        chunks, _ = cache.document(message("foo@example.org"))
+        other, _ = cache.document(message("bar@example.org"))
+        self.assertIdentical(chunks[-1], other[-1])
+        self.assertNotEqual(chunks[0], other[0])
+        self.assertEqual(1, len(cache))
+
+    def test_not_shared(self):
+        cache = BodyCache(clock=self.clock)
+        self.assertIdentical(None, cache.document(message("foo", "small")))
+        self.assertIdentical(None, cache.document(unicode(message("foo"))))
+        cache = BodyCache(max_bytes=0, clock=self.clock)
+        self.assertIdentical(None, cache.document(message("foo")))
+        self.assertEqual(0, len(cache))
+
+    def test_eviction(self):
+        cache = BodyCache(max_bytes=len(BODY) * 3 // 2, ttl=60,
+                          clock=self.clock)
+        chunks, _ = cache.document(message("foo"))
+        cache.document(message("foo", BODY + "more"))
+        self.assertEqual(1, len(cache))
+        other, _ = cache.document(message("foo"))
+        self.assertNotIdentical(chunks[-1], other[-1])
+        self.clock.advance(59)
+        chunks, _ = cache.document(message("bar"))
+        self.assertIdentical(chunks[-1], other[-1])
+        self.clock.advance(60)
+        other, _ = cache.document(message("bar"))
+        self.assertNotIdentical(chunks[-1], other[-1])
+
+    def test_decrypt_shared(self):
+        cache = BodyCache(clock=self.clock)
+        pubkey, _ = PGPKey.from_blob(PUBLIC_KEY)
+        privkey, _ = PGPKey.from_blob(PRIVATE_KEY)
+        for to in ("foo@example.org", "bar@example.org"):
+            msg = message(to)
+            chunks, literal_format = cache.document(msg)
+            encrypted = pubkey.encrypt(PGPMessage.new(
+                chunks, format=literal_format,
+                compression=CompressionAlgorithm.ZIP))
+            decrypted = privkey.decrypt(
+                PGPMessage.from_blob(str(encrypted))).message
+            self.assertEqual(msg, json.loads(decrypted)['content'])
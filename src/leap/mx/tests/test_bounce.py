@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# test_bounce.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Bounce queue tests
+"""
+
+import os
+import re
+import shutil
+import tempfile
+
+from email import message_from_string
+from email.message import Message
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from leap.mx.bounce import _build_bounce_message
+from leap.mx.bounce import BounceQueue
+from leap.mx.bounce import bounce_template
+from leap.mx.bounce_transport import SMTPBounceError
+from leap.mx.retry import Backoff
+
+
+REASON = "Missing PGP public key"
+
+
+def make_message(sender="sender@example.org", to="user@leap.se"):
+    msg = Message()
+    msg.add_header("Return-Path", "<%s>" % (sender,))
+    msg.add_header("X-Original-To", to)
+    msg.add_header("Delivered-To", "uuid@deliver.local")
+    msg.add_header("From", sender)
+    msg.add_header("To", to)
+    msg.add_header("Subject", "hello")
+    msg.set_payload("body")
+    return msg
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.sent = []
+        self.errors = []
+
+    def send(self, recipient, data):
+        if self.errors:
+            return defer.fail(self.errors.pop(0))
+        self.sent.append((recipient, message_from_string(data)))
+        return defer.succeed(None)
+
+
+def normalize(bounce):
+    """
+    Replace the fields of a bounce that change every time it's rendered.
+    """
+    bounce = re.sub("=+[0-9]+==", "BOUNDARY", bounce)
+    return re.sub("\nDate: .*\n", "\nDate: DATE\n", bounce)
+
+
+class BounceTemplateTestCase(unittest.TestCase):
+
+    def assertRendersLikeBuilder(self, orig_msg, headers_only=False):
+        template = bounce_template("bounce@leap.se", "Undelivered mail",
+                                   REASON)
+        built = _build_bounce_message("bounce@leap.se", "Undelivered mail",
+                                      orig_msg, REASON, headers_only)
+        self.assertEqual(normalize(built.as_string()),
+                         normalize(template.render(orig_msg, headers_only)))
+
+    def test_render(self):
+        msg = make_message()
+        msg.add_header("Envelope-Id", "100%-envelope")
+        self.assertRendersLikeBuilder(msg)
+        self.assertRendersLikeBuilder(msg, headers_only=True)
+
+    def test_render_long_recipient(self):
+        msg = make_message(to="a-rather-long-address" * 4 + "@leap.se")
+        self.assertRendersLikeBuilder(msg)
+
+
+class BounceQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.transport = FakeTransport()
+
+    def queue(self, **kwargs):
+        return BounceQueue("bounce@leap.se", "Undelivered mail",
+                           transport=self.transport, window=60,
+                           clock=self.clock, **kwargs)
+
+    def test_coalesce(self):
+        queue = self.queue()
+        for to in ("a@leap.se", "b@leap.se", "a@leap.se"):
+            queue.bounce(make_message(to=to), REASON)
+        queue.bounce(make_message(), "Other reason")
+        self.assertEqual([], self.transport.sent)
+        self.assertEqual(4, queue.pending)
+
+        self.clock.advance(60)
+        self.assertEqual(2, len(self.transport.sent))
+        self.assertEqual(0, queue.pending)
+        reports = sorted(msg.get_payload(0).get_payload()
+                         for _, msg in self.transport.sent)
+        # the single message is bounced the usual way
+        self.assertIn("your message could not", reports[1])
+        self.assertIn("3 of your messages", reports[0])
+        self.assertIn("<a@leap.se>", reports[0])
+        self.assertIn("<b@leap.se>", reports[0])
+
+        recipient, report = self.transport.sent[0]
+        self.assertEqual("sender@example.org", recipient)
+        dsn = report.get_payload(1).as_string()
+        self.assertEqual(1, dsn.count("Reporting-MTA"))
+
+    def test_aggregate_report(self):
+        queue = self.queue()
+        for to in ("a@leap.se", "b@leap.se", "a@leap.se"):
+            queue.bounce(make_message(to=to), REASON)
+        self.clock.advance(60)
+        _, report = self.transport.sent[0]
+        dsn = report.get_payload(1).as_string()
+        self.assertEqual(2, dsn.count("Final-Recipient"))
+        self.assertEqual(
+            "text/rfc822-headers", report.get_payload(2).get_content_type())
+
+    def test_headers_only(self):
+        queue = self.queue()
+        queue.bounce(make_message(), REASON, headers_only=True)
+        self.clock.advance(60)
+        _, report = self.transport.sent[0]
+        self.assertIn("your message could not",
+                      report.get_payload(0).get_payload())
+        returned = report.get_payload(2)
+        self.assertEqual("text/rfc822-headers", returned.get_content_type())
+        self.assertNotIn("body", returned.get_payload())
+
+    def test_sender_rate_limit(self):
+        queue = self.queue(sender_rate=1.0 / 3600, max_delay=150)
+        queue.bounce(make_message(), REASON)
+        self.clock.advance(60)
+        self.assertEqual(1, len(self.transport.sent))
+
+        # the second report to the same sender is delayed, and keeps
+        # gathering bounces until it's dropped
+        queue.bounce(make_message(), REASON)
+        self.clock.advance(60)
+        queue.bounce(make_message(), REASON)
+        self.assertEqual(1, len(self.transport.sent))
+        self.assertEqual(2, queue.pending)
+        self.clock.advance(60)
+        self.assertEqual(0, queue.pending)
+        self.assertEqual(1, len(self.transport.sent))
+
+        # other senders are not affected
+        queue.bounce(make_message(sender="other@example.org"), REASON)
+        self.clock.advance(60)
+        self.assertEqual(2, len(self.transport.sent))
+
+    def test_global_rate_limit(self):
+        queue = self.queue(rate=1.0 / 3600)
+        queue.bounce(make_message(sender="one@example.org"), REASON)
+        queue.bounce(make_message(sender="two@example.org"), REASON)
+        self.clock.advance(60)
+        self.assertEqual(1, len(self.transport.sent))
+        self.assertEqual(1, queue.pending)
+        queue.flush()
+        self.assertEqual(2, len(self.transport.sent))
+
+    def test_global_rate_limit_keeps_sender_tokens(self):
+        queue = self.queue(rate=1.0 / 3600, sender_rate=1.0 / 36000,
+                           sender_burst=1, max_delay=7200)
+        queue.bounce(make_message(sender="one@example.org"), REASON)
+        queue.bounce(make_message(sender="two@example.org"), REASON)
+        self.clock.advance(60)
+        self.assertEqual(1, len(self.transport.sent))
+        # the report to two was only refused by the global limit, so it's
+        # sent as soon as that allows it
+        self.clock.pump([60] * 60)
+        self.assertEqual(2, len(self.transport.sent))
+
+
+class DurableBounceQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.transport = FakeTransport()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def queue(self, **kwargs):
+        queue = BounceQueue("bounce@leap.se", "Undelivered mail",
+                            transport=self.transport, window=60,
+                            directory=self.directory,
+                            backoff=Backoff(retries=1, initial=10),
+                            clock=self.clock, **kwargs)
+        queue.startService()
+        return queue
+
+    def records(self):
+        return [name for name in os.listdir(self.directory)
+                if name.endswith(BounceQueue.RECORD_SUFFIX)]
+
+    @defer.inlineCallbacks
+    def test_records(self):
+        queue = self.queue()
+        yield queue.bounce(make_message(), REASON)
+        self.assertEqual(1, len(self.records()))
+        self.clock.advance(60)
+        self.assertEqual(1, len(self.transport.sent))
+        self.assertEqual([], self.records())
+        # only the headers of the original message are returned
+        _, report = self.transport.sent[0]
+        returned = report.get_payload(2)
+        self.assertEqual("text/rfc822-headers", returned.get_content_type())
+        self.assertIn("Subject: hello", returned.get_payload())
+
+    @defer.inlineCallbacks
+    def test_recovery(self):
+        queue = self.queue()
+        yield queue.bounce(make_message(to="a@leap.se"), REASON)
+        yield queue.bounce(make_message(to="b@leap.se"), REASON)
+        queue.stopService()
+        self.clock.advance(60)
+        self.assertEqual([], self.transport.sent)
+        self.assertEqual(2, len(self.records()))
+
+        queue = self.queue()
+        self.assertEqual(2, queue.pending)
+        self.clock.advance(60)
+        self.assertEqual(1, len(self.transport.sent))
+        _, report = self.transport.sent[0]
+        self.assertIn("2 of your messages",
+                      report.get_payload(0).get_payload())
+        self.assertEqual([], self.records())
+
+    @defer.inlineCallbacks
+    def test_8bit_headers(self):
+        queue = self.queue()
+        msg = make_message()
+        msg.replace_header("Subject", "caf\xe9")
+        yield queue.bounce(msg, REASON)
+        queue.stopService()
+        self.assertEqual(1, len(self.records()))
+        self.assertEqual(self.records(), os.listdir(self.directory))
+
+        queue = self.queue()
+        self.assertEqual(1, queue.pending)
+        self.clock.advance(60)
+        _, report = self.transport.sent[0]
+        self.assertIn("Subject: caf\xe9", report.get_payload(2).get_payload())
+        self.assertEqual([], os.listdir(self.directory))
+
+    @defer.inlineCallbacks
+    def test_stop_waits_for_records(self):
+        queue = self.queue()
+        queue.bounce(make_message(), REASON)
+        yield queue.stopService()
+        # the record is kept for the next start, but not queued
+        self.assertEqual(1, len(self.records()))
+        self.assertEqual(0, queue.pending)
+
+    def test_leftover_tmp(self):
+        with open(os.path.join(self.directory, ".0-partial"), "w") as f:
+            f.write('{"headers": ')
+        self.queue()
+        self.assertEqual([], os.listdir(self.directory))
+
+    @defer.inlineCallbacks
+    def test_retry(self):
+        queue = self.queue()
+        self.transport.errors = [
+            SMTPBounceError(451, "Try again"),
+            SMTPBounceError(451, "Try again")]
+        yield queue.bounce(make_message(), REASON)
+        self.clock.advance(60)
+        self.clock.advance(10)
+        # the retries are exhausted, the report waits for another window
+        self.assertEqual([], self.transport.sent)
+        self.assertEqual(1, queue.pending)
+        self.assertEqual(1, len(self.records()))
+        self.clock.advance(60)
+        self.assertEqual(1, len(self.transport.sent))
+        self.assertEqual([], self.records())
+
+    @defer.inlineCallbacks
+    def test_permanent_failure(self):
+        queue = self.queue()
+        self.transport.errors = [SMTPBounceError(550, "User unknown")]
+        yield queue.bounce(make_message(), REASON)
+        self.clock.advance(60)
+        self.assertEqual([], self.transport.sent)
+        self.assertEqual(0, queue.pending)
+        self.assertEqual([], self.records())
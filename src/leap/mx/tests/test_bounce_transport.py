@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# test_bounce_transport.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+SMTP bounce transport tests
+"""
+
+from twisted.internet import defer, reactor
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineReceiver
+from twisted.trial import unittest
+
+from leap.mx.bounce_transport import SMTPBounceError
+from leap.mx.bounce_transport import SMTPBounceTransport
+
+
+MESSAGE = "To: sender@example.org\n\n.leading dot\nbody\n"
+
+
+class FakeSMTPServer(LineReceiver):
+
+    delimiter = "\r\n"
+
+    def connectionMade(self):
+        self.factory.connections += 1
+        self._data = None
+        self.sendLine("220 localhost ESMTP")
+
+    def lineReceived(self, line):
+        if self._data is not None:
+            if line == ".":
+                self.factory.messages.append("\n".join(self._data))
+                self._data = None
+                self.sendLine("250 2.0.0 Ok: queued")
+            else:
+                self._data.append(line)
+            return
+        self.factory.commands.append(line)
+        command = line.split(" ", 1)[0].split(":", 1)[0].upper()
+        if command == "EHLO":
+            self.sendLine("250-localhost")
+            self.sendLine("250 PIPELINING")
+        elif command == "RCPT" and self.factory.reject:
+            self.sendLine("550 5.1.1 User unknown")
+        elif command in ("MAIL", "RCPT", "RSET"):
+            self.sendLine("250 2.1.0 Ok")
+        elif command == "DATA":
+            if self.factory.reject:
+                self.sendLine("554 5.5.1 No valid recipients")
+            else:
+                self._data = []
+                self.sendLine("354 End data with <CR><LF>.<CR><LF>")
+        elif command == "QUIT":
+            self.sendLine("221 2.0.0 Bye")
+            self.transport.loseConnection()
+
+
+class FakeSMTPFactory(Factory):
+
+    protocol = FakeSMTPServer
+
+    def __init__(self):
+        self.connections = 0
+        self.commands = []
+        self.messages = []
+        self.reject = False
+
+
+class FakeSendmail(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, recipient, data):
+        self.sent.append((recipient, data))
+        return defer.succeed(None)
+
+
+class SMTPBounceTransportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeSMTPFactory()
+        self.port = reactor.listenTCP(0, self.server, interface="127.0.0.1")
+        self.fallback = FakeSendmail()
+        self.transport = SMTPBounceTransport(
+            "127.0.0.1", self.port.getHost().port, concurrency=1,
+            fallback=self.fallback)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.transport.close()
+        yield self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def test_connection_is_reused(self):
+        yield defer.gatherResults(
+            [self.transport.send("sender%d@example.org" % i, MESSAGE)
+             for i in xrange(3)])
+        yield self.transport.send("other@example.org", MESSAGE)
+        self.assertEqual(1, self.server.connections)
+        self.assertEqual(4, len(self.server.messages))
+        self.assertEqual(
+            "To: sender@example.org\n\n..leading dot\nbody",
+            self.server.messages[0])
+        self.assertIn("MAIL FROM:<>", self.server.commands)
+        self.assertIn("RCPT TO:<sender2@example.org>", self.server.commands)
+        self.assertEqual([], self.fallback.sent)
+
+    @defer.inlineCallbacks
+    def test_refused_bounce(self):
+        self.server.reject = True
+        d = self.transport.send("nobody@example.org", MESSAGE)
+        yield self.assertFailure(d, SMTPBounceError)
+        self.assertEqual([], self.fallback.sent)
+        # the connection is still usable
+        self.server.reject = False
+        yield self.transport.send("sender@example.org", MESSAGE)
+        self.assertEqual(1, self.server.connections)
+        self.assertEqual(1, len(self.server.messages))
+
+    @defer.inlineCallbacks
+    def test_fallback(self):
+        yield self.port.stopListening()
+        yield self.transport.send("sender@example.org", MESSAGE)
+        self.assertEqual(
+            [("sender@example.org", MESSAGE)], self.fallback.sent)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# test_compression.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Compression policy tests
+"""
+
+import base64
+import random
+
+from twisted.trial import unittest
+
+from leap.mx.compression import CompressionPolicy
+from leap.mx.metrics import COMPRESSION_BYTES
+from leap.mx.metrics import COMPRESSION_RATIO
+from leap.mx.metrics import COMPRESSION_SECONDS
+from leap.mx.tests.test_mail_receiver import PRIVATE_KEY, PUBLIC_KEY
+from leap.mx.vendor.pgpy import PGPKey, PGPMessage
+from leap.mx.vendor.pgpy.constants import CompressionAlgorithm
+
+
+TEXT = u"Subject: hello\n\nThe quick brown fox jumps over the lazy dog.\n"
+
+
+def attachment(size, seed=0):
+    """
+    Base64 of random data, like that of an already compressed file.
+    """
+    rand = random.Random(seed)
+    data = bytearray(rand.getrandbits(8) for _ in xrange(size))
+    return base64.encodestring(bytes(data))
+
+
+class CompressionPolicyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = CompressionPolicy()
+
+    def test_small(self):
+        self.assertEqual((CompressionAlgorithm.Uncompressed, None),
+                         self.policy.choose(TEXT))
+
+    def test_levels(self):
+        self.assertEqual((CompressionAlgorithm.ZIP, 6),
+                         self.policy.choose(TEXT * 100))
+        self.assertEqual((CompressionAlgorithm.ZIP, 3),
+                         self.policy.choose(TEXT * 10000))
+        self.assertEqual((CompressionAlgorithm.ZIP, 1),
+                         self.policy.choose(TEXT * 20000))
+
+    def test_incompressible(self):
+        self.assertEqual((CompressionAlgorithm.Uncompressed, None),
+                         self.policy.choose(attachment(4096)))
+        # the text at the start doesn't hide the attachment after it
+        self.assertEqual((CompressionAlgorithm.Uncompressed, None),
+                         self.policy.choose(TEXT * 20 + attachment(65536)))
+
+    def test_compression_level(self):
+        pubkey, _ = PGPKey.from_blob(PUBLIC_KEY)
+        privkey, _ = PGPKey.from_blob(PRIVATE_KEY)
+        data = TEXT * 100
+        sizes = []
+        for level in (1, 9):
+            message = PGPMessage.new(
+                data, compression=CompressionAlgorithm.ZIP,
+                compression_level=level)
+            sizes.append(len(message.__bytes__()))
+            encrypted = PGPMessage.from_blob(str(pubkey.encrypt(message)))
+            self.assertEqual(data, privkey.decrypt(encrypted).message)
+        self.assertTrue(sizes[1] < sizes[0])
+
+    def test_observe(self):
+        pubkey, _ = PGPKey.from_blob(PUBLIC_KEY)
+        data = TEXT * 10000
+        compression, level = self.policy.choose(data)
+        message = PGPMessage.new(data, compression=compression,
+                                 compression_level=level)
+        ratio = COMPRESSION_RATIO.labels(str(level))
+        latency = COMPRESSION_SECONDS.labels(str(level))
+        original = COMPRESSION_BYTES.labels(str(level), "original")
+        compressed = COMPRESSION_BYTES.labels(str(level), "compressed")
+        before = (sum(ratio.counts), sum(latency.counts), original.get(),
+                  compressed.get())
+
+        # nothing is recorded before the message is compressed
+        self.policy.observe(message)
+        self.assertEqual(before, (sum(ratio.counts), sum(latency.counts),
+                                  original.get(), compressed.get()))
+
+        pubkey.encrypt(message)
+        self.policy.observe(message)
+        self.assertEqual(before[0] + 1, sum(ratio.counts))
+        self.assertEqual(before[1] + 1, sum(latency.counts))
+        size = original.get() - before[2]
+        compressed_size = compressed.get() - before[3]
+        self.assertTrue(size > len(data))
+        self.assertTrue(0 < compressed_size < size / 10)
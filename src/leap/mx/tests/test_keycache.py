@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# test_keycache.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Parsed key cache tests
+"""
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from leap.mx.keycache import KeyCache
+from leap.mx.tests.test_mail_receiver import EXPIRED_KEY, PUBLIC_KEY
+
+
+class KeyCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def test_hit(self):
+        cache = KeyCache(clock=self.clock)
+        key = cache.get_key(PUBLIC_KEY)
+        self.assertIdentical(key, cache.get_key(PUBLIC_KEY))
+        self.assertNotIdentical(key, cache.get_key(EXPIRED_KEY))
+        self.assertEqual(2, len(cache))
+
+    def test_lru_eviction(self):
+        cache = KeyCache(max_size=1, clock=self.clock)
+        key = cache.get_key(PUBLIC_KEY)
+        cache.get_key(EXPIRED_KEY)
+        self.assertEqual(1, len(cache))
+        self.assertNotIdentical(key, cache.get_key(PUBLIC_KEY))
+
+    def test_ttl(self):
+        cache = KeyCache(ttl=60, clock=self.clock)
+        key = cache.get_key(PUBLIC_KEY)
+        self.clock.advance(59)
+        self.assertIdentical(key, cache.get_key(PUBLIC_KEY))
+        self.clock.advance(1)
+        self.assertNotIdentical(key, cache.get_key(PUBLIC_KEY))
+
+    def test_invalid_key(self):
+        cache = KeyCache(clock=self.clock)
+        self.assertRaises(ValueError, cache.get_key, "not a key")
+        self.assertEqual(0, len(cache))
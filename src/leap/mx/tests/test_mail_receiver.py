@@ -24,12 +24,18 @@ import os
 import os.path
 import shutil
 import tempfile
+import time
 
+from email import message_from_string
 from email.message import Message
 from twisted.internet import defer, reactor
 from twisted.trial import unittest
 
+from leap.mx.mail_receiver import BINARY_CONTENT_TYPE
+from leap.mx.mail_receiver import BinaryCiphertextDocument
+from leap.mx.mail_receiver import ENC_SCHEME_PUBKEY_BINARY
 from leap.mx.mail_receiver import MailReceiver
+from leap.mx.metrics import SPOOL_DEPTH
 from leap.mx.vendor.pgpy import PGPKey, PGPMessage
 
 
@@ -86,6 +92,18 @@ class MailReceiverTestCase(unittest.TestCase):
         self.assertEqual(msg, decmsg)
         self.assertFalse(os.path.exists(path))
 
+    @defer.inlineCallbacks
+    def test_renamed_mail(self):
+        # written in tmp and moved into new once complete
+        os.mkdir(os.path.join(self.directory, "tmp"))
+        msg, tmp_path = self.addMail("foo bar", filename="renamed",
+                                     subdir="tmp")
+        path = os.path.join(self.directory, "new", "renamed")
+        os.rename(tmp_path, path)
+        _, doc = yield self.defer_put_doc
+        self.assertEqual(msg, self.decryptDoc(doc))
+        self.assertFalse(os.path.exists(path))
+
     @defer.inlineCallbacks
     def test_put_doc_raises(self):
         defer_called = defer.Deferred()
@@ -99,6 +117,58 @@ class MailReceiverTestCase(unittest.TestCase):
         yield defer_called
         self.assertTrue(os.path.exists(path))
 
+    @defer.inlineCallbacks
+    def test_stalled_mail_reuses_encrypted_doc(self):
+        failed = defer.Deferred()
+        encrypted = []
+        put_doc = self.users_cdb.put_doc
+        encrypt_message = self.receiver._encrypt_message
+
+        def put_doc_fail_once(uuid, doc):
+            if not failed.called:
+                reactor.callLater(0, failed.callback, doc)
+                return defer.fail(Exception())
+            return put_doc(uuid, doc)
+
+        def encrypt_counting(pubkey, message):
+            encrypted.append(message)
+            return encrypt_message(pubkey, message)
+
+        self.users_cdb.put_doc = put_doc_fail_once
+        self.receiver._encrypt_message = encrypt_counting
+        _, path = self.addMail("foo bar")
+        stalled_doc = yield failed
+        self.assertTrue(os.path.exists(path))
+
+        self.receiver._process_skipped()
+        _, doc = yield self.defer_put_doc
+        self.assertEqual(stalled_doc.doc_id, doc.doc_id)
+        self.assertEqual(1, len(encrypted))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual({}, self.receiver._encrypted)
+
+    def test_encrypted_cache_limits(self):
+        receiver = self.receiver
+        receiver.ENCRYPTED_CACHE_MAX_BYTES = 10
+        docs = [BinaryCiphertextDocument("doc%d" % i, "x" * 4)
+                for i in xrange(3)]
+        receiver._cache_doc("a", docs[0])
+        receiver._cache_doc("b", docs[1])
+        # reusing a document doesn't extend its life, but keeps it from
+        # being evicted
+        _, encrypted_at, _ = receiver._encrypted["a"]
+        self.assertEqual(docs[0], receiver._cached_doc("a"))
+        self.assertEqual(encrypted_at, receiver._encrypted["a"][1])
+        receiver._cache_doc("c", docs[2])
+        self.assertEqual(None, receiver._cached_doc("b"))
+        self.assertEqual(8, receiver._encrypted_bytes)
+
+        receiver._encrypted["a"] = (docs[0], encrypted_at -
+                                    receiver.ENCRYPTED_CACHE_TTL - 1, 4)
+        self.assertEqual(None, receiver._cached_doc("a"))
+        self.assertEqual(["c"], receiver._encrypted.keys())
+        self.assertEqual(4, receiver._encrypted_bytes)
+
     def test_expired_key(self):
         self.pubKey = EXPIRED_KEY
         self.privKey = EXPIRED_PRIVATE
@@ -114,9 +184,119 @@ class MailReceiverTestCase(unittest.TestCase):
         self.assertEqual(unicode(msg, "utf-8"), decmsg)
         self.assertFalse(os.path.exists(path))
 
+    @defer.inlineCallbacks
+    def test_large_bounce_returns_headers(self):
+        self.receiver.stopService()
+        bounced = defer.Deferred()
+
+        class BounceTransport(object):
+            def send(_, recipient, data):
+                reactor.callLater(0, bounced.callback, (recipient, data))
+                return defer.succeed(None)
+
+        self.pubKey = None
+        self.receiver = MailReceiver(
+            users_cdb=self.users_cdb,
+            directories=[(self.directory, True)],
+            bounce_from=BOUNCE_ADDRESS,
+            bounce_subject=BOUNCE_SUBJECT,
+            bounce_transport=BounceTransport(),
+            max_returned_size=1024)
+        self.receiver.startService()
+        _, path = self.addMail(
+            "x" * 2048, headers={"Return-Path": "<someone@domain.org>"})
+        recipient, data = yield bounced
+        self.assertEqual("someone@domain.org", recipient)
+        report = message_from_string(data)
+        returned = report.get_payload(2)
+        self.assertEqual("text/rfc822-headers", returned.get_content_type())
+        self.assertIn("Subject: sent subject", returned.get_payload())
+        self.assertNotIn("x" * 2048, data)
+        self.assertFalse(os.path.exists(path))
+
+    @defer.inlineCallbacks
+    def test_binary_ciphertext(self):
+        self.receiver.stopService()
+        delivered = defer.Deferred()
+
+        class IncomingAPI(object):
+            batching = False
+
+            def put_doc(_, uuid, doc_id, content, content_type=None,
+                        enc_scheme=None):
+                reactor.callLater(0, delivered.callback,
+                                  (uuid, content, content_type, enc_scheme))
+                return defer.succeed(None)
+
+        self.receiver = MailReceiver(
+            users_cdb=self.users_cdb,
+            directories=[(self.directory, True)],
+            bounce_from=BOUNCE_ADDRESS,
+            bounce_subject=BOUNCE_SUBJECT,
+            incoming_api_helper=IncomingAPI(),
+            binary_ciphertext=True)
+        self.receiver.startService()
+        msg, path = self.addMail("foo bar")
+        uuid, content, content_type, enc_scheme = yield delivered
+        self.assertEqual(uuid, UUID)
+        self.assertEqual(BINARY_CONTENT_TYPE, content_type)
+        self.assertEqual(ENC_SCHEME_PUBKEY_BINARY, enc_scheme)
+        self.assertFalse("PGP MESSAGE" in content)
+        decmsg = self.decryptDoc({'_enc_json': content})
+        self.assertEqual(msg, decmsg)
+
+    @defer.inlineCallbacks
+    def test_backlog_batches(self):
+        self.receiver.stopService()
+        done = defer.Deferred()
+        batches = []
+
+        class IncomingAPI(object):
+            batching = True
+            batch_size = 2
+
+            def put_docs(_, docs):
+                batches.append([uuid for uuid, _, _, _, _ in docs])
+                if len(batches) == 2:
+                    reactor.callLater(0, done.callback, None)
+                return defer.succeed([None] * len(docs))
+
+        paths = [self.addMail("mail %d" % i, filename="mail%d" % i)[1]
+                 for i in xrange(3)]
+        self.receiver = MailReceiver(
+            users_cdb=self.users_cdb,
+            directories=[(self.directory, True)],
+            bounce_from=BOUNCE_ADDRESS,
+            bounce_subject=BOUNCE_SUBJECT,
+            incoming_api_helper=IncomingAPI())
+        self.receiver.startService()
+        yield done
+        self.assertEqual([[UUID, UUID], [UUID]], batches)
+        for path in paths:
+            self.assertFalse(os.path.exists(path))
+
+    @defer.inlineCallbacks
+    def test_spool_stats(self):
+        spool = tempfile.mkdtemp(prefix="leap_tests-")
+        self.addCleanup(shutil.rmtree, spool)
+        for name in ("a", "b"):
+            with open(os.path.join(spool, name), "w") as f:
+                f.write("mail")
+        os.utime(os.path.join(spool, "a"), (0, time.time() - 60))
+        receiver = MailReceiver(self.users_cdb, [(spool, False)],
+                                BOUNCE_ADDRESS, BOUNCE_SUBJECT)
+        yield receiver._update_spool_stats()
+        self.assertEqual(2, SPOOL_DEPTH.labels(spool).get())
+        self.assertTrue(receiver._spool_age(spool) >= 60)
+
+    def test_binary_ciphertext_needs_incoming_api(self):
+        self.assertRaises(
+            ValueError, MailReceiver, self.users_cdb, [], BOUNCE_ADDRESS,
+            BOUNCE_SUBJECT, binary_ciphertext=True)
+
     def addMail(self, body="", filename="foo", to=ADDRESS,
                 frm="someone@domain.org", subject="sent subject",
-                headers={}):
+                headers={}, subdir="new"):
         msg = Message()
         msg.add_header("To", to)
         msg.add_header(
@@ -127,15 +307,16 @@ class MailReceiverTestCase(unittest.TestCase):
             msg.add_header(header, value)
         msg.set_payload(body)
 
-        path = os.path.join(self.directory, "new", filename)
+        path = os.path.join(self.directory, subdir, filename)
         with open(path, "w") as f:
             f.write(msg.as_string())
 
         return msg.as_string(), path
 
     def decryptDoc(self, doc):
+        content = getattr(doc, "content", doc)
         key, _ = PGPKey.from_blob(self.privKey)
-        message = PGPMessage.from_blob(doc.content['_enc_json'])
+        message = PGPMessage.from_blob(content['_enc_json'])
         decmsg = key.decrypt(message)
         decdoc = json.loads(str(decmsg.message))
 
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# test_metrics.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Metrics tests
+"""
+
+from twisted.internet import defer
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from leap.mx.check_recipient_access import CheckRecipientAccessFactory
+from leap.mx.metrics import Counter, Gauge, Histogram, Registry
+from leap.mx.metrics import MAP_LATENCY, MAP_QUERIES, MAP_RESULTS
+
+
+class RegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = Counter("requests_total", "Requests.", ("code",),
+                          registry=self.registry)
+        counter.labels("200").inc()
+        counter.labels("200").inc(2)
+        counter.labels("500").inc()
+        self.assertEqual(
+            "# HELP requests_total Requests.\n"
+            "# TYPE requests_total counter\n"
+            'requests_total{code="200"} 3\n'
+            'requests_total{code="500"} 1\n',
+            self.registry.render())
+
+    def test_gauge_function(self):
+        gauge = Gauge("depth", "Depth.", registry=self.registry)
+        gauge.set_function(lambda: 42)
+        self.assertIn("\ndepth 42\n", self.registry.render())
+
+    def test_histogram(self):
+        histogram = Histogram("latency", "Latency.", buckets=(0.1, 1),
+                              registry=self.registry)
+        histogram.observe(0.05)
+        histogram.observe(0.1)
+        histogram.observe(0.5)
+        histogram.observe(3)
+        self.assertEqual(
+            "# HELP latency Latency.\n"
+            "# TYPE latency histogram\n"
+            'latency_bucket{le="0.1"} 2\n'
+            'latency_bucket{le="1"} 3\n'
+            'latency_bucket{le="+Inf"} 4\n'
+            "latency_sum 3.65\n"
+            "latency_count 4\n",
+            self.registry.render())
+
+    def test_wrong_labels(self):
+        counter = Counter("c", "C.", ("a", "b"), registry=self.registry)
+        self.assertRaises(ValueError, counter.labels, "x")
+
+
+class FakeCouchDB(object):
+
+    def getUuidAndPubkey(self, address):
+        return defer.succeed((None, None))
+
+
+class MapMetricsTestCase(unittest.TestCase):
+
+    def test_map_query(self):
+        queries = MAP_QUERIES.labels("check_recipient")
+        results = MAP_RESULTS.labels("check_recipient", "500")
+        latency = MAP_LATENCY.labels("check_recipient")
+        before = queries.get(), results.get(), sum(latency.counts)
+
+        factory = CheckRecipientAccessFactory(FakeCouchDB())
+        proto = factory.buildProtocol(("127.0.0.1", 0))
+        proto.makeConnection(proto_helpers.StringTransport())
+        self.addCleanup(proto.setTimeout, None)
+        proto.lineReceived("get foo@leap.se")
+
+        self.assertEqual(
+            (before[0] + 1, before[1] + 1, before[2] + 1),
+            (queries.get(), results.get(), sum(latency.counts)))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# test_pgpy.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Vendored pgpy tests
+"""
+
+import random
+
+from twisted.trial import unittest
+
+from leap.mx.tests.test_mail_receiver import PUBLIC_KEY
+from leap.mx.vendor.pgpy import PGPKey
+from leap.mx.vendor.pgpy.types import Armorable
+
+
+# A key with six uids and two subkeys. The self signatures of the uids are
+# made a second apart, pgpy orders uids with equal ones differently on each
+# parse.
+MANY_UIDS_KEY = """-----BEGIN PGP PUBLIC KEY BLOCK-----
+Version: PGPy v0.4.1
+
+xo0EatY+VgEEAOZp52hklWM1RkR21Z8n4CnOwH4OPhJt2gAeJhg6K7XsrfKpj2E6
+z8zMMoDHQb9tdv+YuKdvPAcobuHydKzkicw3QXNV+tW/9CWYN7cy/yNPKP/3shI0
+ZXBVIGOkS1uV3twWatdR4vcffhb12Gmm051iMqenUKer6K4nofjaU+spABEBAAHN
+GlVzZXIgMCA8dXNlcjBAZXhhbXBsZS5vcmc+wqgEEwEIABIFAmrWPlYCGwMCFQgC
+GQECHgEACgkQZ89DhGKF3IqHpgP/SRAahGwwJU7+grqYV2/VAZ0NzcB7g9jFyA/A
+zDdTH5Nevd8zsUWSRzYT9C8lMjkKg3OYbeuZ9dg7ST6F4+6hjOAoxc76yI3t8q77
+fndNbkVjyIIT2zrLEhGi8WiU5K0/BKw9FOC8ArIFrs85zfkTwyjCHJX/j3Nz91D5
+08Q/T4jNGlVzZXIgNSA8dXNlcjVAZXhhbXBsZS5vcmc+wqgEEwEIABIFAmrWPlwC
+GwMCFQgCGQACHgEACgkQZ89DhGKF3IrVsQQA3kmeCpQ//H57dkQqFtcsEVyD4m/2
+FSTTFVU19crmjL9Ln0unfYx8/8jxinNH3luOqvmCSMju8MAiWrRJkAiUfCrZWPMo
+AuWE5ifYvRzJYiAfJ98Tjxb2VhNC/FGwObx4vgu3uo6iu0B1rdXTxUv0dc4tIm/y
+zZfdUAswfaMmfTLNGlVzZXIgNCA8dXNlcjRAZXhhbXBsZS5vcmc+wqgEEwEIABIF
+AmrWPlsCGwMCFQgCGQACHgEACgkQZ89DhGKF3IrdpgP8CPDSW/A4DrJ2Un3oHJ+m
+0WQCtjbKEXYlq9csRthegXNTmaY5MPcG3mRStOHxVoVNgt5dZ2sERv8EndGKDr2Q
+u0hJep1fdUk/oXzT4RD8IPjYmOkm4eKLFfkHzbRGq4hw6LzFl9r28rJlH6uLy2HJ
+OxWGW29x0d38XkgdskMFMxjNGlVzZXIgMyA8dXNlcjNAZXhhbXBsZS5vcmc+wqgE
+EwEIABIFAmrWPloCGwMCFQgCGQACHgEACgkQZ89DhGKF3IrPAgP/aWlsJq3H2Jw1
+Y/FouMUVJJpM1DK0ctDHqNEkyloQdug1dfFzkeXaGDWGBRmQlc7IT8Oz228aPoKc
+xjlZFe4O5M1XVZMWQV3ipjM7ZqEfZQodN/yfB9zwuAOYA3MkrvVE3MIDjHS/pPhm
+L6noaHZJaPdxoD6R8rjRo4Qg7kBeak/NGlVzZXIgMiA8dXNlcjJAZXhhbXBsZS5v
+cmc+wqgEEwEIABIFAmrWPlgCGwMCFQgCGQACHgEACgkQZ89DhGKF3IqqwQP/SUeB
+T9/wC7yLj4w/Ig0p9irx7znrwq8UP0p6YcrU+OIboGsJ5HELGqsbFggsLnbqhk83
+2Aorp0qlAk+l8cm1UVsVE2rV+cIdR4wyU+ZBmnuPYxT8rsrpn7fLbI/EbQwixHkP
+aHIl6vHb+4v+90m39RY17E20Pf6IhE5UEVjXhfXNGlVzZXIgMSA8dXNlcjFAZXhh
+bXBsZS5vcmc+wqgEEwEIABIFAmrWPlcCGwMCFQgCGQACHgEACgkQZ89DhGKF3IoR
+qgP/ewnOHDC4RRm3FsiK/Sw91yQPbP9lx19tNuz/8JSN3Vy+MVSIXXnq3D3rw/nf
+t/FWosulrdq+/aDqUrDwrKQsVnEtV0y9scZfUqIh5lZfjBxZcfMRLvGA7sfLGvL6
+4YiAalBfWEi+R1AGoF+TCfs+B6Hgwu2gPGwyD4HI2Iq0YVXOjQRq1j5dAQQAnYsQ
+9g6zqzO0I/c5fFp5RHvSY/ryEbvwITfQsP2wGhbwatiAQKMiAHVqmxai02w/dhz1
+P9Qe8mC/T48JBRPPdrFOT1lfvZ/fsBjEZB/k0dAcW51lszb1o2t4Q/kPeq5vV8y5
+V4mnoLwLcJ5SiRRBrm2IAwC4/FFXJTe7LBd4XE8AEQEAAcLAfAQYAQgACQUCatY+
+XQIbBACoCRBnz0OEYoXcip0gBBkBCAAGBQJq1j5dAAoJEFY/rsxtFcsPamUD/0hO
+WaZW+risxcozhiXLqcH8YfYS5XHfQmGHzYrXi56YyMTQ+K2BToMgiUpwM2rG+Dr/
+vJOO7TvxmtCbmVK0PHzoCRZOrZ7tR3mzsX+ASeercS5Z6WD16uW2SOMZ71+imuFT
+ZntdX60xvcpGpx5gplEXnM5FwD+WgJxY3aSLxRFgieUD9RAaRaIRd9SCmJVQdqQa
+x04s6mLQsOH0YecyuurZhftgUuOsxPCNQjxfGp/z8oM9RJgYJz3l2kkolIiodcsx
+ofB7Cbh3tsH7+ge7sz5yfJbAwrAi64TmR9V+jwLtGPbOMmqO57RqCf3pn28COj+k
+APfibRue6RD2QvF4ZHen92jOVgRq1j5dEggqhkjOPQMBBwIDBObiyXceBwRVGr1l
+UvFHLstpW1GDap4CISMtreACwyclBBlSKKVh04oUfn54aaD1+GK8uDISjXu8RMx7
+PvkPXR0DAQgHwp8EGAEIAAkFAmrWPl0CGwgACgkQZ89DhGKF3IoNsAQA4eRUzdne
+nO+PMg2I6SSr42ET83I6tym9T4CbE38C8kOG6q8WtaHHpFJViWaD29cOOKU4E7BD
+FpCcMpc98Qyh1rvzzJZ13Tl5amy2ctm8gBTcYyFe2QJ+ZCtykC6y8lgTAZUcA1QN
+TEfWtr/+1n99cvwNAr7Ph8q3cqPCNZVtfYM=
+=Wqlv
+-----END PGP PUBLIC KEY BLOCK-----
+"""
+
+
+def reference_crc24(data):
+    """
+    The CRC24 of RFC 4880, computed a bit at a time.
+    """
+    crc = 0x0B704CE
+    for b in bytearray(data):
+        crc ^= b << 16
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= 0x1864CFB
+    return crc & 0xFFFFFF
+
+
+class CRC24TestCase(unittest.TestCase):
+
+    def test_check_value(self):
+        self.assertEqual(0x21CF02, Armorable.crc24(b"123456789"))
+
+    def test_reference(self):
+        rand = random.Random(0)
+        for size in (0, 1, 2, 3, 255, 256, 1000, 4096):
+            data = bytes(bytearray(rand.getrandbits(8) for _ in xrange(size)))
+            self.assertEqual(reference_crc24(data), Armorable.crc24(data))
+
+
+class KeyRoundTripTestCase(unittest.TestCase):
+
+    def assertRoundTrip(self, blob):
+        key, _ = PGPKey.from_blob(blob)
+        self.assertEqual(Armorable.ascii_unarmor(blob)["body"],
+                         key.__bytes__())
+        return key
+
+    def test_simple_key(self):
+        key = self.assertRoundTrip(PUBLIC_KEY)
+        self.assertEqual(1, len(key.userids))
+        self.assertEqual(1, len(key.subkeys))
+
+    def test_many_uids(self):
+        key = self.assertRoundTrip(MANY_UIDS_KEY)
+        self.assertEqual(MANY_UIDS_KEY, str(key))
+        self.assertEqual(6, len(key.userids))
+        self.assertEqual(2, len(key.subkeys))
+        self.assertEqual([True] + [False] * 5,
+                         [uid.is_primary for uid in key.userids])
+        self.assertEqual("User 0", key.userids[0].name)
+        self.assertTrue(key.verify(key))
+        for uid in key.userids:
+            self.assertTrue(key.verify(uid))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# test_retry.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Retry with backoff tests
+"""
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from leap.mx.retry import Backoff, retry
+
+
+class Transient(Exception):
+    pass
+
+
+class Flaky(object):
+
+    def __init__(self, failures):
+        self.failures = list(failures)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.failures:
+            return defer.fail(self.failures.pop(0))
+        return defer.succeed("done")
+
+
+def is_transient(error):
+    return isinstance(error, Transient)
+
+
+class RetryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def test_delays(self):
+        backoff = Backoff(retries=5, initial=1, maximum=5)
+        self.assertEqual([1, 2, 4, 5, 5], backoff.delays())
+
+    def test_retries_transient_failures(self):
+        f = Flaky([Transient(), Transient()])
+        d = retry(f, is_transient, Backoff(retries=3, initial=1),
+                  clock=self.clock)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.assertNoResult(d)
+        self.clock.advance(2)
+        self.assertEqual("done", self.successResultOf(d))
+        self.assertEqual(3, f.calls)
+
+    def test_gives_up(self):
+        f = Flaky([Transient(), Transient()])
+        d = retry(f, is_transient, Backoff(retries=1, initial=1),
+                  clock=self.clock)
+        self.clock.advance(1)
+        self.failureResultOf(d, Transient)
+        self.assertEqual(2, f.calls)
+
+    def test_permanent_failure(self):
+        f = Flaky([ValueError()])
+        d = retry(f, is_transient, clock=self.clock)
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(1, f.calls)
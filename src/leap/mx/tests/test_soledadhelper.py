@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# test_soledadhelper.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+SoledadIncomingAPI tests
+"""
+
+import base64
+import json
+
+from io import BytesIO
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.web import resource, server
+
+from leap.mx.retry import Backoff
+from leap.mx.soledadhelper import ENC_SCHEME_HEADER
+from leap.mx.soledadhelper import SoledadIncomingAPI
+from leap.mx.soledadhelper import StringBodyProducer
+from leap.mx.soledadhelper import UnavailableIncomingAPIException
+
+
+class IncomingResource(resource.Resource):
+
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.docs = {}
+        self.enc_schemes = {}
+        self.drop = 0
+        self.code = 200
+        self.failures = 0
+        self.requests = 0
+
+    def render_PUT(self, request):
+        self.requests += 1
+        if self.failures:
+            self.failures -= 1
+            request.setResponseCode(503)
+            return ""
+        if self.drop:
+            self.drop -= 1
+            request.transport.abortConnection()
+            return server.NOT_DONE_YET
+        self.docs[request.path] = request.content.read()
+        self.enc_schemes[request.path] = request.getHeader(ENC_SCHEME_HEADER)
+        request.setResponseCode(self.code)
+        return ""
+
+
+class BatchIncomingResource(IncomingResource):
+
+    def __init__(self):
+        IncomingResource.__init__(self)
+        self.batches = 0
+        self.failing = set()
+
+    def render_POST(self, request):
+        self.batches += 1
+        results = []
+        for item in json.loads(request.content.read())["docs"]:
+            content = item["content"]
+            if item.get("encoding") == "base64":
+                content = base64.b64decode(content)
+            status = 200
+            if item["doc_id"] in self.failing:
+                status = 500
+            else:
+                path = "/incoming/%s/%s" % (item["user"], item["doc_id"])
+                self.docs[path] = content
+                self.enc_schemes[path] = item.get("enc_scheme")
+            results.append({"doc_id": item["doc_id"], "status": status})
+        return json.dumps({"results": results})
+
+
+class SlowIncomingResource(IncomingResource):
+
+    def __init__(self):
+        IncomingResource.__init__(self)
+        self.inflight = 0
+        self.max_inflight = 0
+
+    def render_PUT(self, request):
+        self.inflight += 1
+        self.max_inflight = max(self.max_inflight, self.inflight)
+
+        def _reply():
+            self.inflight -= 1
+            request.write(IncomingResource.render_PUT(self, request))
+            request.finish()
+
+        reactor.callLater(0.01, _reply)
+        return server.NOT_DONE_YET
+
+
+class ServerTestCase(unittest.TestCase):
+
+    resource_class = IncomingResource
+    batch_size = 1
+
+    def setUp(self):
+        self.resource = self.resource_class()
+        self.port = reactor.listenTCP(
+            0, server.Site(self.resource), interface="127.0.0.1")
+        self.api = SoledadIncomingAPI(
+            "127.0.0.1", self.port.getHost().port, "service:token",
+            batch_size=self.batch_size,
+            backoff=Backoff(retries=2, initial=0.01))
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.api.close()
+        yield self.port.stopListening()
+
+
+class SoledadIncomingAPITestCase(ServerTestCase):
+
+    @defer.inlineCallbacks
+    def test_connection_is_reused(self):
+        for i in xrange(3):
+            yield self.api.put_doc("uuid", "doc%d" % i, "content %d" % i)
+        self.assertEqual(
+            "content 2", self.resource.docs["/incoming/uuid/doc2"])
+        stats = self.api.stats()
+        self.assertEqual(3, stats["requests"])
+        self.assertEqual(1, stats["new_connections"])
+        self.assertEqual(1, stats["idle_connections"])
+
+    @defer.inlineCallbacks
+    def test_retry_on_dropped_connection(self):
+        self.resource.drop = 1
+        yield self.api.put_doc("uuid", "doc", "content")
+        self.assertEqual("content", self.resource.docs["/incoming/uuid/doc"])
+        self.assertEqual(1, self.api.stats()["retries"])
+
+    @defer.inlineCallbacks
+    def test_file_body(self):
+        body = BytesIO("header content")
+        body.seek(len("header "))
+        self.resource.drop = 1
+        yield self.api.put_doc("uuid", "doc", body)
+        self.assertEqual("content", self.resource.docs["/incoming/uuid/doc"])
+        self.assertFalse(body.closed)
+
+    @defer.inlineCallbacks
+    def test_producer_body(self):
+        yield self.api.put_doc("uuid", "doc", StringBodyProducer("content"))
+        self.assertEqual("content", self.resource.docs["/incoming/uuid/doc"])
+
+    @defer.inlineCallbacks
+    def test_producer_body_is_not_retried(self):
+        self.resource.drop = 1
+        d = self.api.put_doc("uuid", "doc", StringBodyProducer("content"))
+        yield self.assertFailure(d, UnavailableIncomingAPIException)
+
+    @defer.inlineCallbacks
+    def test_gives_up(self):
+        # every attempt of the backoff loses its connection and its retry
+        self.resource.drop = (SoledadIncomingAPI.CONNECTION_RETRIES + 1) * 3
+        d = self.api.put_doc("uuid", "doc", "content")
+        yield self.assertFailure(d, UnavailableIncomingAPIException)
+        self.assertEqual(0, self.resource.drop)
+
+    @defer.inlineCallbacks
+    def test_error_status(self):
+        self.resource.code = 500
+        d = self.api.put_doc("uuid", "doc", "content")
+        yield self.assertFailure(d, UnavailableIncomingAPIException)
+        self.assertEqual(3, self.resource.requests)
+
+    @defer.inlineCallbacks
+    def test_client_error_is_not_retried(self):
+        self.resource.code = 403
+        d = self.api.put_doc("uuid", "doc", "content")
+        error = yield self.assertFailure(d, UnavailableIncomingAPIException)
+        self.assertFalse(error.transient)
+        self.assertEqual(1, self.resource.requests)
+
+    @defer.inlineCallbacks
+    def test_retry_transient_failure(self):
+        self.resource.failures = 2
+        yield self.api.put_doc("uuid", "doc", "content")
+        self.assertEqual("content", self.resource.docs["/incoming/uuid/doc"])
+        self.assertEqual(3, self.resource.requests)
+
+    @defer.inlineCallbacks
+    def test_retry_connection_refused(self):
+        port = self.port.getHost().port
+        yield self.port.stopListening()
+        d = self.api.put_doc("uuid", "doc", "content")
+        reactor.callLater(0.005, self._listen, port)
+        yield d
+        self.assertEqual("content", self.resource.docs["/incoming/uuid/doc"])
+
+    def _listen(self, port):
+        self.port = reactor.listenTCP(
+            port, server.Site(self.resource), interface="127.0.0.1")
+
+
+DOCS = [("uuid", "doc1", "content 1", None, None),
+        ("uuid", "doc2", "\x00\xff", "application/pgp-encrypted",
+         "pubkey-binary")]
+
+
+class BatchTestCase(ServerTestCase):
+
+    resource_class = BatchIncomingResource
+    batch_size = 10
+
+    @defer.inlineCallbacks
+    def test_put_docs(self):
+        self.resource.failing.add("doc2")
+        errors = yield self.api.put_docs(DOCS)
+        self.assertEqual(1, self.resource.batches)
+        self.assertEqual(None, errors[0])
+        self.assertIsInstance(errors[1], UnavailableIncomingAPIException)
+        self.assertEqual(
+            "content 1", self.resource.docs["/incoming/uuid/doc1"])
+
+    @defer.inlineCallbacks
+    def test_binary_content(self):
+        errors = yield self.api.put_docs(DOCS)
+        self.assertEqual([None, None], errors)
+        self.assertEqual(
+            "\x00\xff", self.resource.docs["/incoming/uuid/doc2"])
+        self.assertEqual(
+            "pubkey-binary", self.resource.enc_schemes["/incoming/uuid/doc2"])
+        self.assertEqual(
+            None, self.resource.enc_schemes["/incoming/uuid/doc1"])
+
+
+class BatchFallbackTestCase(ServerTestCase):
+
+    batch_size = 10
+
+    @defer.inlineCallbacks
+    def test_fallback_to_put(self):
+        self.assertTrue(self.api.batching)
+        errors = yield self.api.put_docs(DOCS)
+        self.assertEqual([None, None], errors)
+        self.assertFalse(self.api.batching)
+        self.assertEqual(
+            "content 1", self.resource.docs["/incoming/uuid/doc1"])
+        self.assertEqual(
+            "pubkey-binary", self.resource.enc_schemes["/incoming/uuid/doc2"])
+
+
+class SlowBatchFallbackTestCase(ServerTestCase):
+
+    resource_class = SlowIncomingResource
+    batch_size = 10
+
+    @defer.inlineCallbacks
+    def test_fallback_puts_one_at_a_time(self):
+        errors = yield self.api.put_docs(DOCS * 3)
+        self.assertEqual([None] * 6, errors)
+        self.assertEqual(1, self.resource.max_inflight)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# test_throttle.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tcp map throttling tests
+"""
+
+from twisted.internet import defer, task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from leap.mx.alias_resolver import AliasResolverFactory
+from leap.mx.throttle import QueryThrottle, TokenBucket
+
+
+UUID = "13d5203bdd09be1e638bdb1d315251cb"
+
+
+class SlowCouchDB(object):
+
+    def __init__(self):
+        self.pending = []
+
+    def getUuidAndPubkey(self, address):
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+    def fire(self):
+        pending, self.pending = self.pending, []
+        for d in pending:
+            d.callback((UUID, "pubkey"))
+
+
+class TokenBucketTestCase(unittest.TestCase):
+
+    def test_rate(self):
+        clock = task.Clock()
+        bucket = TokenBucket(2, 2, clock)
+        self.assertTrue(bucket.consume())
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+        clock.advance(0.5)
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+        clock.advance(10)
+        self.assertTrue(bucket.consume(2))
+        self.assertFalse(bucket.consume())
+        bucket.refund()
+        self.assertTrue(bucket.consume())
+
+
+class ThrottledMapTestCase(unittest.TestCase):
+
+    def connect(self, factory):
+        proto = factory.buildProtocol(("127.0.0.1", 0))
+        transport = proto_helpers.StringTransport()
+        proto.makeConnection(transport)
+        self.addCleanup(proto.setTimeout, None)
+        return proto, transport
+
+    def test_max_connections(self):
+        throttle = QueryThrottle(max_connections=1)
+        factory = AliasResolverFactory(SlowCouchDB(), throttle=throttle)
+        _, first = self.connect(factory)
+        _, second = self.connect(factory)
+        self.assertFalse(first.disconnecting)
+        self.assertTrue(second.disconnecting)
+        self.assertEqual(1, throttle.rejected_connections)
+
+    def test_max_inflight(self):
+        cdb = SlowCouchDB()
+        throttle = QueryThrottle(max_inflight=1)
+        factory = AliasResolverFactory(cdb, throttle=throttle)
+        proto, transport = self.connect(factory)
+        proto.lineReceived("get foo@leap.se")
+        proto.lineReceived("get bar@leap.se")
+        self.assertEqual("400 TRY%20AGAIN%20LATER\n", transport.value())
+        transport.clear()
+        cdb.fire()
+        self.assertEqual("200 %s%%40deliver.local\n" % UUID, transport.value())
+        transport.clear()
+        proto.lineReceived("get bar@leap.se")
+        cdb.fire()
+        self.assertEqual("200 %s%%40deliver.local\n" % UUID, transport.value())
+        self.assertEqual(1, throttle.rejected_queries)
+
+    def test_rate(self):
+        cdb = SlowCouchDB()
+        clock = task.Clock()
+        throttle = QueryThrottle(connection_rate=1, clock=clock)
+        factory = AliasResolverFactory(cdb, throttle=throttle)
+        proto, transport = self.connect(factory)
+        proto.lineReceived("get foo@leap.se")
+        proto.lineReceived("get bar@leap.se")
+        cdb.fire()
+        self.assertEqual(1, throttle.rejected_queries)
+        clock.advance(1)
+        transport.clear()
+        proto.lineReceived("get bar@leap.se")
+        cdb.fire()
+        self.assertEqual("200 %s%%40deliver.local\n" % UUID, transport.value())
+
+    def test_global_rate_keeps_connection_tokens(self):
+        cdb = SlowCouchDB()
+        clock = task.Clock()
+        throttle = QueryThrottle(rate=1, connection_rate=1.0 / 3600,
+                                 connection_burst=1, clock=clock)
+        factory = AliasResolverFactory(cdb, throttle=throttle)
+        first, _ = self.connect(factory)
+        second, transport = self.connect(factory)
+        first.lineReceived("get foo@leap.se")
+        # refused by the global limit, the connection still has its token
+        second.lineReceived("get bar@leap.se")
+        self.assertEqual("400 TRY%20AGAIN%20LATER\n", transport.value())
+        clock.advance(1)
+        transport.clear()
+        second.lineReceived("get bar@leap.se")
+        cdb.fire()
+        self.assertEqual("200 %s%%40deliver.local\n" % UUID, transport.value())
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# throttle.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Throttling of the postfix tcp map servers.
+
+A QueryThrottle caps the number of concurrent connections to a map, the
+number of lookups in flight on each connection, and the rate of lookups both
+per connection and for the whole map using token buckets. Lookups over any of
+the limits are answered right away with a temporary failure, so postfix will
+retry later instead of piling up requests in front of CouchDB.
+"""
+
+from twisted.internet import reactor
+
+
+class TokenBucket(object):
+    """
+    A token bucket rate limiter.
+    """
+
+    def __init__(self, rate, burst, clock=reactor):
+        """
+        Initialize the bucket, full.
+
+        :param rate: Tokens added per second.
+        :type rate: float
+        :param burst: Maximum number of tokens held by the bucket.
+        :type burst: float
+        :param clock: Provider of the current time.
+        :type clock: twisted.internet.interfaces.IReactorTime
+        """
+        self._rate = float(rate)
+        self._burst = float(burst)
+        self._clock = clock
+        self._tokens = self._burst
+        self._last = clock.seconds()
+
+    def consume(self, tokens=1):
+        """
+        Take tokens from the bucket if there are enough of them.
+
+        :param tokens: The number of tokens to take.
+        :type tokens: int
+
+        :return: Whether the tokens were taken.
+        :rtype: bool
+        """
+        now = self._clock.seconds()
+        self._tokens = min(
+            self._burst, self._tokens + (now - self._last) * self._rate)
+        self._last = now
+        if self._tokens < tokens:
+            return False
+        self._tokens -= tokens
+        return True
+
+    def refund(self, tokens=1):
+        """
+        Give back tokens taken with consume() for something that didn't
+        happen after all.
+
+        :param tokens: The number of tokens to give back.
+        :type tokens: int
+        """
+        self._tokens = min(self._burst, self._tokens + tokens)
+
+
+class QueryThrottle(object):
+    """
+    Limits on the connections and lookups served by a tcp map factory.
+
+    Any of the limits can be None to disable it.
+    """
+
+    def __init__(self, max_connections=None, max_inflight=None,
+                 rate=None, burst=None, connection_rate=None,
+                 connection_burst=None, clock=reactor):
+        """
+        Initialize the throttle.
+
+        :param max_connections: Maximum number of concurrent connections.
+        :type max_connections: int
+        :param max_inflight: Maximum number of lookups in flight on a single
+                             connection.
+        :type max_inflight: int
+        :param rate: Lookups per second allowed for the whole map.
+        :type rate: float
+        :param burst: Lookups allowed in a burst for the whole map. Defaults
+                      to rate.
+        :type burst: float
+        :param connection_rate: Lookups per second allowed on a single
+                                connection.
+        :type connection_rate: float
+        :param connection_burst: Lookups allowed in a burst on a single
+                                 connection. Defaults to connection_rate.
+        :type connection_burst: float
+        :param clock: Provider of the current time.
+        :type clock: twisted.internet.interfaces.IReactorTime
+        """
+        self._max_connections = max_connections
+        self._max_inflight = max_inflight
+        self._connection_rate = connection_rate
+        self._connection_burst = connection_burst or connection_rate
+        self._clock = clock
+        self._bucket = None
+        if rate:
+            self._bucket = TokenBucket(rate, burst or rate, clock)
+        self._connections = {}
+        self.rejected_connections = 0
+        self.rejected_queries = 0
+
+    @property
+    def connections(self):
+        """
+        The number of connections currently accepted.
+        """
+        return len(self._connections)
+
+    def connection_made(self, conn):
+        """
+        Register a new connection.
+
+        :param conn: The protocol instance serving the connection.
+        :type conn: twisted.internet.protocol.Protocol
+
+        :return: Whether the connection should be served.
+        :rtype: bool
+        """
+        if self._max_connections is not None \
+                and len(self._connections) >= self._max_connections:
+            self.rejected_connections += 1
+            return False
+        bucket = None
+        if self._connection_rate:
+            bucket = TokenBucket(
+                self._connection_rate, self._connection_burst, self._clock)
+        self._connections[conn] = [0, bucket]
+        return True
+
+    def connection_lost(self, conn):
+        """
+        Unregister a connection.
+
+        :param conn: The protocol instance serving the connection.
+        :type conn: twisted.internet.protocol.Protocol
+        """
+        self._connections.pop(conn, None)
+
+    def acquire(self, conn):
+        """
+        Try to start a lookup on a connection.
+
+        :param conn: The protocol instance serving the connection.
+        :type conn: twisted.internet.protocol.Protocol
+
+        :return: Whether the lookup may proceed. If it may, release() must be
+                 called once it is done.
+        :rtype: bool
+        """
+        state = self._connections.get(conn)
+        if state is None:
+            self.rejected_queries += 1
+            return False
+        inflight, bucket = state
+        over_inflight = self._max_inflight is not None \
+            and inflight >= self._max_inflight
+        if over_inflight or (bucket is not None and not bucket.consume()):
+            self.rejected_queries += 1
+            return False
+        if self._bucket is not None and not self._bucket.consume():
+            # the lookup isn't made, the connection keeps its token
+            if bucket is not None:
+                bucket.refund()
+            self.rejected_queries += 1
+            return False
+        state[0] += 1
+        return True
+
+    def release(self, conn):
+        """
+        Mark a lookup started with acquire() as done.
+
+        :param conn: The protocol instance serving the connection.
+        :type conn: twisted.internet.protocol.Protocol
+        """
+        state = self._connections.get(conn)
+        if state is not None:
+            state[0] -= 1